@@ -0,0 +1,309 @@
+'''
+Benchmarks for the crawler and data processing code. Run
+
+	python benchmarks.py
+
+to print timings for all benchmarks on synthetic data.
+'''
+import fmcrawler_sql
+import fightmetric as fm
+import os,time,random,shutil,sqlite3,tempfile,datetime
+
+def synthetic_records(nFighters=4000,nFightsPerFighter=14,seed=0):
+    '''
+    Builds a synthetic corpus of parsed fighter pages, in the format returned
+    by fmcrawler_sql.parse_fighter_page. Every fight appears on the pages of
+    both fighters, as on Fightmetric.
+
+    Parameters
+    ----------
+    nFighters : int (optional)
+    	Number of fighters. Default is 4000, roughly the size of Fightmetric.
+
+    nFightsPerFighter : int (optional)
+    	Average number of fights per fighter. Default is 14.
+
+    seed : int (optional)
+    	Seed for the random number generator.
+
+    Returns
+    -------
+    records : list
+    	List of (fighterURL, stats, urls, fights, fingerprint) tuples.
+
+    '''
+
+    rnd = random.Random(seed)
+
+    names = ['Fighter%04d Lastname%04d'%(i,i) for i in range(nFighters)]
+    urls = ['fightmetric.com/fighter-details/%08x'%rnd.getrandbits(32) for i in range(nFighters)]
+
+    urlByName = dict(zip(names,urls))
+    fightsByFighter = [[] for i in range(nFighters)]
+
+    nFights = nFighters*nFightsPerFighter/2
+    for k in range(nFights):
+        i,j = rnd.sample(xrange(nFighters),2)
+        outcome = rnd.choice(['win','loss'])
+        event = 'UFC%d:Event%d'%(k/12,k)
+
+        # one event a week, twelve fights per event
+        date = datetime.date(1993,11,12)+datetime.timedelta(days=7*(k/12))
+
+        fight = {'Event':[event,date.strftime('%b.%d,%Y')],'Method':'KO/TKOPunches',\
+                 'Round':float(rnd.randint(1,3)),'Time':float(rnd.randint(1,300)),\
+                 'Pass':[float(rnd.randint(0,5)),float(rnd.randint(0,5))],\
+                 'Str':[float(rnd.randint(0,99)),float(rnd.randint(0,99))],\
+                 'Sub':[float(rnd.randint(0,3)),float(rnd.randint(0,3))],\
+                 'Td':[float(rnd.randint(0,5)),float(rnd.randint(0,5))]}
+
+        fight1 = dict(fight,Fighter=[names[i],names[j]],outcome=outcome)
+        fight2 = dict(fight,Fighter=[names[j],names[i]],\
+                      outcome={'win':'loss','loss':'win'}[outcome])
+        for key in ['Pass','Str','Sub','Td']:
+            fight2[key] = fight[key][::-1]
+
+        fightsByFighter[i].append(fight1)
+        fightsByFighter[j].append(fight2)
+
+    records = []
+    for i in range(nFighters):
+        fights = fightsByFighter[i]
+
+        stats = {'Name':names[i],'url':urls[i],'Height':rnd.uniform(160,200),\
+                 'Weight':rnd.uniform(55,120),'Reach':rnd.uniform(160,210),\
+                 'STANCE':rnd.choice(['Orthodox','Southpaw']),'DOB':'Jul 13, 1988',\
+                 'SLpM':rnd.uniform(1,6),'Str. Acc.':rnd.random(),'SApM':rnd.uniform(1,6),\
+                 'Str. Def':rnd.random(),'TD Avg.':rnd.uniform(0,4),'TD Acc.':rnd.random(),\
+                 'TD Def.':rnd.random(),'Sub. Avg.':rnd.uniform(0,2)}
+
+        fingerprint = fmcrawler_sql.record_fingerprint(stats,fights)
+
+        stats['wins'] = fmcrawler_sql.compute_wins(fights)
+        stats['losses'] = fmcrawler_sql.compute_losses(fights)
+        stats['cumtime'] = fmcrawler_sql.compute_cumtime(fights)
+
+        opponentURLs = set([urlByName[f['Fighter'][1]] for f in fights[:5]])
+
+        records.append((urls[i],stats,opponentURLs,fights,fingerprint))
+
+    return records
+
+
+def benchmark_writes(nFighters=4000,batchSize=100):
+    '''
+    Compares the per-row write path (write_fighter_to_database and
+    write_fights_to_database, committing after every page) with the
+    batched path (BatchWriter) on a synthetic corpus.
+
+    Parameters
+    ----------
+    nFighters : int (optional)
+    	Number of fighters in the synthetic corpus. Default is 4000.
+
+    batchSize : int (optional)
+    	Number of pages per transaction for the batched path. Default is 100.
+
+    Returns
+    -------
+    timings : dict
+    	Wall-clock time in seconds for each write path.
+
+    '''
+
+    records = synthetic_records(nFighters)
+
+    tmpdir = tempfile.mkdtemp()
+    timings = {}
+    try:
+        # per-row path
+        dbfile = os.path.join(tmpdir,'perrow.sqlite')
+        fmcrawler_sql.init_db(dbfile)
+        conn = sqlite3.connect(dbfile)
+        cur = conn.cursor()
+
+        t0 = time.time()
+        for fighterURL,stats,urls,fights,fingerprint in records:
+            fmcrawler_sql.write_fighter_to_database(dict(stats),urls,cur)
+            fmcrawler_sql.write_fights_to_database(fights,cur)
+            conn.commit()
+        timings['per-row'] = time.time()-t0
+
+        nFightsPerRow = cur.execute('SELECT COUNT(*) FROM Fights').fetchone()[0]
+        conn.close()
+
+        # batched path
+        dbfile = os.path.join(tmpdir,'batched.sqlite')
+        fmcrawler_sql.init_db(dbfile)
+        conn = sqlite3.connect(dbfile)
+        fmcrawler_sql.configure_connection(conn)
+
+        t0 = time.time()
+        writer = fmcrawler_sql.BatchWriter(conn,batchSize)
+        for record in records:
+            writer.add(record)
+        writer.flush()
+        timings['batched'] = time.time()-t0
+
+        nFightsBatched = conn.execute('SELECT COUNT(*) FROM Fights').fetchone()[0]
+        conn.close()
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print '--- Database writes (%d fighters, %d fights) ---'%(nFighters,nFightsBatched)
+    print '%-10s %10s %12s'%('path','seconds','pages/sec')
+    for path in ['per-row','batched']:
+        print '%-10s %10.2f %12.1f'%(path,timings[path],nFighters/timings[path])
+    print 'Speed-up: %.1fx'%(timings['per-row']/timings['batched'])
+
+    if nFightsPerRow != nFightsBatched:
+        print 'Warning: paths wrote different numbers of fights (%d vs %d)'%\
+            (nFightsPerRow,nFightsBatched)
+
+    return timings
+
+
+def synthetic_page(name,fighterId,opponents,seed=0):
+    '''
+    Builds a synthetic fighter profile page, laid out like a Fightmetric
+    page as far as fm.parse_page is concerned.
+
+    Parameters
+    ----------
+    name : str
+    	Name of the fighter.
+
+    fighterId : str
+    	Id used in the fighter's profile URL.
+
+    opponents : list
+    	List of (name, fighterId) tuples, one per fight.
+
+    seed : int (optional)
+    	Seed for the random number generator.
+
+    Returns
+    -------
+    page : list
+    	The page as a list of lines, like fm.get_page.
+
+    '''
+
+    rnd = random.Random(seed)
+
+    # whitespace between the two values in a table cell, as on the real pages
+    pad = ' '*40
+    link = '<a class="b-link" href="http://fightmetric.com/fighter-details/%s">'
+
+    lines = ['<html>','<body>','<span class="b-content__title-highlight">',name,'</span>','<ul>']
+
+    stats = [('Height',"5' %d\""%rnd.randint(0,11)),('Weight','%d lbs.'%rnd.randint(125,265)),\
+             ('Reach','%d"'%rnd.randint(60,80)),('STANCE',rnd.choice(['Orthodox','Southpaw'])),\
+             ('DOB','Jul %02d, %d'%(rnd.randint(1,28),rnd.randint(1970,1995))),\
+             ('SLpM','%.2f'%rnd.uniform(1,6)),('Str. Acc.','%d%%'%rnd.randint(30,60)),\
+             ('SApM','%.2f'%rnd.uniform(1,6)),('Str. Def','%d%%'%rnd.randint(40,70)),\
+             ('TD Avg.','%.2f'%rnd.uniform(0,4)),('TD Acc.','%d%%'%rnd.randint(20,60)),\
+             ('TD Def.','%d%%'%rnd.randint(40,90)),('Sub. Avg.','%.1f'%rnd.uniform(0,2))]
+
+    for metric,val in stats:
+        lines += ['<li class="b-list__box-list-item">','<i class="b-list__box-item-title">',\
+                  metric+':','</i>']
+        if metric in ['DOB','SLpM']:
+            lines.append('')
+        lines += [val,'</li>']
+
+    lines += ['</ul>','<table class="b-fight-details__table">','<thead>','<tr>']
+    for column in ['W/L','Fighter','Str','Td','Sub','Pass','Event','Method','Round','Time']:
+        lines += ['<th class="b-fight-details__table-col">','  '+column,'</th>']
+    lines += ['</tr>','</thead>','<tbody>']
+
+    for k,(opponent,opponentId) in enumerate(opponents):
+        outcome = rnd.choice(['win','loss'])
+        lines += ['<tr class="b-fight-details__table-row">','<td class="b-fight-details__table-col">',\
+                  '<p><i class="b-flag__text">%s<i class="b-flag__icon"></i></i></p>'%outcome,'</td>']
+
+        lines += ['<td class="b-fight-details__table-col">',\
+                  '<p>'+pad,link%fighterId,name,'</a>'+pad,'</p>',\
+                  '<p>'+pad,link%opponentId,opponent,'</a>'+pad,'</p>','</td>']
+
+        for column in ['Str','Td','Sub','Pass']:
+            lines += ['<td class="b-fight-details__table-col">',\
+                      '<p>%d</p>'%rnd.randint(10,99)+pad,'<p>%d</p>'%rnd.randint(10,99),'</td>']
+
+        lines += ['<td class="b-fight-details__table-col">',\
+                  '<p><a>UFC %d: Card %d</a></p>'%(100+k,k)+pad,\
+                  '<p>Mar. %02d, %d</p>'%(rnd.randint(1,28),2016-k),'</td>']
+        lines += ['<td class="b-fight-details__table-col">','<p>KO/TKO</p>','<p>Punches</p>','</td>']
+        lines += ['<td class="b-fight-details__table-col">','<p>%d</p>'%rnd.randint(1,3),'</td>']
+        lines += ['<td class="b-fight-details__table-col">',\
+                  '<p>%d:%02d</p>'%(rnd.randint(0,4),rnd.randint(0,59)),'</td>']
+        lines += ['</tr>']
+
+    lines += ['</tbody>','</table>','</body>','</html>']
+
+    return [line+'\n' for line in lines]
+
+
+def parse_page_multipass(page):
+    ''' The previous parse_page: one scan of the page for each stat, the fights and the links. '''
+
+    fighter_stats = fm.parse_stats(page)
+    fights = fm.parse_fights(page)
+
+    fighter_stats['Fights'] = fights
+    if len(fights) == 0:
+        fighter_stats['Name'] = 'Unknown fighter'
+    else:
+        fighter_stats['Name'] = fights[0]['Fighter'][0]
+
+    return fighter_stats,fm.get_fighter_urls(page)
+
+
+def benchmark_parse(nPages=200,nFights=20):
+    '''
+    Compares the multi-pass page parser with the single-pass fm.parse_page
+    on synthetic fighter pages, and checks that both give the same output.
+
+    Parameters
+    ----------
+    nPages : int (optional)
+    	Number of pages to parse. Default is 200.
+
+    nFights : int (optional)
+    	Number of fights on each page. Default is 20.
+
+    Returns
+    -------
+    timings : dict
+    	Mean parse time per page in milliseconds for each parser.
+
+    '''
+
+    pages = []
+    for i in range(nPages):
+        opponents = [('Opponent%d Lastname%d'%(j,j),'%x'%(1000*i+j)) for j in range(nFights)]
+        pages.append(synthetic_page('Fighter%d Lastname%d'%(i,i),'%x'%i,opponents,seed=i))
+
+    timings = {}
+    results = {}
+    for parserName,parser in [('multi-pass',parse_page_multipass),('single-pass',fm.parse_page)]:
+        t0 = time.time()
+        results[parserName] = [parser(page) for page in pages]
+        timings[parserName] = 1000*(time.time()-t0)/nPages
+
+    print '--- Page parsing (%d pages, %d fights each) ---'%(nPages,nFights)
+    print '%-12s %12s'%('parser','ms/page')
+    for parserName in ['multi-pass','single-pass']:
+        print '%-12s %12.3f'%(parserName,timings[parserName])
+    print 'Speed-up: %.1fx'%(timings['multi-pass']/timings['single-pass'])
+
+    if results['multi-pass'] != results['single-pass']:
+        print 'Warning: parsers gave different results'
+
+    return timings
+
+
+if __name__ == "__main__":
+    benchmark_writes()
+    benchmark_parse()
@@ -1,11 +1,65 @@
 
-import fmprocess
+import fmprocess,fighterindex,ratings
 import sklearn.linear_model as sklin
 import numpy as np
+import pandas as pd
+import pickle,copy,os,time,json
 import matplotlib.pyplot as plt
 import sklearn.ensemble as sken
 import sklearn.linear_model as sklin
 
+class Normaliser(object):
+    '''
+    Normalises feature matrices with the mean and standard deviation of the
+    training data. Unlike a lambda, this can be pickled along with the
+    classifier.
+
+    Parameters
+    ----------
+    meanNorm : pd.Series
+    	Mean of each feature column.
+
+    sdNorm : pd.Series
+    	Standard deviation of each feature column.
+
+    '''
+
+    def __init__(self,meanNorm,sdNorm):
+        self.meanNorm = meanNorm
+        self.sdNorm = sdNorm
+
+    def __call__(self,x):
+        return (x-self.meanNorm)/self.sdNorm
+
+
+def make_estimator(classifierType='logistic',**params):
+    '''
+    Creates an unfitted classifier.
+
+    Parameters
+    ----------
+    classifierType : str
+    	Type of classifier, either 'logistic' or 'randomforest'.
+
+    params : keyword arguments
+    	Hyperparameters passed on to the sklearn estimator (e.g. C for
+    	logistic regression, n_estimators for random forests).
+
+    Returns
+    -------
+    myClassifier : sklearn classifier
+
+    '''
+
+    if classifierType == 'logistic':
+        return sklin.LogisticRegression(**params)
+
+    elif classifierType == 'randomforest':
+        return sken.RandomForestClassifier(**params)
+
+    raise ValueError("classifierType must be 'logistic' or 'randomforest'.")
+
+
 def build_classifier(X=None,y=None,classifierType='logistic'):
     ''' Convenience function to build a classifier.
     
@@ -27,20 +81,15 @@ def build_classifier(X=None,y=None,classifierType='logistic'):
 	Either logistic regression or random forest classifier.
 
     '''
-    fighters = fmprocess.get_fighters()
-
     if X is None or y is None: # only call this if it's not fed as input
+        fighters = fmprocess.get_fighters()
         X,y = fmprocess.build_features(fighters)
 
-    if classifierType == 'logistic':
-        myClassifier = sklin.LogisticRegression()
-        
-    elif classifierType == 'randomforest':
-        myClassifier = sken.RandomForestClassifier()
+    myClassifier = make_estimator(classifierType)
 
     myClassifier.meanNorm = X.mean(0)
     myClassifier.sdNorm = X.std(0)
-    myClassifier.normalise = lambda x:(x-myClassifier.meanNorm)/myClassifier.sdNorm
+    myClassifier.normalise = Normaliser(myClassifier.meanNorm,myClassifier.sdNorm)
     
     X = myClassifier.normalise(X)
     
@@ -48,6 +97,104 @@ def build_classifier(X=None,y=None,classifierType='logistic'):
 
     return myClassifier
 
+def save_classifier(myClassifier,fname='classifier.pickle',dbfile='fighterdb.sqlite'):
+    '''
+    Saves a trained classifier, so that it can be used for predictions
+    without retraining (see load_classifier).
+
+    The artifact bundles the fitted estimator, the normalisation mean and
+    standard deviation (as arrays, with the feature column names), the
+    feature schema version (fmprocess.FEATURE_SCHEMA_VERSION) and the
+    fingerprint of the database it was trained on.
+
+    Parameters
+    ----------
+    myClassifier : sklearn classifier
+    	Obtained from calling build_classifier.
+
+    fname : str (optional)
+    	File to save to. Default is 'classifier.pickle'.
+
+    dbfile : str (optional)
+    	Database the classifier was trained on. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    Nothing.
+
+    '''
+
+    # the normalisation is stored as plain arrays instead
+    estimator = copy.copy(myClassifier)
+    for attr in ['meanNorm','sdNorm','normalise']:
+        if attr in estimator.__dict__:
+            delattr(estimator,attr)
+
+    artifact = {'estimator':estimator,\
+                'columns':list(myClassifier.meanNorm.index),\
+                'mean':np.asarray(myClassifier.meanNorm.values,dtype=float),\
+                'sd':np.asarray(myClassifier.sdNorm.values,dtype=float),\
+                'schema_version':fmprocess.FEATURE_SCHEMA_VERSION,\
+                'db_fingerprint':fmprocess.db_fingerprint(dbfile),\
+                'created':time.time()}
+
+    # write to a temporary file first so readers never see a partial artifact
+    with open(fname+'.tmp','wb') as f:
+        pickle.dump(artifact,f,pickle.HIGHEST_PROTOCOL)
+    os.rename(fname+'.tmp',fname)
+
+
+def load_classifier(fname='classifier.pickle',dbfile=None,strict=False):
+    '''
+    Loads a classifier saved with save_classifier, ready for predict_fight.
+
+    Parameters
+    ----------
+    fname : str (optional)
+    	File to load from. Default is 'classifier.pickle'.
+
+    dbfile : str (optional)
+    	If given, the database fingerprint stored in the artifact is checked
+    	against this database. Default is None (no check).
+
+    strict : bool (optional)
+    	If True, a database which has changed since training raises an
+    	error; otherwise a warning is printed. Default is False.
+
+    Returns
+    -------
+    myClassifier : sklearn classifier
+    	Classifier with meanNorm, sdNorm and normalise set as by
+    	build_classifier, and the artifact metadata in schemaVersion,
+    	dbFingerprint and created.
+
+    '''
+
+    with open(fname,'rb') as f:
+        artifact = pickle.load(f)
+
+    if artifact['schema_version'] != fmprocess.FEATURE_SCHEMA_VERSION:
+        raise ValueError('%s was built with feature schema version %d, but the current version is %d; retrain the classifier.'%\
+                         (fname,artifact['schema_version'],fmprocess.FEATURE_SCHEMA_VERSION))
+
+    if dbfile is not None and artifact['db_fingerprint'] != fmprocess.db_fingerprint(dbfile):
+        if strict:
+            raise ValueError('%s was trained on a different version of %s.'%(fname,dbfile))
+        print 'Warning: %s was trained on a different version of %s.'%(fname,dbfile)
+
+    myClassifier = artifact['estimator']
+
+    myClassifier.meanNorm = pd.Series(artifact['mean'],index=artifact['columns'])
+    myClassifier.sdNorm = pd.Series(artifact['sd'],index=artifact['columns'])
+    myClassifier.normalise = Normaliser(myClassifier.meanNorm,myClassifier.sdNorm)
+
+    myClassifier.schemaVersion = artifact['schema_version']
+    myClassifier.dbFingerprint = artifact['db_fingerprint']
+    myClassifier.created = artifact['created']
+
+    return myClassifier
+
+
 def predict_fight(myClassifier,fighter1Name,fighter2Name,predict_proba=True):
     ''' Predicts a fight outcome between two (potentially unseen) fighters.
     Prints out the result (in probability by default)
@@ -58,10 +205,11 @@ def predict_fight(myClassifier,fighter1Name,fighter2Name,predict_proba=True):
     	Obtained from calling buildClassifier.
 
     fighter1Name : str
-    	Full name of the first fighter.
+    	Name of the first fighter. Small differences from the name in the
+    	database (accents, punctuation, nicknames) are resolved by fighterindex.
 
     fighter2Name : str
-    	Full name of the second fighter.
+    	Name of the second fighter.
 
     predict_proba : bool (optional)
     	Boolean specifying whether to predict probability or a discrete outcome (default is to predict probability)
@@ -74,12 +222,18 @@ def predict_fight(myClassifier,fighter1Name,fighter2Name,predict_proba=True):
     '''
     
     fighters = fmprocess.get_fighters()
-    fighter1 = fighters[fighter1Name]
-    fighter2 = fighters[fighter2Name]
 
-    x = fmprocess.build_matchup(fighter1,fighter2)
+    # resolve names which differ slightly from the database (accents, nicknames, etc.)
+    index = fighterindex.get_index()
+    names = [index.lookup(name) for name in [fighter1Name,fighter2Name]]
+    for name,match in zip([fighter1Name,fighter2Name],names):
+        if match not in fighters:
+            raise KeyError('%s not found in the database.'%name)
 
-    x = myClassifier.normalise(x)
+    # built the same way as for predict_card, including the rating and career
+    # columns of classifiers trained with them
+    features = MatchupFeatures(myClassifier,names=names)
+    x = features.build(features.rows(names[:1]),features.rows(names[1:]))
 
     if predict_proba:
         p = myClassifier.predict_proba(x)[0]
@@ -104,12 +258,213 @@ def predict_fight(myClassifier,fighter1Name,fighter2Name,predict_proba=True):
     return winner
 
 
+class MatchupFeatures(object):
+    '''
+    Per-fighter feature arrays for building a classifier's input for any
+    number of matchups at once, including the career and rating columns
+    if the classifier was trained with them.
+
+    Parameters
+    ----------
+    myClassifier : sklearn classifier
+    	Obtained from calling build_classifier or load_classifier.
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    names : list (optional)
+    	Only prepare these fighters (names as in the database). Default is
+    	all fighters.
+
+    store : featurestore.FeatureStore (optional)
+    	If given, the fighter stats are read from the (memory-mapped) store
+    	instead of being built from the database.
+
+    '''
+
+    def __init__(self,myClassifier,dbfile='fighterdb.sqlite',names=None,store=None):
+        self.classifier = myClassifier
+        self.columns = list(myClassifier.meanNorm.index)
+
+        if store is not None:
+            if names is None:
+                self.names,self.stats = store.names,store.stats
+            else:
+                self.names,self.stats = list(names),store.stats[store.rows(names)]
+        else:
+            fighters = fmprocess.get_fighters(dbfile)
+            if names is not None:
+                fighters = {name:fighters[name] for name in names}
+
+            self.names,self.stats = fmprocess.fighter_stats_array(fighters)
+        self.rowOfName = {name:row for row,name in enumerate(self.names)}
+
+        # per-fighter columns beyond the fighter stats, as in predict_fight
+        extraColumns = []
+        extras = [np.zeros([len(self.names),0])]
+        if 'f1_str_mean' in self.columns:
+            current = fmprocess.career_stats(dbfile)[1]
+            extraColumns += fmprocess.career_features
+            extras.append(current.reindex(self.names)[fmprocess.career_features].fillna(0).values)
+        if 'f1_rating' in self.columns:
+            extraColumns += ['rating']
+            extras.append(np.array(ratings.get_ratings(self.names,dbfile))[:,None])
+
+        self.extras = np.hstack(extras)
+        self.available = list(fmprocess.tagged_features)+\
+                         ['f1_'+f for f in extraColumns]+['f2_'+f for f in extraColumns]
+
+        missing = [column for column in self.columns if column not in self.available]
+        if len(missing) > 0:
+            raise ValueError('Cannot build features for columns: %s'%', '.join(missing))
+
+        # positions of the classifier's columns among the available ones
+        self.order = [self.available.index(column) for column in self.columns]
+
+    def rows(self,names):
+        ''' Returns the rows of the given fighters (names as in the database). '''
+
+        return np.array([self.rowOfName[name] for name in names],dtype=int)
+
+    def build(self,ids1,ids2):
+        '''
+        Builds the normalised classifier input for fights between the fighters
+        in rows ids1 and ids2 (see rows).
+
+        Returns
+        -------
+        X : pd.DataFrame
+        	One row per fight, with the classifier's columns.
+
+        '''
+
+        X = fmprocess.build_matchups(ids1,ids2,self.stats)
+        fmprocess.fill_missing_dob(X)
+
+        X = np.hstack([X,self.extras[ids1],self.extras[ids2]])[:,self.order]
+
+        return self.classifier.normalise(pd.DataFrame(X,columns=self.columns))
+
+    def predict_proba(self,ids1,ids2):
+        ''' Returns the win probabilities (fighter1, fighter2) for each fight; see build. '''
+
+        return self.classifier.predict_proba(self.build(ids1,ids2))
+
+
+def load_card(fname):
+    '''
+    Reads a fight card from a file.
+
+    Parameters
+    ----------
+    fname : str
+    	A CSV file with fighter1 and fighter2 columns, or without a header
+    	row, in which case the first two columns are used; or a JSON-lines
+    	file (.jsonl) with one {"fighter1": ..., "fighter2": ...} object or
+    	[fighter1, fighter2] list per line.
+
+    Returns
+    -------
+    card : list
+    	List of (fighter1, fighter2) tuples.
+
+    '''
+
+    if fname.endswith('.jsonl') or fname.endswith('.json'):
+        card = []
+        with open(fname) as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                bout = json.loads(line)
+                if type(bout) == dict:
+                    bout = (bout['fighter1'],bout['fighter2'])
+                card.append((bout[0],bout[1]))
+
+        return card
+
+    frame = pd.read_csv(fname)
+    if 'fighter1' in frame.columns and 'fighter2' in frame.columns:
+        frame = frame[['fighter1','fighter2']]
+    else:
+        # no header row; otherwise the first bout would become the header
+        frame = pd.read_csv(fname,header=None)
+
+    return [(row[0],row[1]) for row in frame.iloc[:,:2].values]
+
+
+def predict_card(myClassifier,card,dbfile='fighterdb.sqlite'):
+    '''
+    Predicts all bouts on a fight card at once: the names are resolved in one
+    pass, and a single feature matrix is built and classified.
+
+    Parameters
+    ----------
+    myClassifier : sklearn classifier
+    	Obtained from calling build_classifier or load_classifier.
+
+    card : list or str
+    	List of (fighter1, fighter2) name tuples, or a CSV/JSON-lines file
+    	(see load_card).
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    predictions : pd.DataFrame
+    	One row per bout, in card order, with columns fighter1 and fighter2
+    	(as given), name1 and name2 (as found in the database), p1 and p2
+    	(win probabilities of each corner), winner and missing (names not
+    	found in the database, comma separated). Bouts with missing
+    	fighters have NaN probabilities and no winner.
+
+    '''
+
+    if type(card) == str:
+        card = load_card(card)
+
+    index = fighterindex.get_index(dbfile)
+    features = MatchupFeatures(myClassifier,dbfile)
+    rowOfName = features.rowOfName
+
+    predictions = pd.DataFrame({'fighter1':[bout[0] for bout in card],\
+                                'fighter2':[bout[1] for bout in card]},\
+                               columns=['fighter1','fighter2','name1','name2',\
+                                        'p1','p2','winner','missing'])
+
+    resolved = [[index.lookup(name) for name in bout] for bout in card]
+    missing = [', '.join([name for name,match in zip(bout,matches) if match not in rowOfName]) \
+               for bout,matches in zip(card,resolved)]
+
+    predictions['name1'] = [matches[0] for matches in resolved]
+    predictions['name2'] = [matches[1] for matches in resolved]
+    predictions['missing'] = missing
+
+    valid = np.array([m == '' for m in missing],dtype=bool)
+    if not valid.any():
+        return predictions
+
+    names1 = predictions.name1.values[valid]
+    names2 = predictions.name2.values[valid]
+
+    p = features.predict_proba(features.rows(names1),features.rows(names2))
+
+    predictions.loc[valid,'p1'] = p[:,0]
+    predictions.loc[valid,'p2'] = p[:,1]
+    predictions.loc[valid,'winner'] = np.where(p[:,0] > 0.5,names1,names2)
+
+    return predictions
+
+
 if __name__ == "__main__":
 
     fighters = fmprocess.get_fighters()
 
-    print 'Building features (this takes a while)'
-#    X,y = fmprocess.build_features(fighters)
+    print 'Building features'
+    X,y = fmprocess.build_features(fighters)
+
+    # for a proper comparison of models and hyperparameters, see evaluation.py
     
     p = 0.75
 
@@ -0,0 +1,164 @@
+import time,threading,json,os,contextlib
+
+
+class CrawlMetrics(object):
+    '''
+    Thread-safe counters, timers and gauges for the crawler.
+
+    Timers record the number of observations, total time and maximum time
+    of a stage (e.g. 'fetch', 'parse', 'db_write'). Counters count events
+    (pages, bytes, retries) and gauges hold the latest value of a quantity
+    (e.g. the frontier size). Snapshots can be written periodically to a
+    JSON file, or to a Prometheus text file if the file name ends in .prom.
+
+    Parameters
+    ----------
+    snapshotFile : str (optional)
+    	File to write snapshots to. Default is None (no snapshots).
+
+    snapshotInterval : float (optional)
+    	Minimum number of seconds between snapshots. Default is 10.
+
+    '''
+
+    def __init__(self,snapshotFile=None,snapshotInterval=10.0):
+        self.snapshotFile = snapshotFile
+        self.snapshotInterval = snapshotInterval
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.lastSnapshot = self.startTime
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+
+    def incr(self,name,value=1):
+        ''' Adds value to a counter. '''
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0)+value
+
+    def gauge(self,name,value):
+        ''' Sets a gauge. '''
+
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self,name,seconds):
+        ''' Adds an observation (in seconds) to a timer. '''
+
+        with self.lock:
+            count,total,maximum = self.timers.get(name,(0,0.,0.))
+            self.timers[name] = (count+1,total+seconds,max(maximum,seconds))
+
+    @contextlib.contextmanager
+    def timer(self,name):
+        '''
+        Context manager which times the enclosed block, e.g.
+
+        with metrics.timer('fetch'):
+            page = fm.get_page(url)
+        '''
+
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name,time.time()-t0)
+
+    def snapshot(self):
+        '''
+        Returns the current state of all metrics.
+
+        Returns
+        -------
+        snapshot : dict
+        	Contains the elapsed time, pages per second, counters, gauges and
+        	for each timer its count, total, mean and max in seconds.
+
+        '''
+
+        with self.lock:
+            elapsed = time.time()-self.startTime
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            timers = {}
+            for name,(count,total,maximum) in self.timers.items():
+                timers[name] = {'count':count,'total':total,'max':maximum,\
+                                'mean':total/count if count else 0.}
+
+        return {'elapsed':elapsed,\
+                'pages_per_sec':counters.get('pages_fetched',0)/max(elapsed,1e-9),\
+                'counters':counters,'gauges':gauges,'timers':timers}
+
+    def to_prometheus(self,snapshot=None):
+        ''' Formats a snapshot in the Prometheus text exposition format. '''
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        lines = ['# TYPE crawl_elapsed_seconds gauge',\
+                 'crawl_elapsed_seconds %f'%snapshot['elapsed'],\
+                 '# TYPE crawl_pages_per_second gauge',\
+                 'crawl_pages_per_second %f'%snapshot['pages_per_sec']]
+
+        for name,value in sorted(snapshot['counters'].items()):
+            lines += ['# TYPE crawl_%s_total counter'%name,'crawl_%s_total %s'%(name,value)]
+
+        for name,value in sorted(snapshot['gauges'].items()):
+            lines += ['# TYPE crawl_%s gauge'%name,'crawl_%s %s'%(name,value)]
+
+        for name,timer in sorted(snapshot['timers'].items()):
+            lines += ['# TYPE crawl_%s_seconds summary'%name,\
+                      'crawl_%s_seconds_count %d'%(name,timer['count']),\
+                      'crawl_%s_seconds_sum %f'%(name,timer['total'])]
+
+        return '\n'.join(lines)+'\n'
+
+    def write_snapshot(self,snapshotFile=None):
+        ''' Writes a snapshot to snapshotFile (default is the file given to the constructor). '''
+
+        if snapshotFile is None:
+            snapshotFile = self.snapshotFile
+        if snapshotFile is None:
+            return
+
+        snapshot = self.snapshot()
+
+        if snapshotFile.endswith('.prom'):
+            text = self.to_prometheus(snapshot)
+        else:
+            text = json.dumps(snapshot,indent=2,sort_keys=True)
+
+        # write to a temporary file first so readers never see a partial snapshot
+        tmpFile = snapshotFile+'.tmp'
+        with open(tmpFile,'w') as f:
+            f.write(text)
+        os.rename(tmpFile,snapshotFile)
+
+        self.lastSnapshot = time.time()
+
+    def maybe_write_snapshot(self):
+        ''' Writes a snapshot if at least snapshotInterval seconds have passed since the last one. '''
+
+        if self.snapshotFile is not None and \
+           time.time()-self.lastSnapshot >= self.snapshotInterval:
+            self.write_snapshot()
+
+    def summary(self):
+        ''' Returns a human-readable summary of all metrics. '''
+
+        snapshot = self.snapshot()
+
+        lines = ['--- Crawl summary ---',\
+                 'Elapsed: %.1f s, %.2f pages/sec'%(snapshot['elapsed'],snapshot['pages_per_sec'])]
+
+        if snapshot['timers']:
+            lines.append('%-12s %8s %10s %10s %10s'%('stage','count','total (s)','mean (ms)','max (ms)'))
+            for name,timer in sorted(snapshot['timers'].items()):
+                lines.append('%-12s %8d %10.2f %10.1f %10.1f'%\
+                             (name,timer['count'],timer['total'],1000*timer['mean'],1000*timer['max']))
+
+        for name,value in sorted(snapshot['counters'].items()+snapshot['gauges'].items()):
+            lines.append('%-20s %s'%(name,value))
+
+        return '\n'.join(lines)
@@ -0,0 +1,275 @@
+import time,traceback,argparse,multiprocessing
+import numpy as np
+import pandas as pd
+import sklearn.metrics as skmet
+import sklearn.model_selection as skms
+import fmprocess,classifier
+
+
+# hyperparameter grids searched by default; random search samples from the
+# same grids
+DEFAULT_GRIDS = {'logistic':{'C':[0.01,0.1,1.,10.]},\
+                 'randomforest':{'n_estimators':[50,200],\
+                                 'max_depth':[None,5,10],\
+                                 'min_samples_leaf':[1,5],\
+                                 'random_state':[0]}}
+
+SCORES = ['accuracy','log_loss','roc_auc']
+
+
+def make_folds(y,nFolds=5,nRepeats=1,seed=0):
+    '''
+    Splits the fights into stratified cross-validation folds. The folds are
+    computed once and shared by every model and hyperparameter setting, so
+    all candidates are scored on exactly the same splits.
+
+    Parameters
+    ----------
+    y : np.array
+    	Outcomes obtained from fmprocess.build_features.
+
+    nFolds : int (optional)
+    	Number of folds. Default is 5.
+
+    nRepeats : int (optional)
+    	Number of times k-fold cross-validation is repeated with a different
+    	shuffle. Default is 1.
+
+    seed : int (optional)
+    	Random seed of the shuffles. Default is 0.
+
+    Returns
+    -------
+    folds : list
+    	List of (trainIndex, testIndex) tuples, nFolds*nRepeats in total.
+
+    '''
+
+    splitter = skms.RepeatedStratifiedKFold(n_splits=nFolds,n_repeats=nRepeats,random_state=seed)
+
+    return list(splitter.split(np.zeros(len(y)),y))
+
+
+def search_candidates(models=None,search='grid',nIter=10,seed=0):
+    '''
+    Lists the (classifierType, params) candidates to evaluate.
+
+    Parameters
+    ----------
+    models : dict (optional)
+    	Hyperparameter grids keyed by classifier type (see
+    	classifier.make_estimator). Default is DEFAULT_GRIDS.
+
+    search : str (optional)
+    	'grid' evaluates every combination in the grids; 'random' samples nIter
+    	combinations per classifier type. Default is 'grid'.
+
+    nIter : int (optional)
+    	Number of samples per classifier type for random search. Default is 10.
+
+    seed : int (optional)
+    	Random seed for random search. Default is 0.
+
+    Returns
+    -------
+    candidates : list
+    	List of (classifierType, params) tuples.
+
+    '''
+
+    if models is None:
+        models = DEFAULT_GRIDS
+
+    candidates = []
+    for classifierType,grid in sorted(models.items()):
+        if search == 'grid':
+            paramsList = skms.ParameterGrid(grid)
+        elif search == 'random':
+            # sampling without replacement fails if the grid has fewer than nIter points
+            nSamples = min(nIter,len(skms.ParameterGrid(grid)))
+            paramsList = skms.ParameterSampler(grid,nSamples,random_state=seed)
+        else:
+            raise ValueError("search must be 'grid' or 'random'.")
+
+        candidates += [(classifierType,params) for params in paramsList]
+
+    return candidates
+
+
+# data shared with the worker processes; set once per process by init_worker
+# so that the feature matrix and folds are not sent with every task
+_X = None
+_y = None
+_folds = None
+
+def init_worker(X,y,folds):
+    ''' Pool initializer; stores the features and folds in the worker process. '''
+
+    global _X,_y,_folds
+    _X,_y,_folds = X,y,folds
+
+
+def fit_fold(classifierType,params,foldIndex,X,y,folds):
+    '''
+    Fits one candidate on the training part of a fold and scores it on the
+    test part. The features are normalised with the mean and standard
+    deviation of the training part only, so that no information about the
+    test fights leaks into the model.
+
+    Returns
+    -------
+    result : dict
+    	Contains the scores in SCORES and the fit time in seconds.
+
+    '''
+
+    trainIndex,testIndex = folds[foldIndex]
+
+    XTrain,XTest = X[trainIndex],X[testIndex]
+    yTrain,yTest = y[trainIndex],y[testIndex]
+
+    meanNorm = XTrain.mean(0)
+    sdNorm = XTrain.std(0)
+    sdNorm[sdNorm == 0] = 1.
+
+    t0 = time.time()
+    myClassifier = classifier.make_estimator(classifierType,**params)
+    myClassifier.fit((XTrain-meanNorm)/sdNorm,yTrain)
+    fitTime = time.time()-t0
+
+    p = myClassifier.predict_proba((XTest-meanNorm)/sdNorm)[:,1]
+
+    return {'accuracy':skmet.accuracy_score(yTest,p > 0.5),\
+            'log_loss':skmet.log_loss(yTest,p,labels=[0.,1.]),\
+            'roc_auc':skmet.roc_auc_score(yTest,p),\
+            'fit_time':fitTime}
+
+
+def fit_fold_task(task):
+    '''
+    Wrapper around fit_fold for the process pool. Returns the task and its
+    result, or None as the result if fitting failed.
+    '''
+
+    classifierType,params,foldIndex = task
+
+    try:
+        return task,fit_fold(classifierType,params,foldIndex,_X,_y,_folds)
+    except Exception:
+        # an exception in a pool process would never reach the caller
+        print 'Failed to fit %s %s on fold %d:'%(classifierType,params,foldIndex)
+        traceback.print_exc()
+        return task,None
+
+
+def run_search(X,y,models=None,nFolds=5,nRepeats=1,nJobs=None,search='grid',nIter=10,seed=0):
+    '''
+    Cross-validates every candidate model on the same folds, fitting the
+    (candidate, fold) pairs in parallel in a process pool.
+
+    Parameters
+    ----------
+    X : pd.DataFrame or np.array
+    	Feature matrix obtained from fmprocess.build_features.
+
+    y : np.array
+    	Outcomes obtained from fmprocess.build_features.
+
+    models, search, nIter : (optional)
+    	Candidates to evaluate; see search_candidates.
+
+    nFolds, nRepeats, seed : int (optional)
+    	Cross-validation folds; see make_folds.
+
+    nJobs : int (optional)
+    	Number of worker processes. Default is None (one per CPU); 1 runs
+    	everything in this process.
+
+    Returns
+    -------
+    results : pd.DataFrame
+    	One row per candidate with the mean and standard deviation of each
+    	score over the folds, the mean fit time and the number of failed
+    	folds, sorted by mean accuracy.
+
+    '''
+
+    X = np.asarray(X,dtype=float)
+    y = np.asarray(y,dtype=float)
+
+    folds = make_folds(y,nFolds,nRepeats,seed)
+    candidates = search_candidates(models,search,nIter,seed)
+
+    tasks = [(classifierType,params,foldIndex) for classifierType,params in candidates \
+             for foldIndex in range(len(folds))]
+
+    print 'Evaluating %d candidates on %d folds (%d fits)'%(len(candidates),len(folds),len(tasks))
+
+    t0 = time.time()
+
+    if nJobs == 1:
+        init_worker(X,y,folds)
+        taskResults = map(fit_fold_task,tasks)
+    else:
+        pool = multiprocessing.Pool(nJobs,init_worker,(X,y,folds))
+        try:
+            taskResults = pool.map(fit_fold_task,tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    print 'Finished in %.1f s'%(time.time()-t0)
+
+    foldResults = {}
+    for (classifierType,params,foldIndex),result in taskResults:
+        key = (classifierType,repr(sorted(params.items())))
+        foldResults.setdefault(key,[]).append(result)
+
+    rows = []
+    for classifierType,params in candidates:
+        results = foldResults[(classifierType,repr(sorted(params.items())))]
+        succeeded = [result for result in results if result is not None]
+
+        row = {'model':classifierType,\
+               'params':', '.join(['%s=%s'%item for item in sorted(params.items())]),\
+               'failed':len(results)-len(succeeded)}
+
+        for score in SCORES+['fit_time']:
+            values = [result[score] for result in succeeded]
+            row[score] = np.mean(values) if values else np.nan
+            if score != 'fit_time':
+                row[score+'_sd'] = np.std(values) if values else np.nan
+
+        rows.append(row)
+
+    columns = ['model','params']+[s for score in SCORES for s in [score,score+'_sd']]+['fit_time','failed']
+
+    results = pd.DataFrame(rows,columns=columns)
+
+    return results.sort_values('accuracy',ascending=False).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Cross-validated hyperparameter search.')
+    parser.add_argument('--db',default='fighterdb.sqlite',help='database file')
+    parser.add_argument('--folds',type=int,default=5,help='number of folds')
+    parser.add_argument('--repeats',type=int,default=1,help='number of times cross-validation is repeated')
+    parser.add_argument('--jobs',type=int,default=None,help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--search',choices=['grid','random'],default='grid',help='grid or random search')
+    parser.add_argument('--iter',type=int,default=10,help='samples per model for random search')
+    parser.add_argument('--seed',type=int,default=0,help='random seed')
+    parser.add_argument('--ratings',action='store_true',help='add Elo ratings to the features')
+    parser.add_argument('--asof',action='store_true',help='use point-in-time career features')
+    args = parser.parse_args()
+
+    print 'Building features'
+    fighters = fmprocess.get_fighters(args.db)
+    X,y = fmprocess.build_features(fighters,args.db,useRatings=args.ratings,asOf=args.asof)
+
+    results = run_search(X,y,nFolds=args.folds,nRepeats=args.repeats,nJobs=args.jobs,\
+                         search=args.search,nIter=args.iter,seed=args.seed)
+
+    pd.set_option('display.width',200)
+    pd.set_option('display.max_colwidth',80)
+    print results.to_string(float_format=lambda x: '%.3f'%x)
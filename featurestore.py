@@ -0,0 +1,243 @@
+import os,json,sqlite3,threading
+import numpy as np
+import fmprocess
+
+# the dtype of fmprocess.fighter_stats_array, so that features read from the
+# store are identical to the ones the classifier was trained on
+STORE_DTYPE = 'float64'
+
+
+class FeatureStore(object):
+    '''
+    Compiled, read-only store of numeric fighter features.
+
+    The features from fmprocess.fighters_to_frame are saved as a float64
+    matrix (one row per fighter, columns given by fmprocess.feature_list)
+    in storedir, together with a JSON index (storedir/index.json) mapping
+    fighter names and ids to rows. The matrix is memory-mapped when loaded, so
+    opening the store is nearly free and processes using the same store
+    share its pages. The store is regenerated whenever the database
+    fingerprint (see fmprocess.db_fingerprint) changes.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    storedir : str (optional)
+    	Directory holding the store. Default is 'featurestore'.
+
+    rebuild : bool (optional)
+    	Whether to regenerate the store if it is missing or out of date.
+    	If False, an out-of-date store is loaded as is. Default is True.
+
+    '''
+
+    def __init__(self,dbfile='fighterdb.sqlite',storedir='featurestore',rebuild=True):
+        self.dbfile = dbfile
+        self.storedir = storedir
+        self.indexFile = os.path.join(storedir,'index.json')
+
+        index = self._read_index()
+        if rebuild and (index is None or \
+                        index['fingerprint'] != fmprocess.db_fingerprint(dbfile) or \
+                        index['columns'] != fmprocess.feature_list or \
+                        index.get('dtype') != STORE_DTYPE):
+            build_store(dbfile,storedir)
+            index = self._read_index()
+
+        if index is None:
+            raise IOError('No feature store in %s'%storedir)
+
+        self.fingerprint = index['fingerprint']
+        self.columns = index['columns']
+        self.names = index['names']
+        self.ids = index['ids']
+        self.rowOfName = {name:row for row,name in enumerate(self.names)}
+        self.rowOfId = {fighterId:row for row,fighterId in enumerate(self.ids)}
+
+        self.stats = np.load(os.path.join(storedir,index['matrix']),mmap_mode='r')
+
+    def _read_index(self):
+        if not os.path.exists(self.indexFile):
+            return None
+
+        with open(self.indexFile) as f:
+            index = json.load(f)
+
+        if not os.path.exists(os.path.join(self.storedir,index['matrix'])):
+            return None
+
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self,name):
+        return name in self.rowOfName
+
+    def rows(self,names):
+        '''
+        Returns the rows of the given fighters.
+
+        Parameters
+        ----------
+        names : list
+        	Fighter names.
+
+        Returns
+        -------
+        rows : np.array
+        	Row indices into self.stats; -1 for fighters not in the store.
+
+        '''
+
+        return np.array([self.rowOfName.get(name,-1) for name in names],dtype=int)
+
+    def get(self,name):
+        ''' Returns the features of a fighter as a dict (NaN where unknown). '''
+
+        row = self.stats[self.rowOfName[name]]
+
+        return {column:float(row[i]) for i,column in enumerate(self.columns)}
+
+    def build_matchups(self,names1,names2):
+        '''
+        Builds the feature matrix for a batch of fights; see
+        fmprocess.build_matchups.
+
+        Parameters
+        ----------
+        names1 : list
+        	Names of the first fighter in each fight.
+
+        names2 : list
+        	Names of the second fighter in each fight.
+
+        Returns
+        -------
+        X : np.array
+        	Array of shape (nFights, len(fmprocess.tagged_features)).
+
+        '''
+
+        ids1 = self.rows(names1)
+        ids2 = self.rows(names2)
+
+        missing = [name for name,row in zip(list(names1)+list(names2),\
+                                            list(ids1)+list(ids2)) if row < 0]
+        if len(missing) > 0:
+            raise KeyError('Fighters not in feature store: %s'%', '.join(sorted(set(missing))))
+
+        return fmprocess.build_matchups(ids1,ids2,self.stats)
+
+
+def build_store(dbfile='fighterdb.sqlite',storedir='featurestore'):
+    '''
+    Compiles the feature store for dbfile into storedir.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    storedir : str (optional)
+    	Directory to write the store to. Created if it does not exist.
+    	Default is 'featurestore'.
+
+    Returns
+    -------
+    nFighters : int
+    	Number of fighters in the store.
+
+    '''
+
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+
+    # take the fingerprint first, so that a write during the build makes
+    # the store out of date rather than silently stale
+    fingerprint = fmprocess.db_fingerprint(dbfile)
+
+    conn = sqlite3.connect(dbfile)
+    cur = conn.cursor()
+    cur.execute('SELECT name,id FROM Fighters')
+    idOfName = dict(cur.fetchall())
+    conn.close()
+
+    names,stats = fmprocess.fighter_stats_array(fmprocess.get_fighters(dbfile))
+
+    matrixName = 'features-%s.npy'%fingerprint[:12]
+
+    index = {'fingerprint':fingerprint,\
+             'matrix':matrixName,\
+             'dbfile':os.path.abspath(dbfile),\
+             'columns':fmprocess.feature_list,\
+             'dtype':STORE_DTYPE,\
+             'names':names,\
+             'ids':[idOfName[name] for name in names]}
+
+    # write to temporary files first, and the index last, so that readers
+    # never see a partial store; each version of the matrix gets its own file,
+    # so processes which have the old one mapped can keep using it
+    # (the temporary names are unique to this process and thread, so that
+    # concurrent builds cannot rename each other's partial files)
+    tmpSuffix = '.%d.%d.tmp'%(os.getpid(),threading.current_thread().ident)
+
+    matrixFile = os.path.join(storedir,matrixName)
+    with open(matrixFile+tmpSuffix,'wb') as f:
+        np.save(f,np.ascontiguousarray(stats,dtype=STORE_DTYPE))
+    os.rename(matrixFile+tmpSuffix,matrixFile)
+
+    indexFile = os.path.join(storedir,'index.json')
+    with open(indexFile+tmpSuffix,'w') as f:
+        json.dump(index,f)
+    os.rename(indexFile+tmpSuffix,indexFile)
+
+    remove_old_matrices(storedir,matrixFile)
+
+    return len(names)
+
+
+def remove_old_matrices(storedir,matrixFile):
+    '''
+    Removes the matrices in storedir which are older than matrixFile (the one
+    just published). A concurrent build may have published its index after
+    ours, so the matrix referenced by the current index is always kept, and
+    only matrices older than both of them are removed.
+    '''
+
+    keep = [matrixFile]
+    try:
+        with open(os.path.join(storedir,'index.json')) as f:
+            keep.append(os.path.join(storedir,json.load(f)['matrix']))
+    except (IOError,ValueError,KeyError):
+        pass
+
+    mtimes = []
+    for f in keep:
+        try:
+            mtimes.append(os.path.getmtime(f))
+        except OSError:
+            pass
+
+    if len(mtimes) == 0:
+        return
+    cutoff = min(mtimes)
+
+    for f in os.listdir(storedir):
+        fname = os.path.join(storedir,f)
+        if not (f.startswith('features-') and f.endswith('.npy')) or fname in keep:
+            continue
+
+        try:
+            if os.path.getmtime(fname) < cutoff:
+                os.remove(fname)
+        except OSError:
+            pass # removed by a concurrent build
+
+
+def load_store(dbfile='fighterdb.sqlite',storedir='featurestore'):
+    ''' Convenience function; returns an up-to-date FeatureStore for dbfile. '''
+
+    return FeatureStore(dbfile,storedir)
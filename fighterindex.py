@@ -0,0 +1,194 @@
+import sqlite3,unicodedata,re,difflib,os
+import fightmetric as fm
+
+
+# well-known names which have nothing in common with the fighter's name
+# on Fightmetric; more can be added with FighterIndex.add_alias
+ALIASES = {'Jacare Souza':'Ronaldo Souza',
+           'Cowboy Cerrone':'Donald Cerrone',
+           'Shogun Rua':'Mauricio Rua',
+           'Minotauro Nogueira':'Antonio Rodrigo Nogueira',
+           'Cyborg Justino':'Cristiane Justino'}
+
+PUNCTUATION_RE = re.compile(r"[.'`\"]")
+SEPARATOR_RE = re.compile(r'[^a-z0-9]+')
+
+
+def normalise_name(name):
+    '''
+    Normalises a fighter name for matching: accents are removed, the name is
+    lower-cased and punctuation and white space are dropped. Dropping the
+    white space also matches names where the crawler put the space in the
+    wrong place (e.g. 'Rafaeldos Anjos').
+
+    Parameters
+    ----------
+    name : str
+    	Fighter name.
+
+    Returns
+    -------
+    key : str
+    	Normalised name, e.g. 'tjdillashaw' for 'T.J. Dillashaw'.
+
+    '''
+
+    if type(name) == str:
+        name = name.decode('utf-8','ignore')
+
+    name = unicodedata.normalize('NFKD',name)
+    name = u''.join([c for c in name if not unicodedata.combining(c)])
+    name = name.encode('ascii','ignore').lower()
+
+    name = PUNCTUATION_RE.sub('',name)
+
+    return SEPARATOR_RE.sub('',name)
+
+
+def strip_url(url):
+    ''' Returns a fighter URL in the form stored by the crawler (fightmetric.com/fighter-details/...). '''
+
+    for prefix in ['http://','https://','www.']:
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+
+    return url
+
+
+class FighterIndex(object):
+    '''
+    Index from fighter names to profile URLs, built from the Fighters and
+    FighterURLs tables. Names are matched exactly first, then after
+    normalisation (see normalise_name) and aliases, and finally with fuzzy
+    matching.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    cutoff : float (optional)
+    	Minimum similarity (between 0 and 1) for a fuzzy match. Default is 0.85.
+
+    '''
+
+    def __init__(self,dbfile='fighterdb.sqlite',cutoff=0.85):
+        self.cutoff = cutoff
+        self.urls = {}
+        self.keys = {}
+
+        if os.path.exists(dbfile):
+            conn = sqlite3.connect(dbfile)
+            cur = conn.cursor()
+
+            cur.execute('''SELECT Fighters.name, COALESCE(FighterURLs.url,Fighters.url)
+            		FROM Fighters LEFT JOIN FighterURLs
+            		ON FighterURLs.fighter_id = Fighters.id''')
+
+            for name,url in cur.fetchall():
+                self.add(name.encode('utf-8'),url)
+
+            conn.close()
+
+        for alias,name in ALIASES.items():
+            self.add_alias(alias,name)
+
+    def add(self,name,url):
+        ''' Adds a fighter to the index. '''
+
+        self.urls[name] = url
+        self.keys.setdefault(normalise_name(name),name)
+
+    def add_alias(self,alias,name):
+        ''' Makes alias resolve to name, if name is in the index. '''
+
+        if name in self.urls:
+            self.keys.setdefault(normalise_name(alias),name)
+
+    def lookup(self,name,fuzzy=True):
+        '''
+        Finds a fighter in the index.
+
+        Parameters
+        ----------
+        name : str
+        	Fighter name, alias or nickname.
+
+        fuzzy : bool (optional)
+        	Whether to fall back to fuzzy matching. Default is True.
+
+        Returns
+        -------
+        name : str or None
+        	Name of the fighter as stored in the database, or None if there
+        	is no match.
+
+        '''
+
+        if name in self.urls:
+            return name
+
+        key = normalise_name(name)
+        if key in self.keys:
+            return self.keys[key]
+
+        if fuzzy:
+            matches = difflib.get_close_matches(key,self.keys.keys(),n=1,cutoff=self.cutoff)
+            if len(matches) > 0:
+                return self.keys[matches[0]]
+
+        return None
+
+    def get_url(self,name,useSearch=False):
+        '''
+        Returns the profile URL for a fighter.
+
+        Parameters
+        ----------
+        name : str
+        	Fighter name.
+
+        useSearch : bool (optional)
+        	If True, fighters which are not in the index are looked up with a
+        	search engine (fm.get_url). Default is False.
+
+        Returns
+        -------
+        url : str or None
+        	URL in the form stored by the crawler, or None if not found.
+
+        '''
+
+        match = self.lookup(name)
+        if match is not None:
+            return self.urls[match]
+
+        if useSearch:
+            url = fm.get_url(name)
+            if url != 'NaN':
+                return strip_url(url)
+
+        return None
+
+
+_indexCache = {}
+
+def get_index(dbfile='fighterdb.sqlite'):
+    '''
+    Returns a FighterIndex for dbfile, reusing the previous one as long as the
+    database file has not been modified since it was built.
+    '''
+
+    # in WAL mode recent writes only touch the -wal file
+    mtime = tuple([os.path.getmtime(f) for f in [dbfile,dbfile+'-wal'] if os.path.exists(f)])
+
+    if dbfile not in _indexCache or _indexCache[dbfile][0] != mtime:
+        _indexCache[dbfile] = (mtime,FighterIndex(dbfile))
+
+    return _indexCache[dbfile][1]
+
+
+def get_url(name,dbfile='fighterdb.sqlite',useSearch=True):
+    ''' Convenience function; see FighterIndex.get_url. '''
+
+    return get_index(dbfile).get_url(name,useSearch)
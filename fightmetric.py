@@ -1,4 +1,8 @@
-import urllib2,re,google
+import urllib2,re,google,httplib,urlparse,zlib,socket,threading,Queue,time
+
+# seconds to wait before the first retry of a failed request; doubled for
+# every further retry
+RETRY_BACKOFF = 0.5
 
 def get_url(name):
     '''
@@ -33,32 +37,312 @@ def get_url(name):
     return 'NaN'
 
     
-def get_page(url):
+class Session(object):
+    '''
+    A HTTP session which keeps a pool of persistent (keep-alive) connections
+    for each host, so that consecutive requests avoid a new DNS lookup and
+    TCP handshake. A single session is meant to be shared by a whole crawl,
+    and is safe to use from several threads.
+
+    Parameters
+    ----------
+    timeout : float (optional)
+    	Socket timeout in seconds. Default is 2.
+
+    gzip : bool (optional)
+    	Whether to ask for gzip transfer encoding. Default is True.
+
+    poolSize : int (optional)
+    	Maximum number of idle connections kept open per host. Default is 4.
+
+    chunkSize : int (optional)
+    	Number of bytes read from the socket at a time. Default is 16384.
+
+    '''
+
+    def __init__(self,timeout=2,gzip=True,poolSize=4,chunkSize=16384):
+        self.timeout = timeout
+        self.gzip = gzip
+        self.poolSize = poolSize
+        self.chunkSize = chunkSize
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _get_pool(self,host):
+        with self.lock:
+            if host not in self.pools:
+                self.pools[host] = Queue.LifoQueue(maxsize=self.poolSize)
+            return self.pools[host]
+
+    def _get_connection(self,host):
+        try:
+            return self._get_pool(host).get_nowait()
+        except Queue.Empty:
+            return httplib.HTTPConnection(host,timeout=self.timeout)
+
+    def _release_connection(self,host,conn):
+        try:
+            self._get_pool(host).put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def open(self,url,headers=None,limiter=None):
+        '''
+        Sends a GET request for url.
+
+        Parameters
+        ----------
+        url : str
+        	Full URL (including http://).
+
+        headers : dict (optional)
+        	Extra request headers.
+
+        limiter : object (optional)
+        	Rate limiter with a wait(url) method (e.g.
+        	fmcrawler_sql.HostRateLimiter), consulted before every request
+        	sent, including the retry on a fresh connection.
+
+        Returns
+        -------
+        status : int
+        	HTTP status code.
+
+        responseHeaders : dict
+        	Response headers (with lower-case names).
+
+        lines : generator
+        	Streams the (decompressed) body line by line as it is downloaded.
+        	The connection goes back to the pool once this is exhausted.
+
+        '''
+
+        parts = urlparse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+
+        requestHeaders = {'Connection':'keep-alive'}
+        if self.gzip:
+            requestHeaders['Accept-Encoding'] = 'gzip'
+        if headers is not None:
+            requestHeaders.update(headers)
+
+        # a pooled connection may have been closed by the server in the
+        # meantime, in which case we retry once on a fresh connection
+        for k in range(2):
+            if limiter is not None:
+                limiter.wait(url)
+
+            conn = self._get_connection(host)
+            try:
+                conn.request('GET',path,headers=requestHeaders)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException,socket.error) as e:
+                conn.close()
+                if k == 1:
+                    raise IOError(e)
+
+        responseHeaders = dict(response.getheaders())
+
+        return response.status,responseHeaders,self._iter_lines(host,conn,response)
+
+    def _iter_lines(self,host,conn,response):
+        if response.getheader('content-encoding','') == 'gzip':
+            decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+        else:
+            decoder = None
+
+        finished = False
+        buf = ''
+        try:
+            while True:
+                try:
+                    chunk = response.read(self.chunkSize)
+                except (httplib.HTTPException,socket.error) as e:
+                    raise IOError(e)
+
+                if not chunk:
+                    break
+
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+
+                lines = (buf+chunk).split('\n')
+                buf = lines.pop()
+                for line in lines:
+                    yield line+'\n'
+
+            if decoder is not None:
+                buf += decoder.flush()
+            if buf:
+                yield buf
+
+            finished = True
+
+        finally:
+            if finished and not response.will_close:
+                self._release_connection(host,conn)
+            else:
+                conn.close()
+
+    def get(self,url,headers=None,maxRedirects=5,limiter=None):
+        '''
+        Convenience function; like open, but follows redirects and reads
+        the whole body into a list of lines. The limiter (see open) is
+        consulted for every redirect as well.
+        '''
+
+        for k in range(maxRedirects+1):
+            status,responseHeaders,lines = self.open(url,headers,limiter)
+            lines = list(lines)
+
+            if status in (301,302,303,307) and 'location' in responseHeaders:
+                url = urlparse.urljoin(url,responseHeaders['location'])
+            else:
+                break
+
+        return status,responseHeaders,lines
+
+
+# shared by every call to get_page which does not pass its own session
+default_session = Session()
+
+
+def normalise_url(url):
+    ''' Turns a (possibly partial) fighter URL into a full http:// URL. '''
+
     if 'fightmetric' not in url:
         url = 'http://fightmetric.com/'+url
 
     if 'http://' not in url:
         url = 'http://'+url
 
+    return url
+
+
+def get_page(url,session=None,cache=None,offline=False,metrics=None,limiter=None):
+    '''
+    Fetches a Fightmetric page.
+
+    Parameters
+    ----------
+    url : str
+    	URL of the page, with or without http:// and the host name.
+
+    session : Session (optional)
+    	Session used for the request. Default is a module-level shared session.
+
+    cache : pagecache.PageCache (optional)
+    	On-disk page cache. If given, cached pages are revalidated with a
+    	conditional request, and fresh pages are added to the cache.
+
+    offline : bool (optional)
+    	If True, only the cache is consulted and no request is ever sent;
+    	pages which are not cached (or all pages, without a cache) are
+    	returned as ['Empty page'].
+
+    metrics : crawlstats.CrawlMetrics (optional)
+    	If given, retries, cache revalidations and failures are counted, as
+    	well as the bytes downloaded (bytes_fetched) and the bytes served
+    	from the cache after a revalidation (bytes_cached).
+
+    limiter : object (optional)
+    	Rate limiter with a wait(url) method (e.g. fmcrawler_sql.HostRateLimiter),
+    	consulted before every HTTP request, including retries and redirects.
+    	Retries after a failed request also back off exponentially (see
+    	RETRY_BACKOFF).
+
+    Returns
+    -------
+    page : list
+    	The lines of the page, or ['Empty page'] if it could not be fetched.
+
+    '''
+
+    if session is None:
+        session = default_session
+
+    url = normalise_url(url)
+
+    # offline, nothing is fetched; without a cache there is nothing to return
+    if offline:
+        cachedPage = cache.load(url) if cache is not None else None
+        if cachedPage is None:
+            return ['Empty page']
+        return cachedPage
+
+    headers = {}
+    entry = None
+    if cache is not None:
+        entry = cache.lookup(url)
+
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['lastmodified']:
+                headers['If-Modified-Since'] = entry['lastmodified']
+
     n_attempts = 3
 
     page = ['Empty page']
     
+    failures = 0
     for k in range(n_attempts):
+        if k > 0 and metrics is not None:
+            metrics.incr('fetch_retries')
+
+        # don't hammer a server which is already failing
+        if failures > 0:
+            time.sleep(RETRY_BACKOFF*2**(failures-1))
+
         try:
-            url_generator = urllib2.urlopen(url,timeout=2)
-            page = url_generator.readlines()
-            break
+            status,responseHeaders,lines = session.get(url,headers,limiter=limiter)
         except IOError:
-            if k == n_attempts: return ['Empty page']
+            failures += 1
+            continue
+
+        if status == 304 and entry is not None:
+            cachedPage = cache.load(url)
+            if cachedPage is not None:
+                cache.touch(url)
+                if metrics is not None:
+                    metrics.incr('not_modified')
+                    metrics.incr('bytes_cached',sum([len(line) for line in cachedPage]))
+                return cachedPage
+
+            # the cached object has gone missing; fetch unconditionally
+            headers = {}
+            continue
+
+        if status == 200:
+            page = lines
+            if metrics is not None:
+                metrics.incr('bytes_fetched',sum([len(line) for line in page]))
+            if cache is not None:
+                cache.store(url,page,responseHeaders)
+            break
 
+        failures += 1
+
+    if page == ['Empty page'] and metrics is not None:
+        metrics.incr('fetch_failures')
 
     return page
 
 
 def parse_page(page):
     '''
-    Parses a Fighter's profile page, obtains stats and a list of fights
+    Parses a Fighter's profile page, obtains stats and a list of fights.
+
+    This is a single-pass state machine: the stats block, the fight table
+    and the fighter links are all extracted in one scan over the lines.
+    The page may therefore also be a generator of lines, such as the one
+    returned by Session.open, in which case the page is parsed while it
+    downloads. The results are identical to those of parse_stats,
+    parse_fights and get_fighter_urls.
 
     Parameters
     ----------
@@ -75,26 +359,107 @@ def parse_page(page):
 
     '''
 
-    fighter_stats = parse_stats(page)
-    fights = parse_fights(page)
+    # stats block
+    fighter_stats = {}
+    missingMetrics = list(STAT_METRICS)
+    pendingStats = {} # line number -> metrics whose value is on that line
+
+    # fight table; see parse_fights
+    fights = []
+    columns = []
+    ctr = 0
+    open_th = False
+    open_td = False
+    open_outcome = False
+
+    urls = set()
+
+    for lineNo,p in enumerate(page):
+
+        if pendingStats and lineNo in pendingStats:
+            val_str = p.strip()
+            for metric in pendingStats.pop(lineNo):
+                fighter_stats[metric] = convert_stat(metric,val_str)
+
+        if missingMetrics and ':' in p:
+            for metric in list(missingMetrics):
+                if metric+':' in p:
+                    pendingStats.setdefault(lineNo+STAT_OFFSETS[metric],[]).append(metric)
+                    missingMetrics.remove(metric)
+
+        if 'fighter-details' in p:
+            urls.update(find_url(p))
+
+        # the order of these checks follows parse_fights, since a single
+        # line can open and close table cells
+        if '<th' in p:
+            open_th = True
+            current_th = []
+
+        if open_th:
+            if '</th' in p:
+                open_th = False
+                columns.append(strip_html(' '.join(current_th)).strip())
+            else:
+                current_th.append(p)
+
+        if 'win<i' in p:
+            current_fight = {'outcome':'win'}
+            open_outcome = True
+
+        if 'loss<i' in p:
+            current_fight = {'outcome':'loss'}
+            open_outcome = True
+
+        if not open_outcome:
+            continue
+
+        if '<td' in p:
+            ctr += 1
+            current_td = []
+            open_td = True
+
+        if open_td:
+            if '</td' in p:
+                open_td = False
+                current_col = columns[ctr]
+                current_val = strip_html(' '.join(current_td)).strip()
+                current_fight[current_col] = convert_fight_value(current_col,current_val)
+            else:
+                current_td.append(p)
+
+        if '</tr>' in p and ctr == len(columns)-1:
+            split_fighter_names(current_fight)
+
+            fights.append(current_fight)
+            open_outcome = False
+            ctr = 0
+
+    if missingMetrics or pendingStats:
+        raise IndexError('Stats block not found on page.')
 
     fighter_stats['Fights'] = fights
-    try:
-        if len(fights) == 0:        
-            name = 'Unknown fighter'
-        else:
-            name = fights[0]['Fighter'][0]
-            
-    except IndexError:
-        import pdb; pdb.set_trace()
-        
-    fighter_stats['Name'] = name
 
-    urls = get_fighter_urls(page)
+    if len(fights) == 0:        
+        fighter_stats['Name'] = 'Unknown fighter'
+    else:
+        fighter_stats['Name'] = fights[0]['Fighter'][0]
 
     return fighter_stats,urls
 
 
+# stats shown on the profile page, and how many lines below the
+# label the value is found
+STAT_METRICS = ['Height', 'Weight','Reach', 'STANCE', 'DOB','SLpM',\
+                'Str. Acc.','SApM','Str. Def','TD Avg.','TD Acc.',\
+                'TD Def.', 'Sub. Avg.']
+
+STAT_OFFSETS = {metric:(3 if metric in ['DOB','SLpM'] else 2) for metric in STAT_METRICS}
+
+HTML_TAG_RE = re.compile(r'<.*?>')
+FIGHTER_URL_RE = re.compile('fightmetric.com/fighter-details/.*"')
+NAME_BOUNDARY_RE = re.compile('[a-zA-Z][A-Z0-9]')
+
 
 def parse_stats(page):
     '''
@@ -111,44 +476,38 @@ def parse_stats(page):
     	dict of statistics for fighter (see Fightmetric.com for explanation)
 
     '''
-    metrics = ['Height', 'Weight','Reach', 'STANCE', 'DOB','SLpM',\
-               'Str. Acc.','SApM','Str. Def','TD Avg.','TD Acc.',\
-               'TD Def.', 'Sub. Avg.']
-
     fighter_stats = {}
-    for metric in metrics:
-        if metric == 'DOB' or metric == 'SLpM':
-            k =3
-        else:
-            k =2
+    for metric in STAT_METRICS:
+        k = STAT_OFFSETS[metric]
 
         raw_val = [page[i+k] for i,p in enumerate(page) if metric+':' in p][0]
         
-        val_str = raw_val.strip()
-
-        if '%' in val_str:
-            val = percent_to_prop(val_str)
+        fighter_stats[metric] = convert_stat(metric,raw_val.strip())
         
-        elif metric == 'Height':
-            val = ft_to_cm(val_str)
+    return fighter_stats
 
-        elif metric == 'Weight':
-            val = lbs_to_kg(val_str)
-            
-        elif metric == 'Reach':
-            val = in_to_cm(val_str)
+def convert_stat(metric,val_str):
+    ''' Converts the text of a profile stat into its value (see parse_stats). '''
 
+    if '%' in val_str:
+        val = percent_to_prop(val_str)
 
-            
-        elif metric != 'DOB' and metric != 'STANCE':
-            val = float(val_str)
+    elif metric == 'Height':
+        val = ft_to_cm(val_str)
 
-        else:
-             val = val_str   
+    elif metric == 'Weight':
+        val = lbs_to_kg(val_str)
 
-        fighter_stats[metric] = val
-        
-    return fighter_stats
+    elif metric == 'Reach':
+        val = in_to_cm(val_str)
+
+    elif metric != 'DOB' and metric != 'STANCE':
+        val = float(val_str)
+
+    else:
+        val = val_str
+
+    return val
 
 def parse_fights(page):
     '''
@@ -210,28 +569,8 @@ def parse_fights(page):
 
             current_col = columns[ctr]
             current_val = strip_html(current_td).strip()
-            current_val = current_val.replace('\n','')
-
-            if current_col not in ['Method','Round','Time']:                
-                mid_idx = int(len(current_val)/2.)
-                prop1 = current_val[0:mid_idx].replace(' ','')
-                prop2 = current_val[mid_idx:].replace(' ','')                
-                if current_col not in ['W/L','Fighter','Event']:
-                    prop1 = float(prop1)
-                    prop2 = float(prop2)
-
-                props = [prop1,prop2]
-                current_val = props
-            else:
-                current_val = current_val.replace(' ','')
-
-                if current_col == 'Time':
-                    current_val = mins_to_sec(current_val)
-                    
-                if current_col == 'Round':
-                    current_val = float(current_val)
                         
-            current_fight[current_col] = current_val
+            current_fight[current_col] = convert_fight_value(current_col,current_val)
             
 
         if open_td and open_outcome:
@@ -240,11 +579,7 @@ def parse_fights(page):
             
         # this signals the end of the current row
         if '</tr>' in p and ctr == len(columns)-1:
-            for i,name_cat in enumerate(current_fight['Fighter']):
-                myre = re.findall('[a-zA-Z][A-Z0-9]',name_cat)
-        
-                name = name_cat.replace(myre[0],myre[0][0]+' '+myre[0][1])
-                current_fight['Fighter'][i] = name
+            split_fighter_names(current_fight)
 
             fights.append(current_fight)
             open_outcome = False
@@ -252,6 +587,56 @@ def parse_fights(page):
                 
     return fights
 
+def convert_fight_value(current_col,current_val):
+    '''
+    Converts the text of a cell in the fight table into its value. Cells
+    holding one value per fighter are split in half and returned as a list.
+
+    Parameters
+    ----------
+    current_col : str
+    	Column name from the table header (e.g. 'Str' or 'Time').
+
+    current_val : str
+    	Text of the cell with the html stripped.
+
+    Returns
+    -------
+    current_val : str, float or list
+
+    '''
+
+    current_val = current_val.replace('\n','')
+
+    if current_col not in ['Method','Round','Time']:                
+        mid_idx = int(len(current_val)/2.)
+        prop1 = current_val[0:mid_idx].replace(' ','')
+        prop2 = current_val[mid_idx:].replace(' ','')                
+        if current_col not in ['W/L','Fighter','Event']:
+            prop1 = float(prop1)
+            prop2 = float(prop2)
+
+        current_val = [prop1,prop2]
+    else:
+        current_val = current_val.replace(' ','')
+
+        if current_col == 'Time':
+            current_val = mins_to_sec(current_val)
+            
+        if current_col == 'Round':
+            current_val = float(current_val)
+
+    return current_val
+
+def split_fighter_names(fight):
+    ''' Puts back the space between first and last names (removed when the cell was split). '''
+
+    for i,name_cat in enumerate(fight['Fighter']):
+        myre = NAME_BOUNDARY_RE.findall(name_cat)
+
+        name = name_cat.replace(myre[0],myre[0][0]+' '+myre[0][1])
+        fight['Fighter'][i] = name
+
 def get_fighter_urls(page):
     '''
     Returns all fighter URLs on a fighter's profile page
@@ -287,15 +672,13 @@ def find_url(S):
     urls_fx : list
     	list of URLs contained in S   
     '''
-    urlregex='fightmetric.com/fighter-details/.*"'    
-    urls = re.findall(urlregex,S)
+    urls = FIGHTER_URL_RE.findall(S)
     urls_fx = [k[0:-1] for k in urls]
 
     return urls_fx
 
 def strip_html(data):
-    p = re.compile(r'<.*?>')
-    return p.sub('',data)
+    return HTML_TAG_RE.sub('',data)
 
 ######################################
 ### These are conversion functions ###
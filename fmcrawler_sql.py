@@ -1,8 +1,46 @@
-import urllib2,google,re,os,random,sqlite3
+import urllib2,google,re,os,random,sqlite3,time,threading,Queue,urlparse,hashlib,json,collections
+import multiprocessing,traceback
 import fightmetric as fm
+import pagecache,fighterindex,crawlstats
 import numpy as np
 
 
+# keys of the stats dict built by write_page_to_database, and the
+# corresponding columns of the Fighters table
+FIGHTER_KEYS = ['Name','url','Height','Weight','Reach','STANCE','DOB','SLpM',\
+                'Str. Acc.','SApM','Str. Def','TD Avg.','TD Acc.','TD Def.',\
+                'Sub. Avg.','wins','losses','cumtime']
+
+# a fight is seen from both fighters' pages, in opposite orientations; the
+# first one written is kept (tables such as Ratings rely on it), and later
+# writes only update the other columns, swapped into the stored orientation
+FIGHTS_INSERT_SQL = '''INSERT OR IGNORE INTO Fights (id, fighter1, fighter2,
+            event, method, pass1, pass2, round, str1, str2, sub1, sub2,
+    	    td1, td2, time, winner, date) VALUES ( ?, ?, ?, ?, ?, ?, 
+            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )'''
+
+FIGHTS_UPDATE_SQL = '''UPDATE Fights SET event = ?, method = ?, round = ?,
+            time = ?, winner = ?, date = ?,
+            pass1 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            pass2 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            str1 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            str2 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            sub1 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            sub2 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            td1 = CASE WHEN fighter1 = ? THEN ? ELSE ? END,
+            td2 = CASE WHEN fighter1 = ? THEN ? ELSE ? END
+            WHERE id = ?'''
+
+# event dates as they appear in the Event column once spaces are removed,
+# e.g. 'Mar.05,2016'
+EVENT_DATE_RE = re.compile(r'([A-Z][a-z]{2})\.?(\d{1,2}),(\d{4})')
+
+MONTHS = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+
+# SQLite allows at most 999 parameters per statement
+SQL_CHUNK_SIZE = 500
+
+
 def init_db(dbfile='fighterdb.sqlite'):
     '''
     Function to initialise the database. This should be called the first
@@ -25,6 +63,9 @@ def init_db(dbfile='fighterdb.sqlite'):
     DROP TABLE IF EXISTS Fighters;
     DROP TABLE IF EXISTS Fights;
     DROP TABLE IF EXISTS FighterURLs;
+    DROP TABLE IF EXISTS Frontier;
+    DROP TABLE IF EXISTS Ratings;
+    DROP TABLE IF EXISTS FighterRatings;
 
     CREATE TABLE Fighters (
     id		INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
@@ -52,7 +93,10 @@ def init_db(dbfile='fighterdb.sqlite'):
     id		INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
     url		TEXT UNIQUE, 
     fighter_id  INTEGER UNIQUE,
-    processed   INTEGER
+    processed   INTEGER,
+    fetched	REAL,
+    changed	REAL,
+    fingerprint	TEXT
     );
 
     CREATE TABLE Fights (
@@ -71,80 +115,831 @@ def init_db(dbfile='fighterdb.sqlite'):
     td1 	REAL,
     td2		REAL,
     time	REAL,
-    winner 	TEXT
+    winner 	TEXT,
+    date	TEXT
+    );
+
+    CREATE TABLE Frontier (
+    url		TEXT NOT NULL PRIMARY KEY UNIQUE,
+    depth	INTEGER,
+    discovered	REAL,
+    priority	REAL,
+    processed	INTEGER
     )
     ''')
 
     conn.commit()
 
     conn.close()
+
+
+def configure_connection(conn):
+    '''
+    Tunes a database connection for bulk writes from the crawler: WAL
+    journaling (so readers are not blocked while the crawler writes),
+    synchronous=NORMAL (safe in WAL mode, and avoids an fsync per commit),
+    and a larger page cache.
+
+    Parameters
+    ----------
+    conn : sqlite3 connection
+
+    Returns
+    -------
+    Nothing.
+    '''
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -65536') # in KiB, i.e. 64 MB
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+
+def ensure_schema(cur):
+    '''
+    Adds any tables and columns introduced since the database was created, so
+    that databases built by older versions of the crawler can be updated in place.
+
+    Parameters
+    ----------
+    cur : sqlite3 cursor
+    	Cursor pointing to the database.
+
+    Returns
+    -------
+    Nothing.
+    '''
+
+    newColumns = {'FighterURLs':[('fetched','REAL'),('changed','REAL'),\
+                                 ('fingerprint','TEXT')],\
+                  'Fights':[('date','TEXT')]}
+
+    for tableName in newColumns:
+        cur.execute('PRAGMA table_info( %s )'%tableName)
+        existing = set([t[1] for t in cur.fetchall()])
+
+        for columnName,columnType in newColumns[tableName]:
+            if columnName not in existing:
+                cur.execute('ALTER TABLE %s ADD COLUMN %s %s'%(tableName,columnName,columnType))
+
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Frontier (
+    url		TEXT NOT NULL PRIMARY KEY UNIQUE,
+    depth	INTEGER,
+    discovered	REAL,
+    priority	REAL,
+    processed	INTEGER
+    )
+    ''')
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket rate limiter. Tokens are added at a constant
+    rate up to a maximum of burst tokens; each request consumes one token.
+
+    Parameters
+    ----------
+    rate : float (optional)
+    	Number of tokens (i.e. requests) added per second. Default is 1.0.
+
+    burst : int (optional)
+    	Maximum number of tokens that can accumulate. Default is 1, meaning
+    	that requests are never sent in bursts.
+
+    '''
+
+    def __init__(self,rate=1.0,burst=1):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Blocks until a token is available and consumes it. '''
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,self.tokens+(now-self.stamp)*self.rate)
+                self.stamp = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                waitTime = (1-self.tokens)/self.rate
+
+            time.sleep(waitTime)
+
+
+class HostRateLimiter(object):
+    '''
+    Keeps one TokenBucket per host, so that the politeness budget applies
+    to each host separately regardless of how many workers are fetching.
+
+    Parameters
+    ----------
+    rate : float (optional)
+    	Requests per second allowed for each host. Default is 1.0, which
+    	matches the average pause of the sequential crawler.
+
+    burst : int (optional)
+    	Maximum burst size for each host. Default is 1.
+
+    '''
+
+    def __init__(self,rate=1.0,burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self,url):
+        ''' Blocks until a request to the host of url is allowed. '''
+
+        host = get_host(url)
+
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate,self.burst)
+            bucket = self.buckets[host]
+
+        bucket.acquire()
+
+
+def get_host(url):
+    ''' Returns the host name for a (possibly scheme-less) fighter URL. '''
+
+    if '://' not in url:
+        url = 'http://'+url
+
+    return urlparse.urlparse(url).netloc
+
+
+def fetch_pages(fighterURLs,nWorkers=4,limiter=None,session=None,cache=None,metrics=None):
+    '''
+    Fetches fighter pages using a pool of worker threads, keeping up to
+    nWorkers requests in flight. Pages are yielded in the order they arrive,
+    so the caller (a single thread) can write them to the database.
+
+    Parameters
+    ----------
+    fighterURLs : list
+    	List of URLs to fetch.
+
+    nWorkers : int (optional)
+    	Number of concurrent fetch threads. Default is 4.
+
+    limiter : HostRateLimiter (optional)
+    	Rate limiter consulted before every request. Default is no limit.
+
+    session : fm.Session (optional)
+    	HTTP session shared by all workers. Default is fm.default_session.
+
+    cache : pagecache.PageCache (optional)
+    	Page cache used to revalidate and store fetched pages.
+
+    metrics : crawlstats.CrawlMetrics (optional)
+    	Records fetch latency, bytes and retries.
+
+    Returns
+    -------
+    A generator of (fighterURL, page) tuples.
+
+    '''
+
+    if metrics is None:
+        metrics = crawlstats.CrawlMetrics()
+
+    urlQueue = Queue.Queue()
+    for fighterURL in fighterURLs:
+        urlQueue.put(fighterURL)
+
+    # bounded so that fetchers cannot run far ahead of the writer
+    pageQueue = Queue.Queue(maxsize=2*nWorkers)
+
+    def worker():
+        try:
+            while True:
+                try:
+                    fighterURL = urlQueue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                try:
+                    # the limiter is consulted for every request get_page
+                    # sends, including retries and redirects
+                    with metrics.timer('fetch'):
+                        fighterPage = fm.get_page(fighterURL,session,cache,metrics=metrics,limiter=limiter)
+                except Exception:
+                    # e.g. a corrupt gzip body or a failed cache write; the
+                    # page is treated like one which could not be fetched
+                    print 'Could not fetch %s:\n%s'%(fighterURL,traceback.format_exc())
+                    metrics.incr('fetch_errors')
+                    fighterPage = ['Empty page']
+
+                metrics.incr('pages_fetched')
+
+                pageQueue.put((fighterURL,fighterPage))
+
+        finally:
+            # the consumer waits for one sentinel per worker
+            pageQueue.put(None)
+
+    for k in range(nWorkers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    nDone = 0
+    while nDone < nWorkers:
+        item = pageQueue.get()
+        if item is None:
+            nDone += 1
+            continue
+
+        yield item
+
+
+
+def parse_pages(pages,pool=None,maxInFlight=16,metrics=None):
+    '''
+    Parse stage of the crawl pipeline. Takes fetched pages and parses them,
+    either in this thread or in a process pool, so that CPU-bound parsing
+    runs on other cores while pages are being fetched and written.
+
+    At most maxInFlight pages are being parsed or waiting to be picked up
+    at any time. Since pages are only taken from the fetch stage when there
+    is room, a slow writer or slow parsers hold back the fetchers instead of
+    letting pages pile up in memory.
+
+    Parameters
+    ----------
+    pages : iterable
+    	(fighterURL, page) tuples, e.g. from fetch_pages.
+
+    pool : multiprocessing.Pool (optional)
+    	Pool of parser processes. Default is to parse in this thread.
+
+    maxInFlight : int (optional)
+    	Maximum number of pages handed to the pool but not yet returned.
+    	Default is 16.
+
+    metrics : crawlstats.CrawlMetrics (optional)
+    	Records the parse time of each page.
+
+    Returns
+    -------
+    A generator of (fighterURL, record) tuples, where record is as returned by
+    parse_fighter_page (None if the page was empty or could not be parsed).
+
+    '''
+
+    if metrics is None:
+        metrics = crawlstats.CrawlMetrics()
+
+    def collect(item):
+        fighterURL,record,parseTime = item
+        metrics.observe('parse',parseTime)
+        return fighterURL,record
+
+    if pool is None:
+        for fighterURL,fighterPage in pages:
+            yield collect(parse_page_task(fighterURL,fighterPage))
+        return
+
+    results = Queue.Queue()
+    nInFlight = 0
+
+    for fighterURL,fighterPage in pages:
+
+        while nInFlight >= maxInFlight:
+            yield collect(results.get())
+            nInFlight -= 1
+
+        pool.apply_async(parse_page_task,(fighterURL,fighterPage),callback=results.put)
+        nInFlight += 1
+
+        while True:
+            try:
+                item = results.get_nowait()
+            except Queue.Empty:
+                break
+
+            yield collect(item)
+            nInFlight -= 1
+
+    while nInFlight > 0:
+        yield collect(results.get())
+        nInFlight -= 1
+
+
+def parse_page_task(fighterURL,fighterPage):
+    '''
+    Runs parse_fighter_page (possibly in a pool process) and times it.
+    Errors are printed and turned into a None record, since an exception
+    in a pool process would never reach the caller.
+
+    Returns
+    -------
+    (fighterURL, record, parseTime) tuple.
+    '''
+
+    t0 = time.time()
+    try:
+        record = parse_fighter_page(fighterURL,fighterPage)
+    except Exception:
+        print 'Could not parse %s:\n%s'%(fighterURL,traceback.format_exc())
+        record = None
+
+    return fighterURL,record,time.time()-t0
+
+
+class Frontier(object):
+    '''
+    Persistent crawl frontier, stored in the Frontier table. Each URL is
+    stored once, however many seeds or pages it is discovered from, along
+    with its distance (depth) from the nearest seed, the time it was first
+    discovered and a priority (the number of pages linking to it). Since
+    URLs are only marked as processed in the same transaction as their
+    page is written, a crawl which is killed can resume where it stopped.
+
+    Parameters
+    ----------
+    cur : sqlite3 cursor
+    	Cursor pointing to the database.
+
+    '''
+
+    def __init__(self,cur):
+        self.cur = cur
+        self.depths = {} # depth of URLs handed out by next_urls
+
+    def add(self,fighterURLs,depth):
+        '''
+        Adds URLs at the given depth. URLs which are already in the frontier
+        get their priority bumped, and their depth lowered if it is smaller.
+        '''
+
+        now = time.time()
+        fighterURLs = list(fighterURLs)
+
+        self.cur.executemany('''INSERT OR IGNORE INTO Frontier (url,depth,discovered,priority,processed)
+        		VALUES ( ?, ?, ?, 0, 0 )''',[(url,depth,now) for url in fighterURLs])
+        self.cur.executemany('''UPDATE Frontier SET priority = priority + 1,
+        		depth = MIN(depth,?) WHERE url = ?''',[(depth,url) for url in fighterURLs])
+
+    def next_urls(self,K,limit=500):
+        '''
+        Returns up to limit unprocessed URLs at depth < K: shallowest first,
+        then highest priority, then oldest.
+        '''
+
+        self.cur.execute('''SELECT url,depth FROM Frontier WHERE processed = 0 AND depth < ?
+        		ORDER BY depth, priority DESC, discovered LIMIT ?''',(K,limit))
+
+        rows = self.cur.fetchall()
+        self.depths.update(rows)
+
+        return [k[0] for k in rows]
+
+    def expand(self,records):
+        ''' Marks the pages of records as processed and adds the URLs found on them. '''
+
+        for fighterURL,stats,urls,fights,fingerprint in records:
+            depth = self.depths.pop(fighterURL,None)
+            if depth is None:
+                continue
+
+            self.add(urls,depth+1)
+            self.cur.execute('UPDATE Frontier SET processed = 1 WHERE url = ?',(fighterURL,))
+
+    def size(self):
+        ''' Returns the number of unprocessed URLs in the frontier. '''
+
+        self.cur.execute('SELECT COUNT(*) FROM Frontier WHERE processed = 0')
+
+        return self.cur.fetchone()[0]
+
+    def mark_failed(self,fighterURL):
+        ''' Marks a URL whose page could not be fetched, so the crawl moves on. '''
+
+        self.depths.pop(fighterURL,None)
+        self.cur.execute('UPDATE Frontier SET processed = -1 WHERE url = ?',(fighterURL,))
+
+    def reset(self,failedOnly=True):
+        ''' Marks failed (or, if failedOnly is False, all) URLs as unprocessed again. '''
+
+        if failedOnly:
+            self.cur.execute('UPDATE Frontier SET processed = 0 WHERE processed = -1')
+        else:
+            self.cur.execute('UPDATE Frontier SET processed = 0')
+
+
+class BatchWriter(object):
+    '''
+    Collects parsed fighter pages and writes them to the database in
+    batches, committing once per batch rather than once per page.
+
+    Parameters
+    ----------
+    conn : sqlite3 connection
+    	Connection to the database. Only the thread owning the BatchWriter
+    	should write to it.
+
+    batchSize : int (optional)
+    	Number of pages written per transaction. Default is 100.
+
+    incremental : bool (optional)
+    	Passed on to write_records_to_database. Default is False.
+
+    frontier : Frontier (optional)
+    	If given, the frontier is expanded with each batch, in the same
+    	transaction as the batch is written.
+
+    metrics : crawlstats.CrawlMetrics (optional)
+    	Records the time taken by each batch write.
+
+    '''
+
+    def __init__(self,conn,batchSize=100,incremental=False,frontier=None,metrics=None):
+        if metrics is None:
+            metrics = crawlstats.CrawlMetrics()
+
+        self.metrics = metrics
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.batchSize = batchSize
+        self.incremental = incremental
+        self.frontier = frontier
+        self.records = []
+        self.writtenURLs = []
+
+    def add(self,record):
+        ''' Adds a record from parse_fighter_page; None records are ignored. '''
+
+        if record is None:
+            return
+
+        self.records.append(record)
+
+        if len(self.records) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        ''' Writes and commits all pending records. '''
+
+        if len(self.records) == 0:
+            return
+
+        with self.metrics.timer('db_write'):
+            written = write_records_to_database(self.records,self.cur,self.incremental)
+
+            if self.frontier is not None:
+                self.frontier.expand(self.records)
+
+            self.conn.commit()
+
+        self.metrics.incr('pages_written',sum(written))
+
+        self.writtenURLs.extend([r[0] for r,w in zip(self.records,written) if w])
+        self.records = []
+
     
-def crawl(initFighter='Mark Hunt',dbfile='fighterdb.sqlite',K=2):
+def crawl(initFighters=['Mark Hunt'],dbfile='fighterdb.sqlite',K=2,nWorkers=4,rate=1.0,\
+          cachedir='pagecache',batchSize=100,nParsers=0,metricsFile=None):
     '''
-     Basic Fightmetric crawler; will get URLs for all fighter profiles on Fightmetric
+    Basic Fightmetric crawler; will get URLs for all fighter profiles on Fightmetric.
+
+    The crawl runs as a pipeline: fetch threads (fetch_pages) feed a parse
+    stage (parse_pages), which feeds a single database writer (BatchWriter).
+
+    The crawl frontier is kept in the database (see Frontier), so a single
+    crawl can start from many seeds without fetching any page twice, and
+    calling crawl again after it was interrupted resumes where it stopped.
     
     Parameters
     ----------
-    initFighter : str (optional)
-        Name of the fighter to start the crawl. The URL will be fetched from Google.
-    	Default is either a random fighter from existing data, or Mark Hunt if no
-    	data exists.
+    initFighters : list (optional)
+        Names of the fighters to start the crawl from (a single name is also
+        accepted). The URLs are looked up in the database (see fighterindex.py),
+        and only fetched from Google for unknown fighters. Default is Mark Hunt.
     dbfile : str (optional)
 	Name of the database file
     K : int (optional)
     	Degrees of separation to include. Default is K=2, meaning that the crawler
-    	will parse initFighter (1), and the fighters on initFighter's page (2).
+    	will parse initFighters (1), and the fighters on their pages (2).
+    nWorkers : int (optional)
+    	Number of pages to keep in flight at once. Default is 4.
+    rate : float (optional)
+    	Maximum number of requests per second sent to each host. Default is 1.0.
+    cachedir : str (optional)
+    	Directory of the on-disk page cache (see pagecache.py). Pass None to
+    	disable the cache. Default is 'pagecache'.
+    batchSize : int (optional)
+    	Number of pages written per database transaction. Default is 100.
+    nParsers : int (optional)
+    	Number of parser processes. Default is 0, meaning that pages are
+    	parsed in the writer thread.
+    metricsFile : str (optional)
+    	File to which crawl metrics are written periodically, as JSON or, if the
+    	name ends in .prom, in the Prometheus text format. A summary is printed
+    	at the end of the crawl either way. Default is None (no file).
 
     Returns
     -------
-    fighters : dict
-    	Each entry corresponds to a fighter (with the fighter's name as key).
-    	The dict contains fighter stats and all the fighter's fights
+    fighterURLs : list
+    	URLs which were discovered, but not fetched since they are K degrees
+    	of separation away from the seeds.
 
     '''
 
-    if dbfile not in os.listdir('./'):
+    if type(initFighters) == str: initFighters = [initFighters]
+
+    if not os.path.exists(dbfile):
         print "Database not found; initialising new database."
-        init_db()
+        init_db(dbfile)
         
 
 
     # init sqlite stuff
     conn = sqlite3.connect(dbfile,timeout=10)
+
+    configure_connection(conn)
     
     cur = conn.cursor()
 
+    ensure_schema(cur)
+
+    limiter = HostRateLimiter(rate)
+
+    # one keep-alive connection per worker
+    session = fm.Session(poolSize=nWorkers)
+
+    if cachedir is None:
+        cache = None
+    else:
+        cache = pagecache.PageCache(cachedir)
+
+    metrics = crawlstats.CrawlMetrics(metricsFile)
+
+    frontier = Frontier(cur)
+
+    # give pages which failed last time another go
+    frontier.reset()
+
     # Create the base of the tree
-    initFighterURL = fm.get_url(initFighter)[11:]
+    index = fighterindex.FighterIndex(dbfile)
 
-    write_page_to_database(initFighterURL,cur)
+    for initFighter in initFighters:
+        initFighterURL = index.get_url(initFighter,useSearch=True)
+
+        if initFighterURL is None:
+            print 'No URL found for %s; skipping.'%initFighter
+            continue
+
+        frontier.add([initFighterURL],0)
 
     conn.commit()
 
-    fighterURLs = get_url_list(cur)
-            
-    for k in range(K):
+    # pages are fetched concurrently, but only this thread writes to the db
+    writer = BatchWriter(conn,batchSize,frontier=frontier,metrics=metrics)
 
-        for fighterURL in fighterURLs:
+    fighterURLs = frontier.next_urls(K)
 
-            pauseInterval = np.random.rand() + 0.5
+    if nParsers > 0:
+        pool = multiprocessing.Pool(nParsers)
+    else:
+        pool = None
+
+    while len(fighterURLs) > 0:
 
-            # pause for some random time interval
-            os.system('sleep %.2f'%pauseInterval) 
+        metrics.gauge('frontier_size',frontier.size())
 
+        pages = fetch_pages(fighterURLs,nWorkers,limiter,session,cache,metrics)
+        
+        for fighterURL,record in parse_pages(pages,pool,4*nParsers,metrics):
 
             print 'Running fighter: %s'%fighterURL
-            
-            write_page_to_database(fighterURL,cur)
 
-            conn.commit()
+            if record is None:
+                frontier.mark_failed(fighterURL)
+            else:
+                writer.add(record)
 
-        fighterURLs = get_url_list(cur)
+            metrics.maybe_write_snapshot()
 
-        
+        writer.flush()
+        conn.commit()
+
+        fighterURLs = frontier.next_urls(K)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    cur.execute('SELECT url FROM Frontier WHERE processed = 0')
+    fighterURLs = [k[0] for k in cur.fetchall()]
+
+    metrics.gauge('frontier_size',len(fighterURLs))
+    metrics.write_snapshot()
+    print metrics.summary()
+
+    conn.close()
             
     return fighterURLs
 
+
+def update(dbfile='fighterdb.sqlite',nWorkers=4,rate=1.0,cachedir='pagecache',batchSize=100,\
+           nParsers=0,metricsFile=None,maxPages=None,changedWithin=None,includeUnprocessed=False,K=2):
+    '''
+    Incrementally refreshes an existing database. The pages of fighters already
+    in the database are re-fetched, but a fighter's Fighters and Fights rows
+    are only rewritten if the page fingerprint changed since the last fetch.
+    Fighters whose record changed most recently (i.e. active fighters) are
+    fetched first. URLs which were discovered but never fetched are left
+    alone unless includeUnprocessed is True, so that an update does not grow
+    the database by another ring of fighters every time it runs.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file.
+    nWorkers : int (optional)
+    	Number of pages to keep in flight at once. Default is 4.
+    rate : float (optional)
+    	Maximum number of requests per second sent to each host. Default is 1.0.
+    cachedir : str (optional)
+    	Directory of the on-disk page cache. Pass None to disable the cache.
+    batchSize : int (optional)
+    	Number of pages written per database transaction. Default is 100.
+    nParsers : int (optional)
+    	Number of parser processes. Default is 0 (parse in the writer thread).
+    metricsFile : str (optional)
+    	File to which crawl metrics are written periodically (see crawl).
+    maxPages : int (optional)
+    	Maximum number of pages to fetch, most recently changed first.
+    	Default is None (no limit).
+    changedWithin : float (optional)
+    	Only refresh fighters whose record changed in the last changedWithin
+    	days. Default is None (all fighters).
+    includeUnprocessed : bool (optional)
+    	If True, unprocessed URLs in the crawl frontier (see Frontier) at
+    	depth < K are fetched as well, after the refreshed pages and within
+    	maxPages. Default is False.
+    K : int (optional)
+    	Depth limit for unprocessed URLs, as in crawl. Default is 2.
+
+    Returns
+    -------
+    changedURLs : list
+    	URLs of the fighters whose records changed.
+
+    '''
+
+    conn = sqlite3.connect(dbfile,timeout=10)
+    configure_connection(conn)
+    cur = conn.cursor()
+
+    ensure_schema(cur)
+    conn.commit()
+
+    query = 'SELECT url FROM FighterURLs WHERE processed = 1'
+    params = []
+    if changedWithin is not None:
+        query += ' AND changed >= ?'
+        params.append(time.time()-86400*changedWithin)
+    query += ' ORDER BY changed IS NULL, changed DESC, fetched IS NOT NULL, fetched'
+    if maxPages is not None:
+        query += ' LIMIT ?'
+        params.append(maxPages)
+
+    cur.execute(query,params)
+    fighterURLs = [k[0] for k in cur.fetchall()]
+
+    # new fighters only come from the frontier, which enforces the depth limit
+    frontier = None
+    newURLs = set()
+    if includeUnprocessed:
+        frontier = Frontier(cur)
+        frontier.reset()
+
+        # a limit of -1 means no limit in SQLite
+        limit = -1 if maxPages is None else maxPages-len(fighterURLs)
+        if limit != 0:
+            refreshed = set(fighterURLs)
+            newURLs = [url for url in frontier.next_urls(K,limit) if url not in refreshed]
+            fighterURLs = fighterURLs+newURLs
+            newURLs = set(newURLs)
+
+    limiter = HostRateLimiter(rate)
+    session = fm.Session(poolSize=nWorkers)
+
+    if cachedir is None:
+        cache = None
+    else:
+        cache = pagecache.PageCache(cachedir)
+
+    if nParsers > 0:
+        pool = multiprocessing.Pool(nParsers)
+    else:
+        pool = None
+
+    metrics = crawlstats.CrawlMetrics(metricsFile)
+    writer = BatchWriter(conn,batchSize,incremental=True,frontier=frontier,metrics=metrics)
+
+    pages = fetch_pages(fighterURLs,nWorkers,limiter,session,cache,metrics)
+    for fighterURL,record in parse_pages(pages,pool,4*nParsers,metrics):
+
+        if record is None and fighterURL in newURLs:
+            frontier.mark_failed(fighterURL)
+
+        writer.add(record)
+
+        metrics.maybe_write_snapshot()
+
+    writer.flush()
+    conn.close()
+
+    metrics.write_snapshot()
+    print metrics.summary()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    changedURLs = writer.writtenURLs
+    for fighterURL in changedURLs:
+        print 'Updated fighter: %s'%fighterURL
+
+    print '%d of %d fighters changed.'%(len(changedURLs),len(fighterURLs))
+
+    return changedURLs
+
+
+def replay_cache(dbfile='fighterdb.sqlite',cachedir='pagecache'):
+    '''
+    Rebuilds the database from the on-disk page cache without touching the
+    network, e.g. after a fix to fm.parse_page or fm.parse_fights.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. It is re-initialised, so any existing data
+    	in it is dropped.
+
+    cachedir : str (optional)
+    	Directory of the page cache. Default is 'pagecache'.
+
+    Returns
+    -------
+    nPages : int
+    	Number of pages written to the database. Pages which cannot be parsed
+    	are skipped.
+
+    '''
+
+    cache = pagecache.PageCache(cachedir)
+
+    init_db(dbfile)
+
+    conn = sqlite3.connect(dbfile,timeout=10)
+    configure_connection(conn)
+
+    writer = BatchWriter(conn)
+
+    nPages = 0
+    nFailed = 0
+    for url in cache.urls():
+        fighterPage = cache.load(url)
+        if fighterPage is None:
+            continue
+
+        # store the URL in the same form as the crawler does
+        fighterURL = url.replace('http://www.','').replace('http://','')
+
+        print 'Replaying fighter: %s'%fighterURL
+
+        # the cache also holds pages which the crawl could not parse
+        fighterURL,record,parseTime = parse_page_task(fighterURL,fighterPage)
+        if record is None:
+            nFailed += 1
+            continue
+
+        writer.add(record)
+        nPages += 1
+
+    writer.flush()
+    conn.close()
+    cache.close()
+
+    if nFailed > 0:
+        print 'Skipped %d pages which could not be parsed'%nFailed
+
+    return nPages
+
     
 def get_url_list(cur):
     '''
@@ -190,11 +985,7 @@ def add_to_url_list(fighterURLs,processed,cur):
     
 
     '''
-    if processed:
-        sqlExpression = '''INSERT OR REPLACE INTO FighterURLs (url,processed)
-    		VALUES ( ?, ? )'''
-    else:
-        sqlExpression = '''INSERT OR IGNORE INTO FighterURLs (url,processed)
+    sqlExpression = '''INSERT OR IGNORE INTO FighterURLs (url,processed)
     		VALUES ( ?, ? )'''
 
     # convert to list if (presumably) a string is given
@@ -203,6 +994,11 @@ def add_to_url_list(fighterURLs,processed,cur):
     for fighterURL in fighterURLs:
         cur.execute(sqlExpression, (fighterURL, processed))
 
+        # update in place rather than INSERT OR REPLACE, which would drop
+        # the fighter_id and fetch bookkeeping for this URL
+        if processed:
+            cur.execute('UPDATE FighterURLs SET processed = 1 WHERE url = ?',(fighterURL,))
+
 
 
 
@@ -225,19 +1021,8 @@ def write_fights_to_database(fights,cur):
     '''
     
     for fight in fights:
-        sortedFighters = sorted(fight['Fighter'])
-        
-        bothFighters = sortedFighters[0]+sortedFighters[1]
-
-        fightId = hash(bothFighters+fight['Event'][0])
-    
-
-        if fight['outcome'] == 'win':
-            winner = fight['Fighter'][0]
-        elif fight['outcome'] == 'loss':
-            winner = fight['Fighter'][1]
-        else:
-            winner = 'Draw'
+        fightRow = fight_to_row(fight)
+        fightId = fightRow[0]
 
         # Do a quick check
         cur.execute('SELECT fighter1,fighter2 FROM Fights WHERE id == ?',(fightId,))
@@ -248,17 +1033,77 @@ def write_fights_to_database(fights,cur):
                     ' means overlapping ids.')
                  
 
-        cur.execute(\
-            '''INSERT OR IGNORE INTO Fights (id, fighter1, fighter2,
-            event, method, pass1, pass2, round, str1, str2, sub1, sub2,
-    	    td1, td2, time, winner) VALUES ( ?, ?, ?, ?, ?, ?, 
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )''',\
-            (fightId,fight['Fighter'][0], fight['Fighter'][1],\
-             fight['Event'][0], fight['Method'],\
-             fight['Pass'][0], fight['Pass'][1], fight['Round'],\
-             fight['Str'][0], fight['Str'][1], fight['Sub'][0],\
-             fight['Sub'][1], fight['Td'][0], fight['Td'][1],\
-             fight['Time'], winner) )
+        cur.execute(FIGHTS_INSERT_SQL,fightRow)
+        cur.execute(FIGHTS_UPDATE_SQL,fight_update_row(fightRow))
+
+
+def fight_to_row(fight):
+    '''
+    Converts a fight dict (from fm.parse_fights) into a row of the Fights table.
+
+    Parameters
+    ----------
+    fight : dict
+    	Details of a given fight.
+
+    Returns
+    -------
+    fightRow : tuple
+    	Values in the column order of FIGHTS_INSERT_SQL.
+
+    '''
+
+    sortedFighters = sorted(fight['Fighter'])
+        
+    bothFighters = sortedFighters[0]+sortedFighters[1]
+
+    fightId = hash(bothFighters+fight['Event'][0])
+
+    if fight['outcome'] == 'win':
+        winner = fight['Fighter'][0]
+    elif fight['outcome'] == 'loss':
+        winner = fight['Fighter'][1]
+    else:
+        winner = 'Draw'
+
+    return (fightId,fight['Fighter'][0], fight['Fighter'][1],\
+            fight['Event'][0], fight['Method'],\
+            fight['Pass'][0], fight['Pass'][1], fight['Round'],\
+            fight['Str'][0], fight['Str'][1], fight['Sub'][0],\
+            fight['Sub'][1], fight['Td'][0], fight['Td'][1],\
+            fight['Time'], winner, fight_date(fight))
+
+
+def fight_update_row(fightRow):
+    '''
+    Converts a row from fight_to_row into the parameters of FIGHTS_UPDATE_SQL,
+    which keeps the stored fighter1/fighter2 order: the per-fighter columns
+    are swapped if the row sees the fight from the other fighter's side.
+    '''
+
+    (fightId,fighter1,fighter2,event,method,pass1,pass2,rnd,\
+     str1,str2,sub1,sub2,td1,td2,fightTime,winner,date) = fightRow
+
+    params = [event,method,rnd,fightTime,winner,date]
+    for first,second in [(pass1,pass2),(str1,str2),(sub1,sub2),(td1,td2)]:
+        params += [fighter1,first,second,fighter1,second,first]
+
+    return tuple(params+[fightId])
+
+
+def fight_date(fight):
+    '''
+    Returns the date of a fight (from its Event column) as 'YYYY-MM-DD', or
+    None if it cannot be found. Dates in this form sort chronologically.
+    '''
+
+    match = EVENT_DATE_RE.search(''.join(fight['Event']))
+    if match is None or match.group(1) not in MONTHS:
+        return None
+
+    month,day,year = match.groups()
+
+    return '%s-%02d-%02d'%(year,MONTHS.index(month)+1,int(day))
 
 
 def write_fighter_to_database(stats,urls,cur):
@@ -281,25 +1126,18 @@ def write_fighter_to_database(stats,urls,cur):
 
     '''
     
-    key2Sql = {key:strip_key(key) for key in stats.keys()}
+    keys = tuple(stats.keys())
+    dataTuple = tuple([stats[key] for key in keys])
     
     fighterURL = stats['url']
-    
-    sqlExpression = 'INSERT OR REPLACE INTO Fighters ( '
-    
-    for i,k in enumerate(key2Sql):
-        if i == (len(key2Sql)-1):
-            delim = ''
-        else:
-            delim = ', '
-            
-        sqlExpression += key2Sql[k]+delim
 
-    sqlExpression += ') VALUES ( ' + '?, '*(len(key2Sql)-1) + '? )'
+    updateExpression,insertExpression = fighter_sql(keys)
 
-    dataTuple = tuple([stats[key] for key in key2Sql])
+    # update in place so that the fighter keeps its id
+    cur.execute(updateExpression,dataTuple+(stats['Name'],))
 
-    cur.execute(sqlExpression,dataTuple)
+    if cur.rowcount == 0:
+        cur.execute(insertExpression,dataTuple)
 
     cur.execute(''' SELECT id FROM Fighters WHERE name = ? ''', (stats['Name'],))
         
@@ -308,31 +1146,223 @@ def write_fighter_to_database(stats,urls,cur):
     cur.execute('''INSERT OR IGNORE INTO FighterURLs (url,fighter_id)
     		    VALUES ( ?, ? )''', (fighterURL, fighter_id))
 
+    cur.execute('''UPDATE OR IGNORE FighterURLs SET fighter_id = ?
+    		    WHERE url = ?''', (fighter_id, fighterURL))
+
     add_to_url_list(urls,0,cur)
     
     add_to_url_list([fighterURL],1,cur)
 
     
-            
-def write_page_to_database(fighterURL,cur):
-    ''' This is a convenient wrapper for write_fighter_to_database and
-    write_fights_to_database.
+
+_fighterSqlCache = {}
+
+def fighter_sql(keys):
+    '''
+    Returns the UPDATE and INSERT statements for a Fighters row with the given
+    stats keys. Statements are built once per set of keys and then reused,
+    which also lets sqlite3 reuse its prepared statements.
 
     Parameters
     ----------
-    fighterURL : str
-    	A valid Fightmetric.com URL for a fighter's profile page.
+    keys : tuple
+    	Keys of the stats dict, in the order their values are passed.
+
+    Returns
+    -------
+    updateExpression : str
+    	UPDATE statement; takes the values followed by the fighter's name.
+
+    insertExpression : str
+    	INSERT statement; takes the values.
+
+    '''
+
+    if keys not in _fighterSqlCache:
+        columns = [strip_key(key) for key in keys]
 
+        updateExpression = 'UPDATE Fighters SET ' + ', '.join([c+' = ?' for c in columns]) +\
+                           ' WHERE name = ?'
+
+        insertExpression = 'INSERT OR REPLACE INTO Fighters ( ' + ', '.join(columns) +\
+                           ' ) VALUES ( ' + '?, '*(len(columns)-1) + '? )'
+
+        _fighterSqlCache[keys] = (updateExpression,insertExpression)
+
+    return _fighterSqlCache[keys]
+
+
+def select_in(cur,sqlExpression,values):
+    '''
+    Runs a SELECT with an IN ( ... ) clause over an arbitrary number of values,
+    in chunks of SQL_CHUNK_SIZE.
+
+    Parameters
+    ----------
     cur : sqlite3 cursor
-	A cursor pointing to the database.
+
+    sqlExpression : str
+    	Query containing a single %s where the placeholders go, e.g.
+    	'SELECT id FROM Fights WHERE id IN ( %s )'.
+
+    values : list
+    	Values for the IN clause.
 
     Returns
     -------
-    Nothing
+    rows : list
+    	All rows returned by the chunked queries.
+
+    '''
+
+    values = list(values)
+    rows = []
+    for i in range(0,len(values),SQL_CHUNK_SIZE):
+        chunk = values[i:i+SQL_CHUNK_SIZE]
+        cur.execute(sqlExpression%', '.join(['?']*len(chunk)),chunk)
+        rows.extend(cur.fetchall())
+
+    return rows
+
+
+def write_records_to_database(records,cur,incremental=False):
+    '''
+    Batched equivalent of write_page_to_database for many parsed pages.
+    All lookups are done with one (chunked) query per table, and all
+    writes with executemany. The caller is responsible for committing,
+    so a whole batch goes into a single transaction.
+
+    Parameters
+    ----------
+    records : list
+    	Records returned by parse_fighter_page.
+
+    cur : sqlite3 cursor
+    	Cursor pointing to the database.
+
+    incremental : bool (optional)
+    	If True, pages whose fingerprint is unchanged are not rewritten.
+
+    Returns
+    -------
+    written : list
+    	For each record, whether its fighter and fights were written.
+
+    '''
+
+    now = time.time()
+
+    storedFingerprints = dict(select_in(cur,\
+        'SELECT url,fingerprint FROM FighterURLs WHERE url IN ( %s )',\
+        set([r[0] for r in records])))
+
+    written = []
+    toWrite = []
+    fetchedRows = []
+    changedRows = []
+    for record in records:
+        fighterURL,stats,urls,fights,fingerprint = record
+        changed = storedFingerprints.get(fighterURL) != fingerprint
+
+        if changed:
+            changedRows.append((now,now,fingerprint,fighterURL))
+        else:
+            fetchedRows.append((now,fighterURL))
+
+        if incremental and not changed:
+            written.append(False)
+            continue
+
+        written.append(True)
+        toWrite.append(record)
+
+    # Fighters; the last copy wins if a fighter appears twice in a batch
+    fighterRows = collections.OrderedDict()
+    for fighterURL,stats,urls,fights,fingerprint in toWrite:
+        fighterRows[stats['Name']] = tuple([stats[key] for key in FIGHTER_KEYS])
+
+    existing = set([k[0] for k in select_in(cur,\
+        'SELECT name FROM Fighters WHERE name IN ( %s )',fighterRows.keys())])
+
+    updateExpression,insertExpression = fighter_sql(tuple(FIGHTER_KEYS))
+
+    cur.executemany(updateExpression,\
+        [row+(name,) for name,row in fighterRows.items() if name in existing])
+    cur.executemany(insertExpression,\
+        [row for name,row in fighterRows.items() if name not in existing])
+
+    fighterIds = dict(select_in(cur,\
+        'SELECT name,id FROM Fighters WHERE name IN ( %s )',fighterRows.keys()))
+
+    # FighterURLs
+    ownRows = [(fighterIds[r[1]['Name']],r[0]) for r in toWrite]
+
+    cur.executemany('''INSERT OR IGNORE INTO FighterURLs (fighter_id,url)
+    		    VALUES ( ?, ? )''',ownRows)
+    cur.executemany('''UPDATE OR IGNORE FighterURLs SET fighter_id = ?
+    		    WHERE url = ?''',ownRows)
+
+    discovered = set()
+    for record in toWrite:
+        discovered.update(record[2])
+
+    cur.executemany('''INSERT OR IGNORE INTO FighterURLs (url,processed)
+    		    VALUES ( ?, 0 )''',[(url,) for url in discovered])
+    cur.executemany('UPDATE FighterURLs SET processed = 1 WHERE url = ?',\
+                    [(r[0],) for r in toWrite])
+
+    # Fights, with the overlapping id check done as a single lookup
+    fightRows = collections.OrderedDict()
+    for record in toWrite:
+        for fight in record[3]:
+            fightRow = fight_to_row(fight)
+            fightId = fightRow[0]
+
+            if fightId in fightRows and sorted(fightRows[fightId][1:3]) != sorted(fightRow[1:3]):
+                raise AssertionError('Error: Fighters and fight id should match. Probably'+\
+                    ' means overlapping ids.')
+
+            fightRows[fightId] = fightRow
+
+    matches = select_in(cur,\
+        'SELECT id,fighter1,fighter2 FROM Fights WHERE id IN ( %s )',fightRows.keys())
+
+    for match in matches:
+        if sorted(match[1:]) != sorted(fightRows[match[0]][1:3]):
+            raise AssertionError('Error: Fighters and fight id should match. Probably'+\
+                ' means overlapping ids.')
+
+    cur.executemany(FIGHTS_INSERT_SQL,fightRows.values())
+    cur.executemany(FIGHTS_UPDATE_SQL,[fight_update_row(row) for row in fightRows.values()])
+
+    # fetch bookkeeping
+    cur.executemany('''UPDATE FighterURLs SET fetched = ?, changed = ?, fingerprint = ?
+        		WHERE url = ?''',changedRows)
+    cur.executemany('UPDATE FighterURLs SET fetched = ? WHERE url = ?',fetchedRows)
 
+    return written
+
+
+def parse_fighter_page(fighterURL,fighterPage):
     '''
+    Parses a fighter's page and computes the aggregate stats stored in the
+    Fighters table.
+
+    Parameters
+    ----------
+    fighterURL : str
+    	URL of the fighter's profile page.
+
+    fighterPage : list
+    	The page, as returned by fm.get_page.
 
-    fighterPage = fm.get_page(fighterURL)
+    Returns
+    -------
+    record : tuple
+    	(fighterURL, stats, urls, fights, fingerprint), or None if the page
+    	is empty.
+
+    '''
 
     if fighterPage == ['Empty page']: return None
 
@@ -340,6 +1370,8 @@ def write_page_to_database(fighterURL,cur):
     
     fights = stats.pop('Fights')
 
+    fingerprint = record_fingerprint(stats,fights)
+
     stats['url'] = fighterURL
 
     stats['wins'] = compute_wins(fights)
@@ -348,11 +1380,78 @@ def write_page_to_database(fighterURL,cur):
 
     stats['cumtime'] = compute_cumtime(fights)
 
-    write_fighter_to_database(stats,urls,cur)
+    return (fighterURL,stats,urls,fights,fingerprint)
+
+            
+def write_page_to_database(fighterURL,cur,fighterPage=None,session=None,cache=None,\
+                           incremental=False):
+    ''' This is a convenient wrapper for parse_fighter_page and
+    write_records_to_database, for a single page.
+
+    Parameters
+    ----------
+    fighterURL : str
+    	A valid Fightmetric.com URL for a fighter's profile page.
+
+    cur : sqlite3 cursor
+	A cursor pointing to the database.
+
+    fighterPage : list (optional)
+    	The already fetched page for fighterURL. It is fetched if not given.
+
+    session : fm.Session (optional)
+    	HTTP session used if the page has to be fetched.
+
+    cache : pagecache.PageCache (optional)
+    	Page cache used if the page has to be fetched.
+
+    incremental : bool (optional)
+    	If True, the fighter and fights are only written if the page's
+    	fingerprint differs from the one stored for fighterURL.
+
+    Returns
+    -------
+    written : bool
+    	True if the fighter and fights were written to the database.
+
+    '''
+
+    if fighterPage is None:
+        fighterPage = fm.get_page(fighterURL,session,cache)
+
+    record = parse_fighter_page(fighterURL,fighterPage)
+
+    if record is None: return False
+
+    return write_records_to_database([record],cur,incremental)[0]
+
+
+def record_fingerprint(stats,fights):
+    '''
+    Computes a fingerprint of a parsed fighter page. This only depends on the
+    parsed stats and fights, so changes to unrelated markup on the page do
+    not count as a change to the fighter's record.
+
+    Parameters
+    ----------
+    stats : dict
+    	Fighter stats, as returned by fm.parse_page (without 'Fights').
+
+    fights : list
+    	The fighter's fights.
+
+    Returns
+    -------
+    fingerprint : str
+    	SHA1 hex digest.
+
+    '''
+
+    record = json.dumps([stats,fights],sort_keys=True)
+
+    return hashlib.sha1(record).hexdigest()
+
 
-    write_fights_to_database(fights,cur)
-    
-    
 def compute_wins(fights):
     y = np.sum([fight['outcome']=='win' for fight in fights])
     return y
@@ -397,7 +1496,5 @@ if __name__ == "__main__":
                      'Jon Jones','Alexander Gustafsson',\
                      'Mark Hunt','Stipe Miocic']
 
-    
-    for fighter in initFighters:
-        print 'Crawling using %s as root'%fighter
-        crawl(initFighter=fighter,K=4)
+
+    crawl(initFighters=initFighters,K=4)
@@ -1,12 +1,34 @@
 import pandas as pd
 import numpy as np
 import networkx as nx
-import pickle,copy,random,fmcrawler_sql,sqlite3
+import pickle,copy,random,fmcrawler_sql,sqlite3,os,hashlib,collections
+import ratings
 
 
-from scipy.sparse import csc_matrix
+from scipy.sparse import csc_matrix,csr_matrix,coo_matrix,diags
 
-def page_rank(G, s = .85, maxerr = .001):
+# fighter stats used as features, and the corresponding columns of the
+# feature matrix (first fighter, then second fighter)
+feature_list = ['height','reach','sapm','slpm','stance','stracc',\
+                'strdef','subavg','tdacc','tdavg','tddef',\
+                'weight','dob','wins','losses','cumtime']
+
+tagged_features = ['f1_'+f for f in feature_list]+['f2_'+f for f in feature_list]
+
+# bump whenever the meaning or encoding of any feature column changes, so
+# that saved classifiers (see classifier.save_classifier) can be rejected
+FEATURE_SCHEMA_VERSION = 1
+
+# optional career averages computed from the Fights table (see career_stats),
+# added after tagged_features
+career_features = ['fights','str_mean','td_mean','sub_mean','pass_mean']
+
+tagged_career_features = ['f1_'+f for f in career_features]+['f2_'+f for f in career_features]
+
+# optional Elo rating columns (see ratings.py), added last
+rating_features = ['f1_rating','f2_rating']
+
+def page_rank(G, s = .85, maxerr = .001, maxiter = 1000, r0 = None):
     """
     Computes the pagerank for each of the n states.
     Used in webpage ranking and text summarization using unweighted
@@ -15,44 +37,116 @@ def page_rank(G, s = .85, maxerr = .001):
     ----------
     G: matrix representing state transitions
        Gij can be a boolean or non negative real number representing the
-       transition weight from state i to j.
+       transition weight from state i to j. Can be dense or scipy.sparse.
     Kwargs
     ----------
     s: probability of following a transition. 1-s probability of teleporting
        to another state. Defaults to 0.85
     maxerr: if the sum of pageranks between iterations is bellow this we will
             have converged. Defaults to 0.001
+    maxiter: maximum number of iterations. Defaults to 1000
+    r0: initial pagerank, e.g. the result of a previous call on a slightly
+        different graph (warm start). Defaults to uniform
     
-    Attribution note: Not written by sh
+    Attribution note: Not written by sh (vectorized since)
     """
     n = G.shape[0]
 
-    # transform G into markov matrix M
-    M = csc_matrix(G,dtype=np.float)
+    M,sink = markov_matrix(G)
+
+    # Compute pagerank r until we converge; each iteration is one sparse
+    # matrix-vector product, with the rank of sink states spread evenly
+    # over all states
+    ro, r = np.zeros(n), np.ones(n)
+    if r0 is not None:
+        r = n*np.asarray(r0,dtype=np.float)/np.sum(r0)
+    nIter = 0
+    while np.sum(np.abs(r-ro)) > maxerr and nIter < maxiter:
+        ro = r
+        r = s*M.T.dot(ro) + (s*ro[sink].sum() + (1-s)*ro.sum())/float(n)
+        nIter += 1
+
+    # return normalized pagerank
+    return r/sum(r)
+
+
+def personalized_page_rank(G, seeds, s = .85, maxerr = 1e-6, maxiter = 1000):
+    '''
+    Computes personalized pageranks for many seed states at once. For each
+    seed, teleportation (and the rank of sink states) always goes back to
+    the seed, so the rank vector measures how close each state is to it.
+
+    Parameters
+    ----------
+    G : matrix
+    	Transition matrix, as for page_rank (dense or scipy.sparse).
+
+    seeds : list
+    	Integer indices of the seed states.
+
+    s : float (optional)
+    	Probability of following a transition. Default is 0.85.
+
+    maxerr : float (optional)
+    	Convergence tolerance on the L1 change of each rank vector.
+    	Default is 1e-6.
+
+    maxiter : int (optional)
+    	Maximum number of iterations. Default is 1000.
+
+    Returns
+    -------
+    R : np.array
+    	Array of shape (n, len(seeds)); column k is the rank vector of seeds[k]
+    	and sums to 1.
+
+    '''
+
+    n = G.shape[0]
+    seeds = np.asarray(seeds,dtype=int)
+    k = len(seeds)
+
+    M,sink = markov_matrix(G)
+
+    # one column per seed, so each iteration is a single sparse
+    # matrix-matrix product for the whole batch
+    E = np.zeros([n,k])
+    E[seeds,np.arange(k)] = 1.0
+
+    R = E.copy()
+    for nIter in xrange(maxiter):
+        Ro = R
+        R = s*M.T.dot(Ro) + E*(s*Ro[sink].sum(0) + (1-s)*Ro.sum(0))
+
+        if np.abs(R-Ro).sum(0).max() <= maxerr:
+            break
+
+    return R/R.sum(0)
+
+
+def markov_matrix(G):
+    '''
+    Row-normalises a transition matrix.
+
+    Returns
+    -------
+    M : scipy.sparse.csr_matrix
+    	Markov matrix; rows of sink states are all zero.
+
+    sink : np.array
+    	Boolean array which is True for sink states (no outgoing transitions).
+
+    '''
+
+    M = csr_matrix(G,dtype=np.float)
     rsums = np.array(M.sum(1))[:,0]
-    ri, ci = M.nonzero()
-    M.data /= rsums[ri]
 
     # bool array of sink states
     sink = rsums==0
 
-    # Compute pagerank r until we converge
-    ro, r = np.zeros(n), np.ones(n)
-    while np.sum(np.abs(r-ro)) > maxerr:
-        ro = r.copy()
-        # calculate each pagerank at a time
-        for i in xrange(0,n):
-            # inlinks of state i
-            Ii = np.array(M[:,i].todense())[:,0]
-            # account for sink states
-            Si = sink / float(n)
-            # account for teleportation to state i
-            Ti = np.ones(n) / float(n)
-
-            r[i] = ro.dot( Ii*s + Si*s + Ti*(1-s) )
+    M = csr_matrix(diags(1.0/np.where(sink,1.0,rsums)).dot(M))
 
-    # return normalized pagerank
-    return r/sum(r)
+    return M,sink
 
 
 def create_fight_matrix(fights):
@@ -60,6 +154,7 @@ def create_fight_matrix(fights):
     Creates a fight adjacency matrix, where each row/column corresponds 
     to a fighter. The winner is always the column fighter, such that
     entry fight_matrix[i,j]=1 means that fighter j won over fighter i.
+    For large numbers of fighters, use create_sparse_fight_matrix instead.
     
     Parameters
     ----------
@@ -73,45 +168,89 @@ def create_fight_matrix(fights):
     	     NxN matrix where N is the number of fighters. 
     '''
 
-    fighters = []
-    for fight in fights:
-        fighters.extend(fight['Fighters'])
-    
+    fighters,W = create_sparse_fight_matrix(fights)
 
-    fighters = np.unique(fighters)
+    fight_matrix = pd.DataFrame((W.toarray() > 0).astype(float),index=fighters,columns=fighters)
 
-    # init matrix as DataFrame
-    fight_matrix = pd.DataFrame(np.zeros([len(fighters),len(fighters)]),index=fighters,columns=fighters)
+    return fight_matrix
 
-    # iterate over all fights and fill in appropriate entry
-    for fight in fights:
-        fighter1=fight['Fighters'][0]
-        fighter2=fight['Fighters'][1]
-        
-        if fight['Result'] == fighter1:
-            col=fighter1
-            row=fighter2
-        elif fight['Result'] == fighter2:            
-            col=fighter2
-            row=fighter1
 
-        fight_matrix.loc[row,col] = 1.0
+def create_sparse_fight_matrix(fights=None,dbfile='fighterdb.sqlite'):
+    '''
+    Creates a sparse fight adjacency matrix, where entry W[i,j] is the number
+    of times fighter j won over fighter i (i.e. as in create_fight_matrix,
+    the winner is the column fighter). Fights without a winner are left out.
 
-    return fight_matrix
+    Parameters
+    ----------
+    fights : list (optional)
+    	Scraped fights, as for create_fight_matrix. If None (default), the
+    	fights are read from the Fights table.
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    fighters : np.array
+    	Sorted fighter names; fighters[i] is the fighter with id i.
+
+    W : scipy.sparse.csr_matrix
+    	NxN matrix of win counts, where N is the number of fighters.
 
-def create_fight_graph(fights):
+    '''
+
+    if fights is None:
+        conn = sqlite3.connect(dbfile)
+        fights = pd.read_sql_query('SELECT fighter1,fighter2,winner FROM Fights',conn)
+        conn.close()
+
+        fighter1 = fights.fighter1.values
+        fighter2 = fights.fighter2.values
+        winner = fights.winner.values
+    else:
+        fighter1 = np.array([fight['Fighters'][0] for fight in fights],dtype=object)
+        fighter2 = np.array([fight['Fighters'][1] for fight in fights],dtype=object)
+        winner = np.array([fight['Result'] for fight in fights],dtype=object)
+
+    fighters = np.unique(np.concatenate([fighter1,fighter2]))
+
+    ids1 = np.searchsorted(fighters,fighter1)
+    ids2 = np.searchsorted(fighters,fighter2)
+
+    won1 = winner == fighter1
+    won2 = winner == fighter2
+
+    loserIds = np.concatenate([ids2[won1],ids1[won2]])
+    winnerIds = np.concatenate([ids1[won1],ids2[won2]])
+
+    # duplicate entries are summed, giving the number of wins
+    W = coo_matrix((np.ones(len(loserIds)),(loserIds,winnerIds)),\
+                   shape=(len(fighters),len(fighters))).tocsr()
+
+    return fighters,W
+
+
+def create_fight_graph(fights=None,dbfile='fighterdb.sqlite'):
     '''
     Creates a NetworkX fight graph, where each node is a fighter and
     each directed edge corresponds to a result. A node pointing
     from node i to node j means that fighter j won over fighter i.
+    The edge weight is the number of such wins.
     
     Parameters
     ----------
-    fights : dict OR pd.DataFrame
+    fights : dict OR pd.DataFrame OR tuple (optional)
 	     Scraped fights dict through using fmcrawler. This will be
 	     saved in fighters.pickle.
     	     OR
 	     fight_matrix returned from calling create_fight_matrix.
+	     OR
+	     (fighters,W) returned from calling create_sparse_fight_matrix.
+	     If None (default), the graph is built from the Fights table.
+
+    dbfile : str (optional)
+    	     Name of the database file. Default is 'fighterdb.sqlite'.
     
     Returns
     -------
@@ -120,26 +259,27 @@ def create_fight_graph(fights):
     	     to the number of fighters and fighths, respectively.
     '''
 
-    # This lets you pass either a fights list or a fight_matrix
-    if type(fights) == list:
-        fight_matrix = create_fight_matrix(fights)
+    # This lets you pass either a fights list, a fight_matrix or a sparse matrix
+    if fights is None or type(fights) == list:
+        nodes,W = create_sparse_fight_matrix(fights,dbfile)
     elif type(fights) == pd.core.frame.DataFrame:
-        fight_matrix = fights
+        nodes,W = fights.columns,coo_matrix(fights.values == 1.0)
+    else:
+        nodes,W = fights
+
+    nodes = np.asarray(nodes,dtype=object)
+    W = coo_matrix(W)
     
     # init graph and add nodes
     G = nx.DiGraph()
-    nodes = fight_matrix.columns
     G.add_nodes_from(nodes)    
 
-    i,j = np.where(fight_matrix==1.0) # find indices for edges
-
-    edges = [(nodes[i[k]],nodes[j[k]]) for k in range(len(i))] #add edges
-    G.add_edges_from(edges)
+    G.add_weighted_edges_from(zip(nodes[W.row],nodes[W.col],W.data.astype(float)))
 
     return G
 
 
-def prune_graph(G,base_node,K):
+def prune_graph(G,base_node,K,direction='out'):
     '''
     Takes an existing fight graph and a base node and prunes all nodes 
     which are either not connected to the base node or whose shortest
@@ -153,6 +293,9 @@ def prune_graph(G,base_node,K):
     	    Name of the base node in the network.
     K : int
             Integer value specifying the shortest path threshold.
+    direction : str (optional)
+            Which edges to follow from the base node; see k_hop_neighbourhood.
+            Default is 'out'.
 
     Returns
     -------
@@ -160,28 +303,169 @@ def prune_graph(G,base_node,K):
             Pruned network graph    	
     '''
 
-    G = G.copy()
-    if G.is_directed():
-        G_un = G.to_undirected()
+    neighbourhood = k_hop_neighbourhood(G,base_node,K,direction)
+
+    return G.subgraph([node for node in G if node in neighbourhood]).copy()
+
+
+def k_hop_neighbourhood(G,base_node,K,direction='out'):
+    '''
+    Finds all nodes within K hops of a base node with a single bounded
+    breadth-first search.
+
+    Parameters
+    ----------
+    G : nx.DiGraph
+    	Fight graph, e.g. created using create_fight_graph.
+
+    base_node : str, int
+    	Name of the base node in the network.
+
+    K : int
+    	Maximum number of hops.
+
+    direction : str (optional)
+    	'out' follows edges from loser to winner (i.e. fighters who beat the
+    	base fighter, fighters who beat them, etc.), 'in' follows edges from
+    	winner to loser, and 'both' ignores edge direction. Default is 'out'.
+
+    Returns
+    -------
+    distances : dict
+    	Number of hops from the base node, keyed by node (including the base
+    	node itself, at distance 0).
+
+    '''
+
+    if base_node not in G:
+        raise nx.NodeNotFound('Node %s not in graph.'%base_node)
+
+    if direction == 'out':
+        neighbours = [G.successors]
+    elif direction == 'in':
+        neighbours = [G.predecessors]
+    elif direction == 'both':
+        neighbours = [G.successors,G.predecessors]
     else:
-        G_un = G
+        raise ValueError("direction must be 'out', 'in' or 'both'.")
 
-    for node in G_un.nodes():
-        if nx.has_path(G,base_node,node):
-            L = nx.shortest_path_length(G,base_node,node)
-        else:
-            L = np.inf
+    distances = {base_node:0}
+    frontier = [base_node]
+
+    for hop in xrange(1,K+1):
+        nextFrontier = []
+        for node in frontier:
+            for neighbourFun in neighbours:
+                for neighbour in neighbourFun(node):
+                    if neighbour not in distances:
+                        distances[neighbour] = hop
+                        nextFrontier.append(neighbour)
+
+        if len(nextFrontier) == 0:
+            break
+
+        frontier = nextFrontier
+
+    return distances
+
+
+def k_hop_neighbourhoods(W,seeds,K,direction='out'):
+    '''
+    Finds the K-hop neighbourhoods of a batch of base nodes at once. Each hop
+    is a single sparse matrix product for the whole batch.
+
+    Parameters
+    ----------
+    W : scipy.sparse matrix
+    	NxN adjacency matrix, e.g. from create_sparse_fight_matrix.
+
+    seeds : list
+    	Integer indices of the base nodes.
+
+    K : int
+    	Maximum number of hops.
+
+    direction : str (optional)
+    	'out', 'in' or 'both'; see k_hop_neighbourhood. Default is 'out'.
+
+    Returns
+    -------
+    distances : np.array
+    	Integer array of shape (len(seeds), N), where distances[k,j] is the
+    	number of hops from seeds[k] to node j, or -1 if node j is further
+    	than K hops away.
+
+    '''
+
+    A = csr_matrix(W,dtype=bool)
+    if direction == 'in':
+        A = A.T.tocsr()
+    elif direction == 'both':
+        A = (A+A.T).tocsr()
+    elif direction != 'out':
+        raise ValueError("direction must be 'out', 'in' or 'both'.")
+
+    seeds = np.asarray(seeds,dtype=int)
+    n = A.shape[0]
+
+    distances = -np.ones([len(seeds),n],dtype=np.int16)
+    distances[np.arange(len(seeds)),seeds] = 0
+
+    frontier = csr_matrix((np.ones(len(seeds),dtype=bool),(np.arange(len(seeds)),seeds)),\
+                          shape=(len(seeds),n))
+
+    for hop in xrange(1,K+1):
+        reached = frontier.dot(A).tocoo()
+
+        new = distances[reached.row,reached.col] < 0
+        if not new.any():
+            break
+
+        rows,cols = reached.row[new],reached.col[new]
+        distances[rows,cols] = hop
+
+        frontier = csr_matrix((np.ones(len(rows),dtype=bool),(rows,cols)),shape=(len(seeds),n))
+
+    return distances
 
-        if L > K:
-            G.remove_node(node)
-    
-    return G
 
 def compute_graph_metrics(G,base_node):
-    A = nx.adjacency_matrix(G)
-    PR = page_rank(A)
+    '''
+    Computes pagerank features for a fight graph.
+
+    Parameters
+    ----------
+    G : nx.DiGraph
+    	Fight graph, e.g. created using create_fight_graph.
+
+    base_node : str or list
+    	Fighter (or list of fighters) to compute personalized pageranks for.
+
+    Returns
+    -------
+    metrics : pd.DataFrame
+    	Indexed by node. The column 'pagerank' holds the global pagerank, and
+    	there is one column per base node holding its personalized pagerank.
 
-    return PR
+    '''
+
+    if type(base_node) in [list,tuple]:
+        baseNodes = list(base_node)
+    else:
+        baseNodes = [base_node]
+
+    nodes = list(G.nodes())
+    nodeIndex = {node:k for k,node in enumerate(nodes)}
+
+    A = nx.adjacency_matrix(G,nodelist=nodes)
+
+    metrics = pd.DataFrame({'pagerank':page_rank(A)},index=nodes)
+
+    PPR = personalized_page_rank(A,[nodeIndex[node] for node in baseNodes])
+    for k,node in enumerate(baseNodes):
+        metrics[node] = PPR[:,k]
+
+    return metrics
     
 
 def get_fights(fighter,dbfile='fighterdb.sqlite'):
@@ -200,76 +484,371 @@ def get_fights(fighter,dbfile='fighterdb.sqlite'):
     -------
     fights : list
     	     A list of all the fights from fighters   
+
+    The most recently used fight lists (up to FIGHTS_CACHE_SIZE fighters) are
+    cached until the database changes.
     '''
 
-    # this lets us optionally pass a cursor instead of the database file name
-    if type(dbfile)==str:
+    # this lets us optionally pass a cursor instead of the database file name;
+    # only lookups by file name are cached
+    if type(dbfile)!=str:
+        return select_fights(fighter,dbfile)
+
+    fightsCache = get_db_cache(dbfile)['fights']
+
+    if fighter in fightsCache:
+        fights = fightsCache.pop(fighter)
+    else:
         conn = sqlite3.connect(dbfile)
-        cur = conn.cursor()
+        fights = select_fights(fighter,conn.cursor())
+        conn.close()
+
+    # most recently used goes last
+    fightsCache[fighter] = fights
+    while len(fightsCache) > FIGHTS_CACHE_SIZE:
+        fightsCache.popitem(last=False)
+
+    return [dict(fight) for fight in fights]
+
+
+def select_fights(fighter,cur):
+    ''' Reads the fights of a fighter from the database, bypassing the cache; see get_fights. '''
+
+    cur.execute('SELECT * FROM Fights WHERE fighter1 = ? OR fighter2 = ? ORDER BY rowid',\
+                (fighter,fighter))
+
+    columnNames = [t[0] for t in cur.description]
+
+    return [{name:entry[i] for i,name in enumerate(columnNames)} for entry in cur.fetchall()]
+
+def build_features(fighters,dbfile='fighterdb.sqlite',useRatings=False,asOf=False):
+    '''
+    Builds the feature matrix and outcomes for all fights between fighters
+    in the fighters dict. The fights are read with a single query and each
+    fight is used once (previously, every fight was fetched and added once
+    for each of its two fighters, giving two identical rows per fight).
+
+    Parameters
+    ----------
+    fighters : dict
+    	Fighters dict obtained from get_fighters.
+
+    dbfile : str (optional)
+    	Name of the database file.
+
+    useRatings : bool (optional)
+    	If True, the Elo ratings of both fighters before each fight are added
+    	as the columns in rating_features (the ratings are brought up to date
+    	first, see ratings.update_ratings). Default is False.
+
+    asOf : bool (optional)
+    	If True, wins, losses and cumtime are replaced by their values before
+    	each fight (instead of the fighters' current totals, which leak the
+    	outcome), and the pre-fight career averages in tagged_career_features
+    	are added. This needs fight dates; a database without any raises a
+    	ValueError. Default is False.
+
+    Returns
+    -------
+    X : pd.DataFrame
+    	Feature matrix with one row per fight (see build_matchup for the columns).
+
+    y : np.array
+    	1.0 if the second fighter won the fight, 0.0 otherwise.
+
+    '''
+
+    if useRatings:
+        ratings.update_ratings(dbfile)
+
+        conn = sqlite3.connect(dbfile)
+        # Ratings keeps the fighter order of when the fight was rated, which
+        # need not be the order in Fights, so ratings are matched by name
+        fights = pd.read_sql_query('''SELECT Fights.id,Fights.fighter1,Fights.fighter2,Fights.winner,
+        		CASE WHEN Ratings.fighter1 = Fights.fighter1 THEN Ratings.rating1
+        		     ELSE Ratings.rating2 END AS rating1,
+        		CASE WHEN Ratings.fighter1 = Fights.fighter1 THEN Ratings.rating2
+        		     ELSE Ratings.rating1 END AS rating2
+        		FROM Fights LEFT JOIN Ratings ON Ratings.fight_id = Fights.id
+        		ORDER BY Fights.rowid''',conn)
+        conn.close()
     else:
-        cur = dbfile
+        conn = sqlite3.connect(dbfile)
+        fights = pd.read_sql_query('SELECT id,fighter1,fighter2,winner FROM Fights',conn)
+        conn.close()
 
-    data = sql_to_list('Fights',cur)
+    names,stats = fighter_stats_array(fighters)
+    nameIndex = pd.Index(names)
 
-    # So we need to check whether we have repetitions in the Fights and Fighters,
-    # and also work out the best way to structure this data.
-    
-    fights = [fight for fight in data if fighter in [fight['fighter1'],fight['fighter2']]]
+    ids1 = nameIndex.get_indexer(fights.fighter1.values)
+    ids2 = nameIndex.get_indexer(fights.fighter2.values)
 
-    return fights
+    known = (ids1 >= 0) & (ids2 >= 0)
 
-def build_features(fighters):
+    X = build_matchups(ids1[known],ids2[known],stats)
 
-    fighterNames = fighters.keys()
-    fights = []
-    for name in fighterNames:
-        
-        currentFights = get_fights(name)
-        
-        fights.extend(currentFights)
+    fill_missing_dob(X)
 
-    X = []
+    columns = list(tagged_features)
 
-    y = []
+    if asOf:
+        conn = sqlite3.connect(dbfile)
+        nDated = conn.execute('SELECT COUNT(*) FROM Fights WHERE date IS NOT NULL').fetchone()[0]
+        conn.close()
 
-    for fight in fights:
-        f1Name = fight['fighter1']
-        f2Name = fight['fighter2']
+        if nDated == 0 and len(fights) > 0:
+            raise ValueError('No fights in %s have a date, so as-of features cannot be built; re-parse the pages with fmcrawler_sql.replay_cache.'%dbfile)
 
-        if (f1Name not in fighters.keys()) or (f2Name not in fighters.keys()):
-            continue
-        
-        currentFeatureVector = build_matchup(fighters[f1Name],\
-                                             fighters[f2Name])
+        asOfStats = career_stats(dbfile)[0].loc[fights.id.values[known]]
 
-        X.append(currentFeatureVector)
+        for f in ['f1_wins','f1_losses','f1_cumtime','f2_wins','f2_losses','f2_cumtime']:
+            X[:,columns.index(f)] = asOfStats[f].values
 
-        y.append(np.double(fight['winner'] == f2Name))
-        
+        X = np.hstack([X,asOfStats[tagged_career_features].values])
+        columns += tagged_career_features
 
-    X = pd.concat(X)
-    
-    y = np.array(y)
+    if useRatings:
+        # fights without a date have no ratings
+        fightRatings = fights[['rating1','rating2']].values[known]
+        fightRatings[np.isnan(fightRatings)] = ratings.INITIAL_RATING
 
+        X = np.hstack([X,fightRatings])
+        columns += rating_features
+
+    X = pd.DataFrame(X,columns=columns)
     
-    # if we're missing date of birth for one fighter, set their date of births to be the same    
-    missingF1DobIdx = np.isnan(X.f1_dob)
-    missingF2DobIdx = np.isnan(X.f2_dob)
-    missingBothDobIdx = missingF1DobIdx & missingF2DobIdx
-    X.loc[missingF1DobIdx,'f1_dob'] = X.loc[missingF1DobIdx,'f2_dob'].values
-    X.loc[missingF2DobIdx,'f2_dob'] = X.loc[missingF2DobIdx,'f1_dob'].values
-    X.loc[missingBothDobIdx,'f1_dob'] = 1988
-    X.loc[missingBothDobIdx,'f2_dob'] = 1988
+    y = (fights.winner.values == fights.fighter2.values)[known].astype(np.double)
         
     return X,y
+
+
+def career_stats(dbfile='fighterdb.sqlite'):
+    '''
+    Computes every fighter's career totals and averages as they stood before
+    each fight, in one vectorized pass over the Fights table: the fights of
+    each fighter are sorted by date once, and the totals are exclusive
+    cumulative sums within each fighter. Fights without a date are treated
+    as the most recent (in no meaningful order), and a warning is printed
+    if there are any. The result is cached until the database changes.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    asOf : pd.DataFrame
+    	Indexed by fight id, with columns 'f1_'+f and 'f2_'+f for f in wins,
+    	losses, cumtime and career_features, giving the state of fighter1 and
+    	fighter2 before the fight. Averages are per fight (strikes, takedowns,
+    	submission attempts and passes landed), and 0 before a first fight.
+
+    current : pd.DataFrame
+    	Indexed by fighter name, with the same columns (without the prefix)
+    	after all fights in the database.
+
+    '''
+
+    cache = get_db_cache(dbfile)
+
+    if cache['career'] is None:
+        cache['career'] = compute_career_stats(dbfile)
+
+    return cache['career']
+
+
+def compute_career_stats(dbfile='fighterdb.sqlite'):
+    ''' Computes career_stats, bypassing the cache. '''
+
+    conn = sqlite3.connect(dbfile)
+    fights = pd.read_sql_query('''SELECT id,fighter1,fighter2,winner,date,time,
+    		str1,str2,td1,td2,sub1,sub2,pass1,pass2 FROM Fights''',conn)
+    conn.close()
+
+    n = len(fights)
+
+    nUndated = int(fights.date.isnull().sum())
+    if nUndated > 0:
+        print 'Warning: %d of %d fights have no date, so their as-of career stats are not point-in-time; re-parse the pages with fmcrawler_sql.replay_cache.'%(nUndated,n)
+
+    # one row per fighter per fight: rows [0,n) are fighter1, [n,2n) fighter2
+    fighter = np.concatenate([fights.fighter1.values,fights.fighter2.values])
+    won1 = fights.winner.values == fights.fighter1.values
+    won2 = fights.winner.values == fights.fighter2.values
+
+    totals = pd.DataFrame({'wins':np.concatenate([won1,won2]),\
+                           'losses':np.concatenate([won2,won1]),\
+                           'cumtime':np.tile(fights.time.values,2),\
+                           'fights':np.ones(2*n),\
+                           'str':np.concatenate([fights.str1.values,fights.str2.values]),\
+                           'td':np.concatenate([fights.td1.values,fights.td2.values]),\
+                           'sub':np.concatenate([fights.sub1.values,fights.sub2.values]),\
+                           'pass':np.concatenate([fights.pass1.values,fights.pass2.values])},\
+                          columns=['wins','losses','cumtime','fights','str','td','sub','pass'])
+    totals = totals.astype(float).fillna(0)
+
+    # sort by fighter, then date, then fight id (dates are YYYY-MM-DD strings)
+    fighterCodes = pd.factorize(fighter,sort=True)[0]
+    dateCodes = pd.factorize(np.tile(fights.date.fillna('9999-99-99').values,2),sort=True)[0]
+    order = np.lexsort((np.tile(fights.id.values,2),dateCodes,fighterCodes))
+
+    sortedTotals = totals.iloc[order]
+    before = sortedTotals.groupby(fighterCodes[order]).cumsum()-sortedTotals
+
+    # back to the original row order
+    asOfTotals = pd.DataFrame(index=np.arange(2*n),columns=totals.columns,dtype=float)
+    asOfTotals.iloc[order] = before.values
+
+    careerColumns = ['wins','losses','cumtime']+career_features
+
+    asOf = pd.DataFrame(index=fights.id.values)
+    for tag,rows in [('f1_',slice(0,n)),('f2_',slice(n,2*n))]:
+        for f,value in career_averages(asOfTotals.iloc[rows]).items():
+            asOf[tag+f] = value.values
+    asOf = asOf[['f1_'+f for f in careerColumns]+['f2_'+f for f in careerColumns]]
+
+    current = career_averages(totals.groupby(fighter).sum())[careerColumns]
+
+    return asOf,current
+
+
+def career_averages(totals):
+    ''' Converts career totals (see compute_career_stats) into totals and per-fight averages. '''
+
+    nFights = totals['fights'].values
+    safeFights = np.maximum(nFights,1)
+
+    return pd.DataFrame({'wins':totals['wins'],'losses':totals['losses'],\
+                         'cumtime':totals['cumtime'],'fights':totals['fights'],\
+                         'str_mean':totals['str']/safeFights,\
+                         'td_mean':totals['td']/safeFights,\
+                         'sub_mean':totals['sub']/safeFights,\
+                         'pass_mean':totals['pass']/safeFights},index=totals.index)
+
+
+def fill_missing_dob(X):
+    '''
+    If we're missing date of birth for one fighter, set their date of births
+    to be the same; if both are missing, use 1988. X is modified in place.
+
+    Parameters
+    ----------
+    X : np.array
+    	Feature matrix from build_matchups.
+
+    Returns
+    -------
+    Nothing.
+    '''
+
+    f1Dob = tagged_features.index('f1_dob')
+    f2Dob = tagged_features.index('f2_dob')
+
+    missingF1DobIdx = np.isnan(X[:,f1Dob])
+    missingF2DobIdx = np.isnan(X[:,f2Dob])
+    missingBothDobIdx = missingF1DobIdx & missingF2DobIdx
+
+    X[missingF1DobIdx,f1Dob] = X[missingF1DobIdx,f2Dob]
+    X[missingF2DobIdx,f2Dob] = X[missingF2DobIdx,f1Dob]
+    X[missingBothDobIdx,f1Dob] = 1988
+    X[missingBothDobIdx,f2Dob] = 1988
+
+
+def fighter_stats_array(fighters):
+    '''
+    Converts a fighters dict into a fighter stats array, to be used with
+    build_matchups.
+
+    Parameters
+    ----------
+    fighters : dict
+    	Fighters dict obtained from get_fighters.
+
+    Returns
+    -------
+    names : list
+    	Fighter names; names[i] corresponds to row i of stats.
+
+    stats : np.array
+    	Array of shape (nFighters, len(feature_list)); see fighters_to_frame.
+
+    '''
+
+    fighterFrame = fighters_to_frame(fighters)
+
+    return list(fighterFrame.index),fighterFrame.values
+
+
+def build_matchups(ids1,ids2,stats):
+    '''
+    Builds the feature matrix for a batch of fights in one vectorized gather.
+
+    Parameters
+    ----------
+    ids1 : np.array
+    	Integer row indices into stats of the first fighter in each fight.
+
+    ids2 : np.array
+    	Integer row indices into stats of the second fighter in each fight.
+
+    stats : np.array
+    	Fighter stats array, e.g. from fighter_stats_array.
+
+    Returns
+    -------
+    X : np.array
+    	Array of shape (nFights, 2*len(feature_list)), with columns given by
+    	tagged_features.
+
+    '''
+
+    stats = np.asarray(stats)
+    f1 = stats[np.asarray(ids1,dtype=int)]
+    f2 = stats[np.asarray(ids2,dtype=int)]
+
+    # the first fighter's dob is encoded as age, and the second fighter's
+    # as year of birth; this is what the classifier has always been trained on
+    dobIdx = feature_list.index('dob')
+    f1[:,dobIdx] = 2017-f1[:,dobIdx]
+
+    return np.hstack([f1,f2])
+
+
+def fighters_to_frame(fighters):
+    '''
+    Converts a fighters dict into a DataFrame of numeric features, one row per
+    fighter (indexed by name). Stance is encoded as 0 for orthodox and 1
+    otherwise, and dob as year of birth (NaN if unknown).
+
+    Parameters
+    ----------
+    fighters : dict
+    	Fighters dict obtained from get_fighters.
+
+    Returns
+    -------
+    fighterFrame : pd.DataFrame
+    	Columns are given by feature_list.
+
+    '''
+
+    fighterFrame = pd.DataFrame.from_dict(fighters,orient='index')
+
+    dob = fighterFrame['dob'].astype(str).str[-4:]
+    fighterFrame['dob'] = pd.to_numeric(dob.where(fighterFrame['dob'] != '--'),errors='coerce')
+    fighterFrame['stance'] = (fighterFrame['stance'] != 'Orthodox').astype(float)
+
+    return fighterFrame[feature_list].astype(float)
         
     
 
-def build_matchup(fighter1,fighter2):
+def build_matchup(fighter1,fighter2,fighterRatings=None,careerStats=None):
     ''' 
     Builds a single feature vector for a fight between two fighters.
     Note that this only considers fighter stats at the present moment
-    in time (except age... maybe)
+    in time (except age... maybe). This is a wrapper around build_matchups;
+    use that directly for more than a few fights.
 
     Parameters
     ----------
@@ -277,6 +856,13 @@ def build_matchup(fighter1,fighter2):
     	       fighter dictionary containing stats on the first fighter
     fighter2 : dict
     	       fighter dictionary containing stats on the second fighter
+    fighterRatings : tuple (optional)
+    	       (rating1, rating2), current Elo ratings of both fighters
+    	       (see ratings.get_ratings); added as the rating_features columns
+    careerStats : tuple (optional)
+    	       (stats1, stats2), current career averages of both fighters
+    	       (rows of the second output of career_stats); added as the
+    	       tagged_career_features columns
 
     Returns
     -------
@@ -284,48 +870,22 @@ def build_matchup(fighter1,fighter2):
     	A single-row data frame corresponding to our feature vector   
     '''
 
-    feature_list = ['height','reach','sapm','slpm','stance','stracc',\
-                    'strdef','subavg','tdacc','tdavg','tddef',\
-                    'weight','dob','wins','losses','cumtime']
+    names,stats = fighter_stats_array({0:fighter1,1:fighter2})
 
-    tagged_features = ['f1_'+f for f in feature_list]+['f2_'+f for f in feature_list]
-    X = pd.DataFrame(columns=tagged_features,dtype=float)
+    X = build_matchups([names.index(0)],[names.index(1)],stats)
 
-    for feature in feature_list:
-        f1='f1_'+feature
-        f2='f2_'+feature
-        
-        cf1=fighter1[feature]
-        cf2=fighter2[feature]
-            
-        if feature == 'dob':
-            if cf1=='--':
-                cf1=np.nan
-            else:
-                cf1=2017-float(cf1[-4:])
-
-            if cf2=='--':
-                cf2=np.nan
-            else:
-                cf2=float(cf2[-4:])
-
-        if feature == 'stance':
-            if cf1 == 'Orthodox':
-                cf1=0.0
-            else:
-                cf1=1.0
-                
-            if cf2 == 'Orthodox':
-                cf2=0.0
-            else:
-                cf2=1.0
+    columns = list(tagged_features)
 
-        X.loc[0,f1]=float(cf1)
-        X.loc[0,f2]=float(cf2)
+    if careerStats is not None:
+        career = [careerStats[0][f] for f in career_features]+[careerStats[1][f] for f in career_features]
+        X = np.hstack([X,[career]])
+        columns += tagged_career_features
 
+    if fighterRatings is not None:
+        X = np.hstack([X,[fighterRatings]])
+        columns += rating_features
 
-
-    return X
+    return pd.DataFrame(X,columns=columns)
 
 
 
@@ -354,6 +914,35 @@ def sql_to_list(tableName,cur):
     return dataList
 
 def get_fighters(dbfile='fighterdb.sqlite'):
+    '''
+    Returns all fighters in the database.
+
+    The result is cached for the lifetime of the process, and only re-read
+    when the database changes (see db_fingerprint). The returned dict is
+    shared between callers, so it should not be modified.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    fighters : dict
+    	Dict of fighter stats dicts, keyed by fighter name.
+
+    '''
+
+    cache = get_db_cache(dbfile)
+
+    if cache['fighters'] is None:
+        cache['fighters'] = load_fighters(dbfile)
+
+    return cache['fighters']
+
+
+def load_fighters(dbfile='fighterdb.sqlite'):
+    ''' Reads all fighters from the database, bypassing the cache; see get_fighters. '''
 
     conn = sqlite3.connect(dbfile)
 
@@ -374,5 +963,56 @@ def get_fighters(dbfile='fighterdb.sqlite'):
     return dataDict
 
 
+# maximum number of per-fighter fight lists kept by get_fights
+FIGHTS_CACHE_SIZE = 512
+
+_dbCache = {}
+
+def get_db_cache(dbfile='fighterdb.sqlite'):
+    '''
+    Returns the process-level cache for dbfile, emptying it first if the
+    database has changed since it was filled.
+
+    Returns
+    -------
+    cache : dict
+    	Dict with keys 'fingerprint', 'fighters' (None until get_fighters
+    	is called), 'fights' (an LRU OrderedDict of fight lists) and 'career'
+    	(None until career_stats is called).
+
+    '''
+
+    key = os.path.abspath(dbfile)
+    fingerprint = db_fingerprint(dbfile)
+
+    if key not in _dbCache or _dbCache[key]['fingerprint'] != fingerprint:
+        _dbCache[key] = {'fingerprint':fingerprint,'fighters':None,\
+                         'fights':collections.OrderedDict(),'career':None}
+
+    return _dbCache[key]
+
+
+def clear_cache(dbfile=None):
+    ''' Empties the cache for dbfile, or for all databases if dbfile is None. '''
+
+    if dbfile is None:
+        _dbCache.clear()
+    else:
+        _dbCache.pop(os.path.abspath(dbfile),None)
+
+
+def db_fingerprint(dbfile='fighterdb.sqlite'):
+    '''
+    Returns a fingerprint of the database file which changes whenever the
+    database is written to (based on the size and modification time of the
+    database and its write-ahead log). Used to decide when derived data
+    (e.g. the feature store) needs to be regenerated.
+    '''
 
+    stats = []
+    for f in [dbfile,dbfile+'-wal']:
+        if os.path.exists(f):
+            st = os.stat(f)
+            stats.append('%s:%d:%r'%(os.path.basename(f),st.st_size,st.st_mtime))
 
+    return hashlib.sha1('|'.join(stats)).hexdigest()
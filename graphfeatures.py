@@ -0,0 +1,241 @@
+import sqlite3,pickle,collections
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+import fmprocess,fmcrawler_sql
+
+
+class GraphFeatureEngine(object):
+    '''
+    Maintains win-graph features (pagerank, wins, losses and connected
+    components) which are updated incrementally as new fights arrive.
+
+    Fighters are kept in a union-find structure of connected components of
+    the fight graph. When a batch of fights is added, only the components
+    it touches are marked as changed, and only their pageranks are
+    recomputed, warm-started from the previous values. Pageranks are
+    computed within each component (teleportation and the rank of sink
+    states stay in the component) and then scaled by the component's share
+    of all fighters, so fighters in different components are comparable.
+
+    Parameters
+    ----------
+    s : float (optional)
+    	Probability of following a transition, as for fmprocess.page_rank.
+    	Default is 0.85.
+
+    maxerr : float (optional)
+    	Convergence tolerance, as for fmprocess.page_rank. Default is 1e-6.
+
+    '''
+
+    def __init__(self,s=.85,maxerr=1e-6):
+        self.s = s
+        self.maxerr = maxerr
+
+        self.names = []
+        self.idOfName = {}
+        self.fightIds = set()
+
+        # union-find over fighter ids; members and win edges (loser,winner)
+        # are only kept for component roots
+        self.parent = []
+        self.members = {}
+        self.edges = {}
+
+        self.wins = []
+        self.losses = []
+        self.rank = []
+
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _add_fighter(self,name):
+        fighterId = len(self.names)
+
+        self.names.append(name)
+        self.idOfName[name] = fighterId
+        self.parent.append(fighterId)
+        self.members[fighterId] = [fighterId]
+        self.edges[fighterId] = []
+        self.wins.append(0)
+        self.losses.append(0)
+        self.rank.append(1.0)
+
+        self.changed.add(fighterId)
+
+        return fighterId
+
+    def _find(self,fighterId):
+        root = fighterId
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        # path compression
+        while self.parent[fighterId] != root:
+            self.parent[fighterId],fighterId = root,self.parent[fighterId]
+
+        return root
+
+    def _union(self,id1,id2):
+        root1,root2 = self._find(id1),self._find(id2)
+        if root1 == root2:
+            return root1
+
+        # merge the smaller component into the larger one
+        if len(self.members[root1]) < len(self.members[root2]):
+            root1,root2 = root2,root1
+
+        self.parent[root2] = root1
+        self.members[root1].extend(self.members.pop(root2))
+        self.edges[root1].extend(self.edges.pop(root2))
+
+        self.changed.discard(root2)
+
+        return root1
+
+    def add_fights(self,fights):
+        '''
+        Adds a batch of fights. Fights which have already been added (by id)
+        are ignored, and fights without a winner only connect the fighters.
+
+        Parameters
+        ----------
+        fights : list
+        	List of (id, fighter1, fighter2, winner) tuples, as in the
+        	Fights table.
+
+        Returns
+        -------
+        nAdded : int
+        	Number of new fights.
+
+        '''
+
+        nAdded = 0
+
+        for fightId,fighter1,fighter2,winner in fights:
+            if fightId in self.fightIds:
+                continue
+            self.fightIds.add(fightId)
+            nAdded += 1
+
+            ids = []
+            for name in [fighter1,fighter2]:
+                if name not in self.idOfName:
+                    self._add_fighter(name)
+                ids.append(self.idOfName[name])
+
+            root = self._union(ids[0],ids[1])
+
+            if winner in [fighter1,fighter2]:
+                winnerId = ids[winner == fighter2]
+                loserId = ids[winner == fighter1]
+
+                self.wins[winnerId] += 1
+                self.losses[loserId] += 1
+                self.edges[root].append((loserId,winnerId))
+
+            self.changed.add(root)
+
+        self.changed = set([self._find(root) for root in self.changed])
+
+        self.refresh()
+
+        return nAdded
+
+    def update_from_db(self,dbfile='fighterdb.sqlite'):
+        '''
+        Adds all fights in the Fights table which have not been added yet.
+
+        Returns
+        -------
+        nAdded : int
+        	Number of new fights.
+
+        '''
+
+        conn = sqlite3.connect(dbfile)
+        cur = conn.cursor()
+
+        cur.execute('SELECT id FROM Fights')
+        newIds = [k[0] for k in cur.fetchall() if k[0] not in self.fightIds]
+
+        fights = fmcrawler_sql.select_in(cur,'''SELECT id,fighter1,fighter2,winner
+        				FROM Fights WHERE id IN ( %s ) ORDER BY id''',newIds)
+
+        conn.close()
+
+        return self.add_fights(fights)
+
+    def refresh(self):
+        ''' Recomputes the pageranks of all components changed since the last refresh. '''
+
+        for root in self.changed:
+            members = self.members[root]
+            if len(members) == 1:
+                self.rank[members[0]] = 1.0
+                continue
+
+            localId = {fighterId:k for k,fighterId in enumerate(members)}
+            m = len(members)
+
+            if len(self.edges[root]) > 0:
+                loserIds,winnerIds = zip(*self.edges[root])
+            else:
+                loserIds,winnerIds = [],[]
+
+            W = coo_matrix((np.ones(len(loserIds)),\
+                            ([localId[k] for k in loserIds],[localId[k] for k in winnerIds])),\
+                           shape=(m,m)).tocsr()
+
+            # ranks are stored scaled by component size, so the ranks of
+            # components which have just merged can be used as they are
+            r0 = np.array([self.rank[k] for k in members])
+
+            r = fmprocess.page_rank(W,self.s,self.maxerr,r0=r0)
+
+            for k,fighterId in enumerate(members):
+                self.rank[fighterId] = r[k]*m
+
+        self.changed = set()
+
+    def features(self):
+        '''
+        Returns the graph features of all fighters.
+
+        Returns
+        -------
+        features : pd.DataFrame
+        	Indexed by fighter name, with columns pagerank (sums to 1 over
+        	all fighters), wins, losses, component (id of the connected
+        	component) and component_size.
+
+        '''
+
+        n = len(self.names)
+        roots = [self._find(k) for k in range(n)]
+        sizes = collections.Counter(roots)
+
+        return pd.DataFrame({'pagerank':np.array(self.rank)/max(n,1),\
+                             'wins':self.wins,\
+                             'losses':self.losses,\
+                             'component':roots,\
+                             'component_size':[sizes[root] for root in roots]},\
+                            index=self.names,\
+                            columns=['pagerank','wins','losses','component','component_size'])
+
+    def save(self,fname='graphfeatures.pickle'):
+        ''' Saves the engine, so later updates can continue from it; see load. '''
+
+        with open(fname,'wb') as f:
+            pickle.dump(self,f,pickle.HIGHEST_PROTOCOL)
+
+
+def load(fname='graphfeatures.pickle'):
+    ''' Loads an engine saved with GraphFeatureEngine.save. '''
+
+    with open(fname,'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,295 @@
+import os,json
+import numpy as np
+import fmprocess,classifier
+
+
+# upper weight limits (in lbs) of the weight classes; fighters are assigned
+# to the lightest class they fit in (men's and women's divisions share limits)
+WEIGHT_CLASSES = [('strawweight',115),('flyweight',125),('bantamweight',135),\
+                  ('featherweight',145),('lightweight',155),('welterweight',170),\
+                  ('middleweight',185),('light_heavyweight',205),('heavyweight',265)]
+
+KG_TO_LBS = 2.20462
+
+
+def weight_class(weight):
+    '''
+    Returns the weight class of a fighter.
+
+    Parameters
+    ----------
+    weight : float
+    	Weight in kg, as in the Fighters table. The parser stores unknown
+    	weights as 0 (see fightmetric.lbs_to_kg).
+
+    Returns
+    -------
+    weightClass : str or None
+    	Name of the weight class (see WEIGHT_CLASSES), or None if the weight
+    	is unknown or above the heavyweight limit.
+
+    '''
+
+    if weight is None or np.isnan(weight) or weight <= 0:
+        return None
+
+    # allow for rounding in the lbs to kg conversion
+    lbs = weight*KG_TO_LBS-0.5
+
+    for name,limit in WEIGHT_CLASSES:
+        if lbs <= limit:
+            return name
+
+    return None
+
+
+def weight_classes(fighters):
+    '''
+    Groups fighters by weight class.
+
+    Parameters
+    ----------
+    fighters : dict
+    	Fighters dict obtained from fmprocess.get_fighters.
+
+    Returns
+    -------
+    classes : dict
+    	Sorted lists of fighter names, keyed by weight class.
+
+    '''
+
+    classes = {}
+    for name,fighter in fighters.items():
+        weightClass = weight_class(fighter['weight'])
+        if weightClass is not None:
+            classes.setdefault(weightClass,[]).append(name)
+
+    for weightClass in classes:
+        classes[weightClass].sort()
+
+    return classes
+
+
+def build_matrix(myClassifier,names,fname,dbfile='fighterdb.sqlite',chunkSize=256,features=None):
+    '''
+    Computes the win probabilities of all pairs of the given fighters and
+    saves them as a memory-mappable matrix. The matrix is filled in chunks
+    of chunkSize rows, each predicted with one predict_proba call.
+
+    Parameters
+    ----------
+    myClassifier : sklearn classifier
+    	Obtained from calling classifier.build_classifier or load_classifier.
+
+    names : list
+    	Fighter names (as in the database).
+
+    fname : str
+    	File to save the matrix to (.npy); the name index goes in the same
+    	file with .json appended.
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    chunkSize : int (optional)
+    	Number of rows per chunk. Default is 256.
+
+    features : classifier.MatchupFeatures (optional)
+    	Precomputed matchup features, e.g. when building several matrices.
+
+    Returns
+    -------
+    matrix : WinMatrix
+    	The saved matrix, opened for queries.
+
+    '''
+
+    if features is None:
+        features = classifier.MatchupFeatures(myClassifier,dbfile)
+
+    names = [name for name in names if name in features.rowOfName]
+    rows = features.rows(names)
+    n = len(names)
+
+    # P[i,j] is the probability that fighter i beats fighter j, with fighter
+    # i as fighter1; written to a temporary file and renamed when complete
+    tmpFile = fname+'.tmp'
+    P = np.lib.format.open_memmap(tmpFile,mode='w+',dtype=np.float32,shape=(n,n))
+
+    for start in range(0,n,chunkSize):
+        stop = min(start+chunkSize,n)
+
+        ids1 = np.repeat(rows[start:stop],n)
+        ids2 = np.tile(rows,stop-start)
+
+        P[start:stop] = features.predict_proba(ids1,ids2)[:,0].reshape(stop-start,n)
+
+    P[np.arange(n),np.arange(n)] = 0.5
+    P.flush()
+    del P
+
+    os.rename(tmpFile,fname)
+
+    index = {'names':names,\
+             'schema_version':fmprocess.FEATURE_SCHEMA_VERSION,\
+             'db_fingerprint':fmprocess.db_fingerprint(dbfile)}
+    with open(fname+'.json','w') as f:
+        json.dump(index,f)
+
+    return WinMatrix(fname)
+
+
+def build_weight_class_matrices(myClassifier,outdir='matchups',dbfile='fighterdb.sqlite',chunkSize=256):
+    '''
+    Builds the win-probability matrix of every weight class (see build_matrix),
+    saved as outdir/<weight class>.npy.
+
+    Returns
+    -------
+    matrices : dict
+    	WinMatrix objects, keyed by weight class.
+
+    '''
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    features = classifier.MatchupFeatures(myClassifier,dbfile)
+
+    matrices = {}
+    for weightClass,names in sorted(weight_classes(fmprocess.get_fighters(dbfile)).items()):
+        print 'Building %s matrix (%d fighters)'%(weightClass,len(names))
+
+        matrices[weightClass] = build_matrix(myClassifier,names,os.path.join(outdir,weightClass+'.npy'),\
+                                             dbfile,chunkSize,features)
+
+    return matrices
+
+
+class WinMatrix(object):
+    '''
+    Memory-mapped all-pairs win-probability matrix saved by build_matrix.
+
+    Parameters
+    ----------
+    fname : str
+    	Matrix file (.npy).
+
+    '''
+
+    def __init__(self,fname):
+        with open(fname+'.json') as f:
+            index = json.load(f)
+
+        self.names = index['names']
+        self.schemaVersion = index['schema_version']
+        self.dbFingerprint = index['db_fingerprint']
+        self.rowOfName = {name:row for row,name in enumerate(self.names)}
+
+        self.P = np.load(fname,mmap_mode='r')
+
+    def __contains__(self,name):
+        return name in self.rowOfName
+
+    def probability(self,fighter1,fighter2,symmetric=True):
+        '''
+        Returns the probability that fighter1 beats fighter2.
+
+        Parameters
+        ----------
+        fighter1 : str
+        	Name of the first fighter.
+
+        fighter2 : str
+        	Name of the second fighter.
+
+        symmetric : bool (optional)
+        	The classifier does not treat both corners the same way; if True
+        	(default), the probabilities with either fighter as fighter1 are
+        	averaged.
+
+        Returns
+        -------
+        p : float
+
+        '''
+
+        i,j = self.rowOfName[fighter1],self.rowOfName[fighter2]
+
+        if symmetric:
+            return float(self.P[i,j]+1-self.P[j,i])/2
+
+        return float(self.P[i,j])
+
+    def win_probabilities(self,name):
+        ''' Returns the (symmetric) probabilities of a fighter beating every fighter in the matrix. '''
+
+        i = self.rowOfName[name]
+
+        return (np.asarray(self.P[i],dtype=float)+1-np.asarray(self.P[:,i],dtype=float))/2
+
+    def top_opponents(self,name,k=10,largest=True):
+        '''
+        Returns the k opponents a fighter is most (or least) likely to beat.
+
+        Parameters
+        ----------
+        name : str
+        	Name of the fighter.
+
+        k : int (optional)
+        	Number of opponents. Default is 10.
+
+        largest : bool (optional)
+        	If True (default), the opponents the fighter is most likely to
+        	beat; otherwise those the fighter is least likely to beat.
+
+        Returns
+        -------
+        opponents : list
+        	List of (opponent, probability of the fighter winning) tuples,
+        	sorted from most to least extreme.
+
+        '''
+
+        p = self.win_probabilities(name)
+        candidates = np.delete(np.arange(len(p)),self.rowOfName[name])
+
+        return self._top_k(p,candidates,k,largest)
+
+    def upsets(self,name,k=10):
+        '''
+        Returns the most likely upsets for a fighter: the opponents the
+        fighter is favoured against but is least likely to beat.
+
+        Returns
+        -------
+        upsets : list
+        	List of (opponent, probability of the fighter winning) tuples,
+        	most likely upset first.
+
+        '''
+
+        p = self.win_probabilities(name)
+        candidates = np.where(p > 0.5)[0]
+
+        return self._top_k(p,candidates,k,largest=False)
+
+    def _top_k(self,p,candidates,k,largest):
+        values = p[candidates] if largest else -p[candidates]
+        k = min(k,len(candidates))
+        if k == 0:
+            return []
+
+        # only the top k are sorted
+        top = np.argpartition(-values,k-1)[:k]
+        top = top[np.argsort(-values[top])]
+
+        return [(self.names[candidates[t]],float(p[candidates[t]])) for t in top]
+
+
+def load_matrix(weightClass,outdir='matchups'):
+    ''' Opens the matrix of a weight class saved by build_weight_class_matrices. '''
+
+    return WinMatrix(os.path.join(outdir,weightClass+'.npy'))
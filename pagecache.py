@@ -0,0 +1,160 @@
+import os,sqlite3,hashlib,zlib,time,threading
+
+
+class PageCache(object):
+    '''
+    Compressed on-disk cache of raw Fightmetric pages.
+
+    Page bodies are stored content-addressed (by their SHA1 hash) under
+    cachedir/objects, so identical pages are only stored once. A small
+    SQLite index maps each URL to the hash of its latest body, the time
+    it was fetched, and the ETag/Last-Modified headers needed to
+    revalidate it with a conditional request.
+
+    Parameters
+    ----------
+    cachedir : str (optional)
+    	Directory holding the cache. Created if it does not exist.
+    	Default is 'pagecache'.
+
+    '''
+
+    def __init__(self,cachedir='pagecache'):
+        self.cachedir = cachedir
+        self.objectdir = os.path.join(cachedir,'objects')
+
+        if not os.path.isdir(self.objectdir):
+            os.makedirs(self.objectdir)
+
+        # the cache is used from several fetch threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cachedir,'index.sqlite'),\
+                                    timeout=10,check_same_thread=False)
+
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS Pages (
+        url		TEXT NOT NULL PRIMARY KEY UNIQUE,
+        hash		TEXT,
+        fetched		REAL,
+        etag		TEXT,
+        lastmodified	TEXT
+        )
+        ''')
+        self.conn.commit()
+
+    def _object_path(self,pageHash):
+        return os.path.join(self.objectdir,pageHash[:2],pageHash[2:]+'.z')
+
+    def lookup(self,url):
+        '''
+        Returns the index entry for url.
+
+        Parameters
+        ----------
+        url : str
+        	Normalised URL of the page (see fightmetric.normalise_url).
+
+        Returns
+        -------
+        entry : dict or None
+        	Dict with keys hash, fetched, etag and lastmodified, or None if
+        	the page is not in the cache.
+
+        '''
+
+        with self.lock:
+            cur = self.conn.execute('''SELECT hash,fetched,etag,lastmodified
+            			FROM Pages WHERE url = ?''',(url,))
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        return {'hash':row[0],'fetched':row[1],'etag':row[2],'lastmodified':row[3]}
+
+    def load(self,url):
+        '''
+        Returns the cached page for url as a list of lines (like get_page),
+        or None if it is not cached.
+        '''
+
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+
+        objectPath = self._object_path(entry['hash'])
+        if not os.path.exists(objectPath):
+            return None
+
+        with open(objectPath,'rb') as f:
+            body = zlib.decompress(f.read())
+
+        return body.splitlines(True)
+
+    def store(self,url,page,headers=None):
+        '''
+        Adds a freshly fetched page to the cache.
+
+        Parameters
+        ----------
+        url : str
+        	Normalised URL of the page.
+
+        page : list
+        	The page, as a list of lines.
+
+        headers : dict (optional)
+        	Response headers; used for the ETag and Last-Modified validators.
+
+        Returns
+        -------
+        pageHash : str
+        	SHA1 hash of the page body.
+
+        '''
+
+        if headers is None:
+            headers = {}
+
+        body = ''.join(page)
+        pageHash = hashlib.sha1(body).hexdigest()
+
+        objectPath = self._object_path(pageHash)
+        if not os.path.exists(objectPath):
+            if not os.path.isdir(os.path.dirname(objectPath)):
+                try:
+                    os.makedirs(os.path.dirname(objectPath))
+                except OSError:
+                    pass # another thread got there first
+
+            # write to a temporary file first so readers never see a partial object
+            tmpPath = '%s.%d.tmp'%(objectPath,threading.current_thread().ident)
+            with open(tmpPath,'wb') as f:
+                f.write(zlib.compress(body,6))
+            os.rename(tmpPath,objectPath)
+
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO Pages
+            		(url,hash,fetched,etag,lastmodified) VALUES ( ?, ?, ?, ?, ? )''',\
+                              (url,pageHash,time.time(),headers.get('etag'),\
+                               headers.get('last-modified')))
+            self.conn.commit()
+
+        return pageHash
+
+    def touch(self,url):
+        ''' Marks a cached page as revalidated (e.g. after a 304 response). '''
+
+        with self.lock:
+            self.conn.execute('UPDATE Pages SET fetched = ? WHERE url = ?',(time.time(),url))
+            self.conn.commit()
+
+    def urls(self):
+        ''' Returns a list of all URLs in the cache. '''
+
+        with self.lock:
+            cur = self.conn.execute('SELECT url FROM Pages ORDER BY url')
+            return [k[0] for k in cur.fetchall()]
+
+    def close(self):
+        self.conn.close()
@@ -22,18 +22,20 @@ def ufc208_predictions(X=None,y=None):
               ('Phillipe Nover','Rick Glenn'),\
               ('Ryan LaFlare','Roan Carneiro')]
 
-    fighters = fmprocess.get_fighters()
+    predictions = classifier.predict_card(myClassifier,currentFights)
 
     winners = []
     
-    for fight in currentFights:
-        if (fight[0] not in fighters) or (fight[1] not in fighters):
-            print '%s vs %s skipped as one or both fighters not in database.'%fight
+    for k,fight in predictions.iterrows():
+        if fight.missing != '':
+            print '%s vs %s skipped as one or both fighters not in database.'%(fight.fighter1,fight.fighter2)
             print ' '
             continue
 
-        print '%s vs %s'%fight
-        winner=classifier.predict_fight(myClassifier,fight[0],fight[1])
+        print '%s vs %s'%(fight.fighter1,fight.fighter2)
+
+        winner = fight.fighter1 if fight.winner == fight.name1 else fight.fighter2
+        print '%.2f%% chance of %s winning.'%(100*max(fight.p1,fight.p2),winner)
         print ' '
 
         winners.append(winner)
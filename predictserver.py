@@ -0,0 +1,410 @@
+'''
+Long-lived prediction service. The classifier and fighter features are
+loaded once and kept in memory, and concurrent requests are coalesced into
+micro-batches which are predicted with a single predict_proba call.
+
+The service speaks either JSON lines on stdin/stdout:
+
+	python predictserver.py --classifier classifier.pickle
+	{"id": 1, "fighter1": "Conor McGregor", "fighter2": "Nick Diaz"}
+	{"cmd": "stats"}
+
+or HTTP on a local socket:
+
+	python predictserver.py --http 8642
+	curl 'localhost:8642/predict?fighter1=Conor+McGregor&fighter2=Nick+Diaz'
+	curl -d '[["Conor McGregor","Nick Diaz"]]' localhost:8642/predict
+	curl localhost:8642/stats
+'''
+import sys,time,json,threading,Queue,collections,argparse,urlparse
+import BaseHTTPServer,SocketServer
+import numpy as np
+import classifier,featurestore,fighterindex,crawlstats
+
+
+class PendingPrediction(object):
+    ''' Result of PredictionService.submit; wait() blocks until the prediction is made. '''
+
+    def __init__(self,fighter1,fighter2):
+        self.fighter1 = fighter1
+        self.fighter2 = fighter2
+        self.submitted = time.time()
+        self.event = threading.Event()
+        self.result = None
+
+    def set(self,result):
+        self.result = result
+        self.event.set()
+
+    def wait(self,timeout=None):
+        self.event.wait(timeout)
+        return self.result
+
+
+class PredictionService(object):
+    '''
+    Resident fight predictor with micro-batching.
+
+    Parameters
+    ----------
+    classifierFile : str (optional)
+    	Classifier saved with classifier.save_classifier. Default is
+    	'classifier.pickle'.
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    storedir : str (optional)
+    	Directory of the feature store (see featurestore.py), from which the
+    	fighter stats are memory-mapped. Default is 'featurestore'.
+
+    maxBatch : int (optional)
+    	Maximum number of requests per batch. Default is 64.
+
+    maxWait : float (optional)
+    	Maximum number of seconds to wait for more requests once the first
+    	request of a batch has arrived. Default is 0.002.
+
+    '''
+
+    def __init__(self,classifierFile='classifier.pickle',dbfile='fighterdb.sqlite',\
+                 storedir='featurestore',maxBatch=64,maxWait=0.002):
+        self.classifierFile = classifierFile
+        self.dbfile = dbfile
+        self.storedir = storedir
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+
+        self.metrics = crawlstats.CrawlMetrics()
+        self.latencies = collections.deque(maxlen=10000)
+
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+
+        self.load()
+
+        self.worker = threading.Thread(target=self._batch_loop)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def load(self):
+        '''
+        (Re)loads the classifier, fighter index and fighter features, e.g.
+        after the database has been updated.
+        '''
+
+        myClassifier = classifier.load_classifier(self.classifierFile,self.dbfile)
+        index = fighterindex.get_index(self.dbfile)
+        store = featurestore.load_store(self.dbfile,self.storedir)
+
+        # the same features as classifier.predict_card (the store holds the
+        # same float64 stats), so both give the same probabilities
+        features = classifier.MatchupFeatures(myClassifier,self.dbfile,store=store)
+
+        with self.lock:
+            self.features = features
+            self.index = index
+
+    def submit(self,fighter1,fighter2):
+        ''' Queues a prediction and returns a PendingPrediction. '''
+
+        pending = PendingPrediction(fighter1,fighter2)
+        self.requests.put(pending)
+
+        return pending
+
+    def predict(self,fighter1,fighter2,timeout=None):
+        '''
+        Predicts the outcome of a fight.
+
+        Parameters
+        ----------
+        fighter1 : str
+        	Name of the first fighter.
+
+        fighter2 : str
+        	Name of the second fighter.
+
+        Returns
+        -------
+        result : dict
+        	Contains fighter1 and fighter2 (as found in the database), p1 and
+        	p2 (win probabilities) and winner, or error if a fighter is not
+        	in the database.
+
+        '''
+
+        return self.submit(fighter1,fighter2).wait(timeout)
+
+    def close(self):
+        ''' Stops the batching thread once all queued requests are done. '''
+
+        self.requests.put(None)
+        self.worker.join()
+
+    def _batch_loop(self):
+        while True:
+            batch = [self.requests.get()]
+            if batch[0] is None:
+                break
+
+            # coalesce requests arriving within maxWait of the first one
+            deadline = time.time()+self.maxWait
+            stop = False
+            while len(batch) < self.maxBatch:
+                remaining = deadline-time.time()
+                try:
+                    if remaining > 0:
+                        pending = self.requests.get(timeout=remaining)
+                    else:
+                        pending = self.requests.get_nowait()
+                except Queue.Empty:
+                    break
+
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+
+            try:
+                with self.metrics.timer('batch'):
+                    results = self.predict_batch([(p.fighter1,p.fighter2) for p in batch])
+            except Exception as e:
+                results = [{'error':'%s: %s'%(type(e).__name__,e)} for p in batch]
+
+            done = time.time()
+            self.metrics.incr('batches')
+            self.metrics.incr('requests',len(batch))
+            self.metrics.gauge('last_batch_size',len(batch))
+
+            for pending,result in zip(batch,results):
+                latency = done-pending.submitted
+                self.metrics.observe('request',latency)
+                self.latencies.append(latency)
+                pending.set(result)
+
+            if stop:
+                break
+
+    def predict_batch(self,pairs):
+        '''
+        Predicts a batch of fights with a single predict_proba call.
+
+        Parameters
+        ----------
+        pairs : list
+        	List of (fighter1, fighter2) name tuples.
+
+        Returns
+        -------
+        results : list
+        	One result dict per pair; see predict.
+
+        '''
+
+        with self.lock:
+            features,index = self.features,self.index
+
+        results = [None]*len(pairs)
+        names1,names2,valid = [],[],[]
+
+        for k,(fighter1,fighter2) in enumerate(pairs):
+            match1,match2 = index.lookup(fighter1),index.lookup(fighter2)
+            missing = [name for name,match in [(fighter1,match1),(fighter2,match2)] \
+                       if match not in features.rowOfName]
+
+            if len(missing) > 0:
+                results[k] = {'fighter1':fighter1,'fighter2':fighter2,\
+                              'error':'%s not found in the database.'%', '.join(missing)}
+            else:
+                names1.append(match1)
+                names2.append(match2)
+                valid.append(k)
+
+        if len(valid) == 0:
+            return results
+
+        p = features.predict_proba(features.rows(names1),features.rows(names2))
+
+        for j,k in enumerate(valid):
+            results[k] = {'fighter1':names1[j],'fighter2':names2[j],\
+                          'p1':float(p[j,0]),'p2':float(p[j,1]),\
+                          'winner':names1[j] if p[j,0] > 0.5 else names2[j]}
+
+        return results
+
+    def stats(self):
+        '''
+        Returns service statistics: request and batch counts, mean batch size
+        and request latency percentiles (in milliseconds, over the last
+        10000 requests).
+        '''
+
+        snapshot = self.metrics.snapshot()
+        latencies = 1000*np.array(self.latencies)
+
+        stats = {'uptime':snapshot['elapsed'],\
+                 'requests':snapshot['counters'].get('requests',0),\
+                 'batches':snapshot['counters'].get('batches',0)}
+
+        stats['mean_batch_size'] = stats['requests']/float(max(stats['batches'],1))
+
+        if len(latencies) > 0:
+            for q in [50,90,99]:
+                stats['latency_p%d_ms'%q] = float(np.percentile(latencies,q))
+            stats['latency_max_ms'] = float(latencies.max())
+
+        return stats
+
+
+def handle_message(service,message):
+    '''
+    Handles one protocol message (a dict decoded from JSON). Returns a
+    PendingPrediction, or for commands a function returning the response,
+    to be called once all earlier requests have been answered.
+    '''
+
+    if type(message) != dict:
+        raise ValueError('Requests must be JSON objects.')
+
+    if message.get('cmd') == 'stats':
+        return service.stats
+
+    if message.get('cmd') == 'reload':
+        def reload():
+            service.load()
+            return {'reloaded':True}
+        return reload
+
+    return service.submit(message['fighter1'],message['fighter2'])
+
+
+def serve_stdio(service,infile=sys.stdin,outfile=sys.stdout):
+    '''
+    Serves JSON-lines requests from infile, writing one JSON response per
+    request to outfile, in the order the requests were received. Requests
+    carry an optional id, which is copied to the response.
+    '''
+
+    responses = Queue.Queue()
+
+    def writer():
+        while True:
+            item = responses.get()
+            if item is None:
+                break
+
+            requestId,response = item
+            if isinstance(response,PendingPrediction):
+                response = dict(response.wait())
+            elif callable(response):
+                response = response()
+            if requestId is not None:
+                response['id'] = requestId
+
+            outfile.write(json.dumps(response)+'\n')
+            outfile.flush()
+
+    writerThread = threading.Thread(target=writer)
+    writerThread.start()
+
+    # reading ahead while earlier requests are being predicted lets them
+    # be batched together
+    for line in iter(infile.readline,''):
+        if line.strip() == '':
+            continue
+
+        requestId = None
+        try:
+            message = json.loads(line)
+            if type(message) == dict:
+                requestId = message.get('id')
+            responses.put((requestId,handle_message(service,message)))
+        except Exception as e:
+            # keep the id (if the message decoded) so the client can match the error
+            responses.put((requestId,{'error':'%s: %s'%(type(e).__name__,e)}))
+
+    responses.put(None)
+    writerThread.join()
+
+
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' HTTP handler; the service is taken from the server's service attribute. '''
+
+    def _respond(self,code,response):
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+
+        if url.path == '/stats':
+            self._respond(200,self.server.service.stats())
+        elif url.path == '/predict' and 'fighter1' in query and 'fighter2' in query:
+            self._respond(200,self.server.service.predict(query['fighter1'],query['fighter2']))
+        else:
+            self._respond(404,{'error':'Use /predict?fighter1=...&fighter2=... or /stats'})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/predict':
+            self._respond(404,{'error':'POST a JSON list of [fighter1, fighter2] pairs to /predict'})
+            return
+
+        try:
+            pairs = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+            pending = [self.server.service.submit(pair[0],pair[1]) for pair in pairs]
+        except Exception as e:
+            self._respond(400,{'error':'%s: %s'%(type(e).__name__,e)})
+            return
+
+        self._respond(200,[p.wait() for p in pending])
+
+    def log_message(self,format,*args):
+        pass # the service keeps its own statistics
+
+
+class PredictionHTTPServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self,service,address):
+        BaseHTTPServer.HTTPServer.__init__(self,address,PredictionHandler)
+        self.service = service
+
+
+def serve_http(service,port=8642,host='127.0.0.1'):
+    ''' Serves predictions over HTTP until interrupted. '''
+
+    server = PredictionHTTPServer(service,(host,port))
+    print 'Serving predictions on http://%s:%d/'%(host,port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve fight predictions.')
+    parser.add_argument('--classifier',default='classifier.pickle')
+    parser.add_argument('--db',default='fighterdb.sqlite')
+    parser.add_argument('--http',type=int,default=None,metavar='PORT',\
+                        help='serve over HTTP on this port instead of stdin/stdout')
+    args = parser.parse_args()
+
+    service = PredictionService(args.classifier,args.db)
+
+    if args.http is None:
+        serve_stdio(service)
+    else:
+        serve_http(service,args.http)
+
+    service.close()
@@ -0,0 +1,235 @@
+import sqlite3
+import fmcrawler_sql
+
+
+INITIAL_RATING = 1500.
+K_FACTOR = 32.
+
+
+def expected_score(rating1,rating2):
+    ''' Elo expected score (win probability) of a fighter rated rating1 against one rated rating2. '''
+
+    return 1./(1.+10.**((rating2-rating1)/400.))
+
+
+class EloRatings(object):
+    '''
+    Elo ratings, updated one fight at a time in chronological order.
+
+    Parameters
+    ----------
+    k : float (optional)
+    	Maximum rating change per fight. Default is K_FACTOR.
+
+    initial : float (optional)
+    	Rating of fighters without any rated fights. Default is INITIAL_RATING.
+
+    '''
+
+    def __init__(self,k=K_FACTOR,initial=INITIAL_RATING):
+        self.k = k
+        self.initial = initial
+        self.ratings = {}
+        self.nFights = {}
+        self.lastDate = {}
+
+    def get(self,name):
+        ''' Returns the current rating of a fighter. '''
+
+        return self.ratings.get(name,self.initial)
+
+    def rate(self,fighter1,fighter2,winner,date=None):
+        '''
+        Updates the ratings of both fighters with the result of a fight.
+
+        Parameters
+        ----------
+        fighter1 : str
+        	Name of the first fighter.
+
+        fighter2 : str
+        	Name of the second fighter.
+
+        winner : str
+        	Name of the winner; anything else (e.g. 'Draw') counts as a draw.
+
+        date : str (optional)
+        	Date of the fight, stored as the fighters' last fight date.
+
+        Returns
+        -------
+        rating1, rating2 : float
+        	Ratings of the two fighters before the fight.
+
+        '''
+
+        rating1 = self.get(fighter1)
+        rating2 = self.get(fighter2)
+
+        if winner == fighter1:
+            score1 = 1.
+        elif winner == fighter2:
+            score1 = 0.
+        else:
+            score1 = .5
+
+        delta = self.k*(score1-expected_score(rating1,rating2))
+
+        self.ratings[fighter1] = rating1+delta
+        self.ratings[fighter2] = rating2-delta
+
+        for name in [fighter1,fighter2]:
+            self.nFights[name] = self.nFights.get(name,0)+1
+            self.lastDate[name] = date
+
+        return rating1,rating2
+
+
+def init_ratings(cur):
+    '''
+    Creates the Ratings table (ratings of both fighters before each fight)
+    and the FighterRatings table (current rating of each fighter), if they
+    do not exist yet.
+    '''
+
+    cur.executescript('''
+    CREATE TABLE IF NOT EXISTS Ratings (
+    fight_id	INTEGER NOT NULL PRIMARY KEY UNIQUE,
+    date	TEXT,
+    fighter1	TEXT,
+    fighter2	TEXT,
+    rating1	REAL,
+    rating2	REAL
+    );
+
+    CREATE TABLE IF NOT EXISTS FighterRatings (
+    name	TEXT NOT NULL PRIMARY KEY UNIQUE,
+    rating	REAL,
+    nfights	INTEGER,
+    last_date	TEXT
+    );
+    ''')
+
+
+def update_ratings(dbfile='fighterdb.sqlite',k=K_FACTOR,initial=INITIAL_RATING):
+    '''
+    Rates all fights in the Fights table which have not been rated yet, in
+    chronological order, continuing from the ratings stored in the database.
+    History is never replayed, so this only costs time proportional to the
+    number of new fights. Fights without a date are left unrated (they get
+    one when their pages are re-parsed, e.g. with fmcrawler_sql.replay_cache).
+
+    New fights which are older than fights that have already been rated
+    are applied after them; use rebuild_ratings to replay everything in
+    order, or after changing k or initial.
+
+    Parameters
+    ----------
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    k : float (optional)
+    	Maximum rating change per fight. Default is K_FACTOR.
+
+    initial : float (optional)
+    	Rating of new fighters. Default is INITIAL_RATING.
+
+    Returns
+    -------
+    nRated : int
+    	Number of fights rated.
+
+    '''
+
+    conn = sqlite3.connect(dbfile,timeout=10)
+    cur = conn.cursor()
+
+    init_ratings(cur)
+
+    elo = EloRatings(k,initial)
+
+    cur.execute('SELECT name,rating,nfights,last_date FROM FighterRatings')
+    for name,rating,nFights,lastDate in cur.fetchall():
+        elo.ratings[name] = rating
+        elo.nFights[name] = nFights
+        elo.lastDate[name] = lastDate
+
+    cur.execute('''SELECT Fights.id,Fights.date,Fights.fighter1,Fights.fighter2,Fights.winner
+    		FROM Fights LEFT JOIN Ratings ON Ratings.fight_id = Fights.id
+    		WHERE Ratings.fight_id IS NULL AND Fights.date IS NOT NULL
+    		ORDER BY Fights.date,Fights.id''')
+
+    ratingRows = []
+    for fightId,date,fighter1,fighter2,winner in cur.fetchall():
+        rating1,rating2 = elo.rate(fighter1,fighter2,winner,date)
+        ratingRows.append((fightId,date,fighter1,fighter2,rating1,rating2))
+
+    changed = set([row[2] for row in ratingRows]+[row[3] for row in ratingRows])
+
+    cur.executemany('''INSERT OR REPLACE INTO Ratings
+    		(fight_id,date,fighter1,fighter2,rating1,rating2) VALUES ( ?, ?, ?, ?, ?, ? )''',\
+                    ratingRows)
+    cur.executemany('''INSERT OR REPLACE INTO FighterRatings
+    		(name,rating,nfights,last_date) VALUES ( ?, ?, ?, ? )''',\
+                    [(name,elo.ratings[name],elo.nFights[name],elo.lastDate[name]) \
+                     for name in changed])
+
+    conn.commit()
+    conn.close()
+
+    return len(ratingRows)
+
+
+def rebuild_ratings(dbfile='fighterdb.sqlite',k=K_FACTOR,initial=INITIAL_RATING):
+    ''' Drops all ratings and rates every fight again from scratch; see update_ratings. '''
+
+    conn = sqlite3.connect(dbfile,timeout=10)
+    conn.executescript('''
+    DROP TABLE IF EXISTS Ratings;
+    DROP TABLE IF EXISTS FighterRatings;
+    ''')
+    conn.commit()
+    conn.close()
+
+    return update_ratings(dbfile,k,initial)
+
+
+def get_ratings(names,dbfile='fighterdb.sqlite'):
+    '''
+    Returns the current ratings of the given fighters.
+
+    Parameters
+    ----------
+    names : list
+    	Fighter names.
+
+    dbfile : str (optional)
+    	Name of the database file. Default is 'fighterdb.sqlite'.
+
+    Returns
+    -------
+    ratings : list
+    	Ratings in the same order as names; INITIAL_RATING for fighters
+    	without any rated fights (or if nothing has been rated yet).
+
+    '''
+
+    # names may be utf-8 encoded str or unicode; sqlite returns unicode
+    keys = [name.decode('utf-8') if type(name) == str else name for name in names]
+
+    conn = sqlite3.connect(dbfile)
+    cur = conn.cursor()
+
+    # only read here; the tables are created by update_ratings
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'FighterRatings'")
+    if cur.fetchone() is None:
+        rows = []
+    else:
+        rows = fmcrawler_sql.select_in(cur,'SELECT name,rating FROM FighterRatings WHERE name IN ( %s )',\
+                                       set(keys))
+
+    conn.close()
+
+    ratingOfName = dict(rows)
+
+    return [ratingOfName.get(key,INITIAL_RATING) for key in keys]
@@ -0,0 +1,41 @@
+import unittest,tempfile,shutil,os,json
+import classifier
+
+
+class LoadCardTest(unittest.TestCase):
+
+    card = [('Conor McGregor','Nick Diaz'),('Jon Jones','Daniel Cormier')]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,name,lines):
+        fname = os.path.join(self.tmpdir,name)
+        with open(fname,'w') as f:
+            f.write('\n'.join(lines)+'\n')
+
+        return fname
+
+    def test_csv_with_header(self):
+        fname = self.write('card.csv',['weight,fighter1,fighter2']+\
+                           ['155,%s,%s'%bout for bout in self.card])
+
+        self.assertEqual(classifier.load_card(fname),self.card)
+
+    def test_csv_without_header(self):
+        fname = self.write('card.csv',['%s,%s'%bout for bout in self.card])
+
+        self.assertEqual(classifier.load_card(fname),self.card)
+
+    def test_jsonl(self):
+        fname = self.write('card.jsonl',[json.dumps({'fighter1':self.card[0][0],'fighter2':self.card[0][1]}),\
+                                         json.dumps(list(self.card[1]))])
+
+        self.assertEqual(classifier.load_card(fname),self.card)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+import fightmetric as fm
+import matchups
+
+
+class WeightClassTest(unittest.TestCase):
+
+    def test_known_weights(self):
+        self.assertEqual(matchups.weight_class(fm.lbs_to_kg('155 lbs.')),'lightweight')
+        self.assertEqual(matchups.weight_class(fm.lbs_to_kg('115 lbs.')),'strawweight')
+        self.assertEqual(matchups.weight_class(fm.lbs_to_kg('265 lbs.')),'heavyweight')
+
+    def test_unknown_weights(self):
+        # the parser stores '--' as 0, which must not end up in strawweight
+        self.assertEqual(fm.lbs_to_kg('--'),0)
+        self.assertIsNone(matchups.weight_class(fm.lbs_to_kg('--')))
+        self.assertIsNone(matchups.weight_class(None))
+        self.assertIsNone(matchups.weight_class(float('nan')))
+        self.assertIsNone(matchups.weight_class(fm.lbs_to_kg('300 lbs.')))
+
+    def test_weight_classes_skips_unknown(self):
+        fighters = {'A':{'weight':fm.lbs_to_kg('115 lbs.')},\
+                    'B':{'weight':0},\
+                    'C':{'weight':fm.lbs_to_kg('155 lbs.')}}
+
+        self.assertEqual(matchups.weight_classes(fighters),\
+                         {'strawweight':['A'],'lightweight':['C']})
+
+
+if __name__ == "__main__":
+    unittest.main()
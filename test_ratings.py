@@ -0,0 +1,77 @@
+import unittest,tempfile,shutil,os,sqlite3
+import numpy as np
+import benchmarks,fmcrawler_sql,fmprocess,ratings
+
+
+def write_records(dbfile,records):
+    conn = sqlite3.connect(dbfile)
+    writer = fmcrawler_sql.BatchWriter(conn,50)
+    for record in records:
+        writer.add(record)
+    writer.flush()
+    conn.close()
+
+
+class RatingFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir,'fighterdb.sqlite')
+        self.records = benchmarks.synthetic_records(60)
+
+        fmcrawler_sql.init_db(self.dbfile)
+        write_records(self.dbfile,self.records)
+        ratings.update_ratings(self.dbfile)
+
+    def tearDown(self):
+        fmprocess.clear_cache()
+        shutil.rmtree(self.tmpdir)
+
+    def rating_features(self):
+        fmprocess.clear_cache()
+        fighters = fmprocess.get_fighters(self.dbfile)
+        X,y = fmprocess.build_features(fighters,self.dbfile,useRatings=True)
+
+        return X[fmprocess.rating_features].values
+
+    def expected_ratings(self):
+        ''' Pre-fight ratings of Fights.fighter1 and Fights.fighter2, looked up by name. '''
+
+        conn = sqlite3.connect(self.dbfile)
+        rows = conn.execute('''SELECT Fights.fighter1,Fights.fighter2,
+        		Ratings.fighter1,Ratings.rating1,Ratings.rating2
+        		FROM Fights JOIN Ratings ON Ratings.fight_id = Fights.id
+        		ORDER BY Fights.rowid''').fetchall()
+        conn.close()
+
+        expected = []
+        for fighter1,fighter2,rated1,rating1,rating2 in rows:
+            ratingOfName = {rated1:rating1,(fighter2 if rated1 == fighter1 else fighter1):rating2}
+            expected.append([ratingOfName[fighter1],ratingOfName[fighter2]])
+
+        return np.array(expected)
+
+    def test_rewriting_pages_after_rating(self):
+        before = self.rating_features()
+
+        # re-write pages in the opposite order, so every fight is seen from
+        # the other fighter's side last
+        write_records(self.dbfile,self.records[::-1])
+
+        np.testing.assert_array_equal(self.rating_features(),before)
+        np.testing.assert_array_equal(self.rating_features(),self.expected_ratings())
+
+    def test_fights_flipped_after_rating(self):
+        # fights whose order differs from Ratings (e.g. in databases written
+        # before fights kept their orientation)
+        conn = sqlite3.connect(self.dbfile)
+        conn.execute('''UPDATE Fights SET fighter1 = fighter2, fighter2 = fighter1,
+        		str1 = str2, str2 = str1 WHERE id % 2 = 0''')
+        conn.commit()
+        conn.close()
+
+        np.testing.assert_array_equal(self.rating_features(),self.expected_ratings())
+
+
+if __name__ == "__main__":
+    unittest.main()